@@ -0,0 +1,280 @@
+"""
+benchmark.py
+Times ``import quadtree`` in a new interpreter, tree builds, overlap
+queries against kings-county.geojson and point iteration, and measures
+peak memory, for several point sets.
+
+    $ python benchmark.py --sizes 10000 100000 --output results.json
+    $ python benchmark.py --baseline results.json
+
+Results are written as JSON. With ``--baseline``, every timing and
+memory figure is compared with a saved run, and the exit status is 1 if
+any of them got worse by more than ``--threshold``.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+import quadtree
+
+COUNTY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'kings-county.geojson')
+WORKLOADS = ('uniform', 'clustered', 'duplicated')
+# the figures compared against a baseline, lower is better
+METRICS = ('seconds', 'peak_bytes', 'bytes')
+
+
+def load_polygons(path=COUNTY):
+    """
+    Returns ``(name, Feature)`` pairs for every feature of ``path``, and
+    for each polygon of a multipolygon feature.
+    """
+    with open(path) as fp:
+        collection = json.load(fp)
+
+    polygons = []
+    for index, item in enumerate(collection['features']):
+        geometry = shape(item['geometry'])
+        polygons.append(('feature%d' % index, quadtree.Feature(geometry)))
+        if geometry.geom_type == 'MultiPolygon':
+            polygons.extend([
+                ('feature%d.polygon%d' % (index, number),
+                 quadtree.Feature(polygon))
+                for number, polygon in enumerate(geometry.geoms)
+            ])
+    return polygons
+
+
+def make_points(workload, number_of_points, bbox, seed=0):
+    """
+    Returns ``xs, ys`` coordinate arrays of ``number_of_points`` within
+    ``bbox``:
+
+    uniform: spread evenly.
+    clustered: around 20 centres, with a tenth of the points uniform.
+    duplicated: drawn from only 1000 distinct locations.
+    """
+    random = np.random.RandomState(seed)
+    x0, y0, x1, y1 = bbox
+    if workload == 'uniform':
+        xs = random.uniform(x0, x1, number_of_points)
+        ys = random.uniform(y0, y1, number_of_points)
+    elif workload == 'clustered':
+        centres = random.uniform(size=(20, 2))
+        labels = random.randint(0, 20, number_of_points)
+        xs = centres[labels, 0] + random.normal(0, 0.01, number_of_points)
+        ys = centres[labels, 1] + random.normal(0, 0.01, number_of_points)
+        background = random.uniform(size=number_of_points) < 0.1
+        xs[background] = random.uniform(size=background.sum())
+        ys[background] = random.uniform(size=background.sum())
+        xs = x0 + (x1 - x0) * np.clip(xs, 0, 1)
+        ys = y0 + (y1 - y0) * np.clip(ys, 0, 1)
+    elif workload == 'duplicated':
+        locations = random.uniform(size=(1000, 2))
+        labels = random.randint(0, 1000, number_of_points)
+        xs = x0 + (x1 - x0) * locations[labels, 0]
+        ys = y0 + (y1 - y0) * locations[labels, 1]
+    else:
+        raise ValueError('unknown workload %r.' % (workload,))
+    return xs, ys
+
+
+def best_time(function, repeat):
+    """The fastest of ``repeat`` runs of ``function``, and its result."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = timeit.default_timer()
+        result = function()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def peak_memory(function):
+    """The peak bytes allocated while running ``function``."""
+    gc.collect()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def allocated_by(build):
+    """Returns the object built by ``build`` and the bytes it holds."""
+    gc.collect()
+    tracemalloc.start()
+    obj = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, current
+
+
+def import_time(repeat):
+    """
+    The fastest of ``repeat`` ``import quadtree`` in a new interpreter,
+    and the heavy modules that the import loaded.
+    """
+    code = '\n'.join([
+        'import sys, timeit',
+        'start = timeit.default_timer()',
+        'import quadtree',
+        'elapsed = timeit.default_timer() - start',
+        'print(elapsed, *[name for name in ("numpy", "shapely")'
+        ' if name in sys.modules])',
+    ])
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=here).decode().split()
+        if best is None or float(output[0]) < best:
+            best = float(output[0])
+    return best, output[1:]
+
+
+def run_workload(workload, number_of_points, polygons, bbox, repeat,
+                 incremental=True):
+    """Runs every benchmark on one point set, keyed by name."""
+    results = {}
+    prefix = '%s/%d' % (workload, number_of_points)
+    xs, ys = make_points(workload, number_of_points, bbox)
+    points = list(zip(xs.tolist(), ys.tolist()))
+
+    if incremental:
+        seconds, _ = best_time(lambda: quadtree.QuadTree(points), repeat)
+        results['build/%s/incremental' % prefix] = {
+            'seconds': seconds,
+            'peak_bytes': peak_memory(lambda: quadtree.QuadTree(points)),
+        }
+    seconds, tree = best_time(
+        lambda: quadtree.QuadTree.from_arrays(xs, ys), repeat)
+    results['build/%s/bulk' % prefix] = {
+        'seconds': seconds,
+        'peak_bytes': peak_memory(
+            lambda: quadtree.QuadTree.from_arrays(xs, ys)),
+        'nodes': tree.summary()['nodes'],
+    }
+
+    for name, feature in polygons:
+        seconds, count = best_time(
+            lambda: tree.count_overlapping_points(feature), repeat)
+        results['count/%s/%s' % (prefix, name)] = {
+            'seconds': seconds,
+            'points': count,
+        }
+
+    seconds, _ = best_time(lambda: sum(1 for _ in tree.walk()), repeat)
+    results['walk/%s' % prefix] = {
+        'seconds': seconds,
+        'points_per_second': number_of_points / seconds,
+    }
+    seconds, _ = best_time(tree.get_all_points, repeat)
+    results['get_all_points/%s' % prefix] = {
+        'seconds': seconds,
+        'points_per_second': number_of_points / seconds,
+    }
+
+    # drop the tree, so that it is not counted in the figures below
+    tree = None
+    tree, tree_bytes = allocated_by(
+        lambda: quadtree.QuadTree.from_arrays(xs, ys))
+    tree = None
+    _, compact_bytes = allocated_by(
+        lambda: quadtree.CompactQuadTree.from_arrays(xs, ys))
+    results['memory/%s/quadtree' % prefix] = {'bytes': tree_bytes}
+    results['memory/%s/compact' % prefix] = {'bytes': compact_bytes}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the figures of ``results`` with those of ``baseline``.
+
+    :return: A list of ``(name, metric, old, new, ratio)`` rows, and the
+    rows whose ratio is above ``threshold``.
+    """
+    rows = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric in METRICS:
+            old = baseline[name].get(metric)
+            new = results[name].get(metric)
+            if old and new is not None:
+                rows.append((name, metric, old, new, float(new) / old))
+    return rows, [row for row in rows if row[-1] > threshold]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10 ** 4, 10 ** 5],
+                        help='numbers of points, up to 10**7')
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS,
+                        default=list(WORKLOADS))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per timing, the fastest is kept')
+    parser.add_argument('--no-incremental', dest='incremental',
+                        action='store_false',
+                        help='skip point by point builds, slow for big sizes')
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    polygons = load_polygons()
+    bbox = polygons[0][1].bounds
+    seconds, loaded = import_time(args.repeat)
+    results = {'import': {'seconds': seconds, 'loaded': loaded}}
+    for workload in args.workloads:
+        for number_of_points in args.sizes:
+            results.update(run_workload(workload, number_of_points, polygons,
+                                        bbox, args.repeat, args.incremental))
+
+    output = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'shapely': shapely.__version__,
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['results']
+        rows, regressions = compare(results, baseline, args.threshold)
+        for name, metric, old, new, ratio in rows:
+            flag = ' REGRESSION' if ratio > args.threshold else ''
+            sys.stderr.write('%-60s %-10s %12.6g %12.6g %6.2fx%s\n'
+                             % (name, metric, old, new, ratio, flag))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,92 @@ quadtree.py
 Implements a Node and QuadTree class that can be used as
 base classes for more sophisticated implementations.
 """
-from shapely.geometry import Polygon as shapelyPolygon
-from shapely.geometry import Point as shapelyPoint
-from shapely.geometry.base import BaseGeometry
+import collections
+import contextlib
+import heapq
+import io
+import itertools
+import json
+import math
+import os
+import re
+import struct
+import sys
+import threading
+import timeit
+
+# numpy is imported by load_numpy on first use, by bulk loading, batch
+# tests and the array-backed trees, so that ``import quadtree`` stays fast
+np = None
+_numpy_missing = False
+
+# shapely is imported by load_shapely when a shapely geometry is first
+# wrapped in a Feature, trees and ring geometries work without it
+shapelyPolygon = None
+shapelyPoint = None
+shapelyShape = None
+BaseGeometry = None
+prep = None
+shapelyWkb = None
+intersects_xy = None
+prepare_geometry = None
+vectorized = None
 
 __author__ = 'Malcolm Kesson, Miklos Koren, James Hohman'
 
 
+def load_shapely():
+    """Imports shapely, once. Called by the code paths that need it."""
+    global shapelyPolygon, shapelyPoint, shapelyShape, BaseGeometry, prep
+    global shapelyWkb, intersects_xy, prepare_geometry, vectorized
+    if BaseGeometry is not None:
+        return
+
+    from shapely.geometry import Polygon as shapelyPolygon
+    from shapely.geometry import Point as shapelyPoint
+    from shapely.geometry import shape as shapelyShape
+    from shapely.prepared import prep
+    from shapely import wkb as shapelyWkb
+    try:
+        # shapely >= 2.0 tests coordinates without creating Point objects
+        from shapely import intersects_xy
+        from shapely import prepare as prepare_geometry
+        vectorized = None
+    except ImportError:
+        intersects_xy = None
+        prepare_geometry = None
+        try:
+            from shapely import vectorized
+        except (ImportError, ValueError):  # missing, or built for another numpy
+            vectorized = None
+    # set last, it marks shapely as loaded
+    from shapely.geometry.base import BaseGeometry
+
+
+def load_numpy():
+    """
+    Imports numpy, once. Called by the code paths that need it.
+
+    :return: The numpy module, or None if it is not installed.
+    """
+    global np, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy as np
+        except ImportError:
+            _numpy_missing = True
+    return np
+
+
+def is_shapely_geometry(obj):
+    """
+    Whether ``obj`` is a shapely geometry, without importing shapely: if
+    it was never imported, nothing can be one.
+    """
+    base = sys.modules.get('shapely.geometry.base')
+    return base is not None and isinstance(obj, base.BaseGeometry)
+
+
 def bbox_to_coords(bbox):
     if len(bbox) != 4:
         raise TypeError('bbox must have 4 coordinates.')
@@ -19,6 +98,49 @@ def bbox_to_coords(bbox):
     return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
 
 
+_last_polygon = (None, None)
+
+
+def rectangle_polygon(rectangle):
+    """
+    Returns ``rectangle`` as a shapely Polygon.
+
+    The last polygon is reused, as a node is usually tested for containment
+    and intersection, or against many features in a row.
+    """
+    global _last_polygon
+    last_rectangle, polygon = _last_polygon
+    if last_rectangle != rectangle:
+        polygon = shapelyPolygon(bbox_to_coords(rectangle))
+        _last_polygon = (rectangle, polygon)
+    return polygon
+
+
+def quadrants(rect, x, y):
+    """
+    The rectangles of the four children of a node split at (x, y), in
+    the order used by ``Node.subdivide``.
+    """
+    x0, y0, x1, y1 = rect
+    return [(x0, y0, x, y), (x0, y, x, y1), (x, y, x1, y1), (x, y0, x1, y)]
+
+
+def payload_value(point, field):
+    """The value of ``field`` in the payload of a Point, or None."""
+    data = getattr(point, 'data', None)
+    if isinstance(data, dict):
+        return data.get(field)
+    return None
+
+
+def rectangle_distance2(x, y, rectangle):
+    """Squared distance from (x, y) to the closest point of ``rectangle``."""
+    x0, y0, x1, y1 = rectangle
+    dx = max(x0 - x, 0.0, x - x1)
+    dy = max(y0 - y, 0.0, y - y1)
+    return dx * dx + dy * dy
+
+
 def point_in_rectangle(point, rectangle):
     if type(point) in [tuple, list]:
         x, y = point[0], point[1]
@@ -37,263 +159,3622 @@ def get_coords(point):
         return point.x, point.y
 
 
-class Feature(object):
-    """A wrapper around shapely geometries."""
-    def __init__(self, geometry):
-        if not isinstance(geometry, BaseGeometry):
-            raise Exception
+def finite_coords(point):
+    """
+    The coordinates of ``point`` as floats.
 
-        self.geometry = geometry
+    :raises ValueError: if a coordinate is NaN or infinite, as no
+    rectangle can be grown to contain it.
+    """
+    x, y = [float(item) for item in get_coords(point)]
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise ValueError('%r has coordinates that are not finite.'
+                         % (point,))
+    return x, y
 
-    def contains_point(self, point):
-        if self.geometry.is_empty:
-            return False
 
-        sh_point = shapelyPoint(get_coords(point))
+def tile_edges(z, x, y, size=256):
+    """
+    The pixel edges of the Web Mercator tile ``z/x/y``, in degrees.
 
-        return (
-            point_in_rectangle(point, self.geometry.bounds)
-            and self.geometry.intersects(sh_point)
-        )
+    :return: Increasing longitude and latitude arrays of ``size + 1``
+    edges. Latitude edges are not evenly spaced.
+    """
+    load_numpy()
+    tiles = 2 ** z
+    steps = np.arange(size + 1) / float(size)
+    lons = (x + steps) / tiles * 360.0 - 180.0
+    # pixel rows go from north to south
+    rows = (y + steps[::-1]) / tiles
+    lats = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * rows))))
+    return lons, lats
 
-    def contains_rectangle(self, rectangle):
-        if self.geometry.is_empty:
-            return False
 
-        x0, y0, x1, y1 = rectangle
-        points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
-        sh_polygon = shapelyPolygon(points)
-        return all([point_in_rectangle(point, self.geometry.bounds) for point in
-                    points]) and self.geometry.contains(sh_polygon)
+def cell_index(edges, values):
+    """
+    The index of the cell of each value, ``i`` where ``edges[i] <= value
+    < edges[i + 1]``, clipped to the cells: the same as
+    ``np.searchsorted(edges, values, 'right') - 1``.
+    """
+    load_numpy()
+    cells = len(edges) - 1
+    step = (edges[-1] - edges[0]) / float(cells)
+    if not step or np.abs(np.diff(edges) - step).max() > 1e-9 * step:
+        index = np.searchsorted(edges, values, 'right') - 1
+        return np.clip(index, 0, cells - 1)
 
-    def intersects_rectangle(self, rectangle):
-        if self.geometry.is_empty:
-            return False
+    # evenly spaced edges: guess by arithmetic, then fix rounding
+    index = np.clip(((values - edges[0]) / step).astype(np.int64),
+                    0, cells - 1)
+    index -= (values < edges[index]) & (index > 0)
+    index += (values >= edges[index + 1]) & (index < cells - 1)
+    return index
 
-        x0, y0, x1, y1 = rectangle
-        points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
-        sh_polygon = shapelyPolygon(points)
-        return not self.geometry.disjoint(sh_polygon)
 
+def bin_coordinates(grid, x_edges, y_edges, xs, ys, weights=None):
+    """
+    Adds the points ``xs, ys`` (with optional ``weights``) to the cells
+    of ``grid`` with the given increasing edges, leaving out the points
+    outside of the grid. A point on the edge between two cells goes to
+    the upper one, except on the last edge.
+    """
+    load_numpy()
+    ny, nx = grid.shape
+    inside = ((x_edges[0] <= xs) & (xs <= x_edges[-1])
+              & (y_edges[0] <= ys) & (ys <= y_edges[-1]))
+    columns = cell_index(x_edges, xs[inside])
+    rows = cell_index(y_edges, ys[inside])
+    if weights is not None:
+        weights = np.asarray(weights)[inside]
+    grid.ravel()[:] += np.bincount(rows * nx + columns, weights,
+                                   minlength=nx * ny).astype(grid.dtype)
 
-class Node(object):
-    # In the case of a root node "parent" will be None. The
-    # "rect" lists the minx, miny, maxx, maxy of the rectangle
-    # represented by the node.
-    ROOT = 0
-    BRANCH = 1
-    LEAF = 2
 
-    def __init__(self, parent, rect, max_points=2):
-        self.parent = parent
-        self.children = []
-        self._points = {}
-        self.features = []
-        self.number_of_points = 0
-        self.max_points = max_points
+def count_locations(points, limit):
+    """
+    Counts the distinct coordinates of ``points``, stopping above
+    ``limit``. Points with different payloads at one location count once,
+    as no split can separate them.
+    """
+    locations = set()
+    for point in points:
+        locations.add(get_coords(point))
+        if len(locations) > limit:
+            break
+    return len(locations)
 
-        self.rectangle = tuple([float(item) for item in rect])
-        self.type = Node.LEAF
 
-    @property
-    def points(self):
-        points = []
-        for coordinate, frequency in self._points.items():
-            points.extend([coordinate] * frequency)
-        return points
+def frequencies(points):
+    """Maps each distinct point to the number of times it occurs."""
+    output = {}
+    for point in points:
+        output[point] = output.get(point, 0) + 1
+    return output
 
-    def add_point(self, point):
-        # point_feature = featurize(point)
-        # point = feature_to_point(point_feature)
-        if self.point_coords_in_bbox(point):
-            if self.type == Node.LEAF:
-                if point in self._points:
-                    self._points[point] += 1
-                else:
-                    self._points[point] = 1
-                self.features.append(point)
-                self.number_of_points += 1
-                if len(self._points) > self.max_points:
-                    # the box is crowded, break it up in 4
-                    self.subdivide()
+
+def coords_in_rectangle(coords, rectangle):
+    """Boolean mask of the rows of an (N, 2) array within ``rectangle``."""
+    x0, y0, x1, y1 = rectangle
+    xs = coords[:, 0]
+    ys = coords[:, 1]
+    return (x0 <= xs) & (xs <= x1) & (y0 <= ys) & (ys <= y1)
+
+
+@contextlib.contextmanager
+def open_source(source, **kwargs):
+    """Opens ``source`` if it is a path, file objects are used as they are."""
+    if hasattr(source, 'read'):
+        yield source
+    else:
+        with io.open(source, **kwargs) as fp:
+            yield fp
+
+
+def iter_csv_points(source, x='x', y='y', properties=False, **kwargs):
+    """
+    Streams the points of a CSV file with a header row.
+
+    :param source: path or file object.
+    :param x: name of the x column.
+    :param y: name of the y column.
+    :param properties: yield Points carrying the row as payload instead
+    of (x, y) tuples.
+    :param kwargs: passed on to ``csv.DictReader``.
+    """
+    import csv
+
+    with open_source(source, newline='') as fp:
+        for row in csv.DictReader(fp, **kwargs):
+            if properties:
+                yield Point(float(row[x]), float(row[y]), row)
             else:
-                # find where the point goes
-                for child in self.children:
-                    if child.point_coords_in_bbox(point):
-                        child.add_point(point)
-                        self.number_of_points += 1
-                        break
-        else:
-            # point not in box, cannot place
-            raise Exception
+                yield float(row[x]), float(row[y])
 
-    def count_overlapping_points(self, feature):
-        if feature.contains_rectangle(self.rectangle):
-            # all points are within
-            return self.number_of_points
-        elif feature.intersects_rectangle(self.rectangle):
-            if self.type == Node.LEAF:
-                # we cannot continue recursion, do a "manual" count
-                return sum([
-                    frequency for point, frequency in self._points.items()
-                    if feature.contains_point(point)
-                ])
+
+_whitespace = re.compile(r'[ \t\r\n]*')
+
+
+def _find_features_array(decoder, buffer, position):
+    """
+    Skips the members of the object starting at ``position`` up to its
+    ``"features"`` array.
+
+    :return: The position after the opening bracket of the array, or None
+    if the buffer ends first or the object has no such member.
+    """
+    position += 1
+    while True:
+        position = _whitespace.match(buffer, position).end()
+        if buffer[position:position + 1] == ',':
+            position += 1
+            continue
+        if buffer[position:position + 1] != '"':
+            return None
+        try:
+            key, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            return None
+        position = _whitespace.match(buffer, position).end()
+        if buffer[position:position + 1] != ':':
+            return None
+        position = _whitespace.match(buffer, position + 1).end()
+        if key == 'features' and buffer[position:position + 1] == '[':
+            return position + 1
+        try:
+            # another member, which may hold "features" keys of its own
+            position = decoder.raw_decode(buffer, position)[1]
+        except ValueError:
+            return None
+
+
+def iter_json_features(fp, chunk_size=65536):
+    """
+    Decodes the features of a GeoJSON FeatureCollection, or of a sequence
+    of GeoJSON objects (one per line, or RFC 8142 text sequences), one at
+    a time while reading ``fp`` in chunks.
+
+    Only the feature being decoded is kept in memory, not the document.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    in_collection = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n\x1e,':
+            position += 1
+
+        if position < len(buffer):
+            if in_collection and buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # incomplete, unless this is the start of a collection
+                start = None
+                if not in_collection and buffer[position] == '{':
+                    start = _find_features_array(decoder, buffer, position)
+                if start is not None:
+                    in_collection = True
+                    position = start
+                    continue
             else:
-                return sum([
-                   child.count_overlapping_points(feature)
-                   for child in self.children
-                ])
-        else:
-            return 0
+                if item.get('type') == 'FeatureCollection':
+                    # a small collection, decoded at once
+                    for feature in item.get('features', []):
+                        yield feature
+                else:
+                    yield item
+                continue
 
-    def get_overlapping_points(self, feature):
-        if feature.contains_rectangle(self.rectangle):
-            # all points are within
-            return self.get_all_points()
-        elif feature.intersects_rectangle(self.rectangle):
-            if self.type == Node.LEAF:
-                # we cannot continue recursion, do a "manual" count
-                return [
-                    point for point in self.features if
-                    feature.contains_point(point)
-                ]
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            if buffer[position:].strip():
+                raise ValueError('truncated GeoJSON document.')
+            return
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iter_geojson_points(source, properties=False, chunk_size=65536):
+    """
+    Streams the points of the Point and MultiPoint features of a GeoJSON
+    file, see ``iter_json_features``. Other geometries are skipped.
+
+    :param source: path or file object.
+    :param properties: yield Points carrying the feature properties as
+    payload instead of (x, y) tuples.
+    """
+    with open_source(source) as fp:
+        for feature in iter_json_features(fp, chunk_size):
+            if feature.get('type') == 'Feature':
+                geometry = feature.get('geometry') or {}
+                data = feature.get('properties')
             else:
-                output = []
-                for child in self.children:
-                    output.extend(child.get_overlapping_points(feature))
-                return output
-        else:
-            return []
+                geometry = feature
+                data = None
 
-    def get_all_points(self):
-        if self.type == Node.LEAF:
-            return self.features
-        else:
-            output = []
-            for child in self.children:
-                output.extend(child.get_all_points())
-            return output
+            if geometry.get('type') == 'Point':
+                coordinates = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPoint':
+                coordinates = geometry['coordinates']
+            else:
+                continue
 
-    def subdivide(self):
-        """
-        Recursively subdivides a rectangle. Division occurs
-        ONLY if the rectangle spans a "feature of interest".
-        :return:
-        """
-        if not self.type == Node.LEAF:
-            # only leafs can be subdivided
-            raise Exception
+            for coordinate in coordinates:
+                x, y = float(coordinate[0]), float(coordinate[1])
+                if properties:
+                    yield Point(x, y, data)
+                else:
+                    yield x, y
 
-        features = self.features
-        self._points = {}
-        self.features = []
-        self.type = Node.BRANCH
 
-        x0, y0, x1, y1 = self.rectangle
-        half_width = (x1 - x0) / 2
-        half_height = (y1 - y0) / 2
-        rects = [
-            (x0, y0, x0 + half_width, y0 + half_height),
-            (x0, y0 + half_height, x0 + half_width, y1),
-            (x0 + half_width, y0 + half_height, x1, y1),
-            (x0 + half_width, y0, x1, y0 + half_height)
-        ]
-        for rect in rects:
-            self.children.append(Node(self, rect, self.max_points))
-        for point in features:
-            for child in self.children:
-                if child.point_coords_in_bbox(point):
-                    child.add_point(point)
-                    break
+def coordinate_arrays(xs, ys=None):
+    """
+    Normalizes bulk-load input to two flat float arrays.
 
-    def point_coords_in_bbox(self, point):
-        """
-        Test if the point's _coordinates_ fall within the
-        Node's bounding box.
+    :param xs: x coordinates, or an (N, 2) array of coordinates when
+    ``ys`` is omitted.
+    :param ys: y coordinates.
+    :return: A tuple of contiguous float64 arrays ``(xs, ys)``.
+    """
+    if load_numpy() is None:
+        raise ImportError('numpy is required to bulk-load a QuadTree.')
 
-        NOT whether the Point object exists within the node or not.
+    if ys is None:
+        coords = np.asarray(xs, dtype=float)
+        if coords.ndim != 2 or coords.shape[1] != 2:
+            raise TypeError('coordinates must be an (N, 2) array.')
+        xs, ys = coords[:, 0], coords[:, 1]
 
-        :param point:
-        :type point: Point class or tuple of (x, y) coordinates.
-        :return: Returns True if the coordinates lie within the
-        Node's bounding box.
-        :rtype bool:
-        """
-        x, y = get_coords(point)
+    xs = np.ascontiguousarray(xs, dtype=float).ravel()
+    ys = np.ascontiguousarray(ys, dtype=float).ravel()
+    if xs.shape != ys.shape:
+        raise TypeError('xs and ys must have the same length.')
 
-        x0, y0, x1, y1 = self.rectangle
-        if x0 <= x <= x1 and y0 <= y <= y1:
-            return True
+    return xs, ys
+
+
+def bulk_partition(xs, ys, rect, max_points, max_depth=None):
+    """
+    Partitions points into quadrants top-down, one tree level at a time.
+
+    Splits nodes by the same rule as ``Node.add_point``: a node above
+    ``max_depth`` is broken up when it holds more than ``max_points``
+    distinct coordinates, and a point on a quadrant boundary goes to the
+    first child (in ``subdivide`` order) whose rectangle contains it.
+
+    The nodes are returned in breadth-first order as flat arrays:
+
+    * ``rects``: (M, 4) array of node rectangles,
+    * ``counts``: number of points in each node,
+    * ``first_child``: index of the first of the four consecutive
+      children of each node, -1 for leaves,
+    * ``starts``: offset of each node's points in ``order``,
+
+    where ``order`` is a permutation of the input that keeps the points
+    of every node contiguous and in input order.
+    """
+    load_numpy()
+    n = len(xs)
+    order = np.arange(n)
+
+    # flag one representative per distinct coordinate pair, so that the
+    # number of distinct points in a node is a sum over its flags
+    lex = np.lexsort((ys, xs))
+    sorted_xs = xs[lex]
+    sorted_ys = ys[lex]
+    first = np.ones(n, dtype=bool)
+    first[1:] = ((sorted_xs[1:] != sorted_xs[:-1])
+                 | (sorted_ys[1:] != sorted_ys[:-1]))
+    distinct = np.zeros(n, dtype=bool)
+    distinct[lex[first]] = True
+
+    level_rects = np.array([rect], dtype=float)
+    level_counts = np.array([n], dtype=np.int64)
+    level_starts = np.zeros(1, dtype=np.int64)
+    rects, counts, starts, first_child = [], [], [], []
+    number_of_nodes = 1
+
+    while len(level_counts):
+        rects.append(level_rects)
+        counts.append(level_counts)
+        starts.append(level_starts)
+
+        cumulative = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(distinct[order], out=cumulative[1:])
+        level_distinct = (cumulative[level_starts + level_counts]
+                          - cumulative[level_starts])
+
+        if max_depth is not None and len(rects) > max_depth:
+            # the leaves of the last level overflow instead
+            level_distinct[:] = 0
+        split = np.flatnonzero(level_distinct > max_points)
+        children = np.full(len(level_counts), -1, dtype=np.int64)
+        children[split] = number_of_nodes + 4 * np.arange(len(split))
+        first_child.append(children)
+        number_of_nodes += 4 * len(split)
+
+        if not len(split):
+            break
+
+        split_rects = level_rects[split]
+        split_counts = level_counts[split]
+        split_starts = level_starts[split]
+
+        # positions in ``order`` of the points of every splitting node
+        owner = np.repeat(np.arange(len(split)), split_counts)
+        positions = (np.arange(len(owner))
+                     - np.repeat(np.cumsum(split_counts) - split_counts,
+                                 split_counts)
+                     + np.repeat(split_starts, split_counts))
+        members = order[positions]
+
+        # same arithmetic as ``subdivide`` so the boundaries match exactly
+        x0, y0, x1, y1 = split_rects.T
+        xm = x0 + (x1 - x0) / 2
+        ym = y0 + (y1 - y0) / 2
+
+        px = xs[members]
+        py = ys[members]
+        left = px <= xm[owner]
+        quadrant = np.where(
+            left,
+            np.where(py <= ym[owner], 0, 1),
+            np.where(py >= ym[owner], 2, 3)
+        )
+        key = 4 * owner + quadrant
+        order[positions] = members[np.argsort(key, kind='stable')]
+
+        child_counts = np.bincount(
+            key, minlength=4 * len(split)).reshape(-1, 4)
+        child_starts = (split_starts[:, None] + np.cumsum(child_counts, axis=1)
+                        - child_counts)
+
+        level_rects = np.stack([
+            np.stack([x0, y0, xm, ym], axis=1),
+            np.stack([x0, ym, xm, y1], axis=1),
+            np.stack([xm, ym, x1, y1], axis=1),
+            np.stack([xm, y0, x1, ym], axis=1),
+        ], axis=1).reshape(-1, 4)
+        level_counts = child_counts.ravel()
+        level_starts = child_starts.ravel()
+
+    return (np.concatenate(rects), np.concatenate(counts),
+            np.concatenate(first_child), np.concatenate(starts), order)
+
+
+def clip_segment(segment, rectangle):
+    """
+    Clips ``segment``, ``(ax, ay, bx, by)``, to the closed ``rectangle``
+    (Liang-Barsky).
+
+    :return: The clipped part as a segment, None if they do not meet.
+    """
+    ax, ay, bx, by = segment
+    x0, y0, x1, y1 = rectangle
+    dx = bx - ax
+    dy = by - ay
+    t0 = 0.0
+    t1 = 1.0
+    # p * t <= q along each side
+    for p, q in ((-dx, ax - x0), (dx, x1 - ax), (-dy, ay - y0), (dy, y1 - ay)):
+        if p == 0:
+            if q < 0:
+                return None
+        elif p < 0:
+            t0 = max(t0, q / p)
         else:
-            return False
+            t1 = min(t1, q / p)
+    if t0 > t1:
+        return None
+    return (ax + dx * t0, ay + dy * t0, ax + dx * t1, ay + dy * t1)
 
-    def walk(self):
-        """An iterator over the points of in the Node"""
-        if self.type == Node.LEAF:
-            for point in self.points:
-                yield point
+
+def _clip_ring(xs, ys, rectangle):
+    """
+    Clips a closed ring to ``rectangle`` (Sutherland-Hodgman).
+
+    :return: The coordinates of the clipped ring, not closed.
+    """
+    x0, y0, x1, y1 = rectangle
+    xs = xs[:-1]
+    ys = ys[:-1]
+    for coords, bound, keep_above in ((0, x0, True), (0, x1, False),
+                                      (1, y0, True), (1, y1, False)):
+        if not len(xs):
+            break
+        values = xs if coords == 0 else ys
+        inside = values >= bound if keep_above else values <= bound
+        next_xs = np.roll(xs, -1)
+        next_ys = np.roll(ys, -1)
+        next_values = np.roll(values, -1)
+        crossing = inside != np.roll(inside, -1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # only kept where the edge crosses, so never divided by zero
+            t = (bound - values) / (next_values - values)
+            cross_xs = xs + t * (next_xs - xs)
+            cross_ys = ys + t * (next_ys - ys)
+        if coords == 0:
+            cross_xs = np.full(len(xs), bound)
         else:
-            for child in self.children:
-                for point in child.walk():
-                    yield point
+            cross_ys = np.full(len(xs), bound)
+        # each vertex emits itself if inside, then the crossing if any
+        keep = np.column_stack([inside, crossing]).ravel()
+        xs = np.column_stack([xs, cross_xs]).ravel()[keep]
+        ys = np.column_stack([ys, cross_ys]).ravel()[keep]
+    return xs, ys
 
-    def get_bbox(self):
-        return self.rectangle
 
+def _ring_area(xs, ys):
+    """The unsigned area of a ring, closed or not."""
+    if not len(xs):
+        return 0.0
+    # relative to a vertex, far from the origin the products would cancel
+    xs = xs - xs[0]
+    ys = ys - ys[0]
+    return abs(float(np.dot(xs, np.roll(ys, -1)) -
+                     np.dot(np.roll(xs, -1), ys))) / 2
 
-class Point(object):
+
+class RingGeometry(object):
     """
-    A point object which allows a paylood to be attached.
+    Polygons given by coordinate rings, as GeoJSON Polygon and
+    MultiPolygon coordinates are: each polygon is a list of rings, the
+    exterior first and then its holes.
+
+    Features of rings are tested with numpy, without shapely. Points on
+    the boundary are within the polygons, as with shapely geometries.
     """
-    def __init__(self, x=None, y=None, data=None):
-        self.x = x
-        self.y = y
-        self.data = data
+    # above this many edge and point pairs, points are tested in bands
+    CHUNK = 2 ** 16
 
-    def __repr__(self):
-        return 'p(%s, %s)' % (str(self.x), str(self.y))
+    def __init__(self, polygons, geom_type='MultiPolygon'):
+        if load_numpy() is None:
+            raise ImportError('numpy is required for ring geometries.')
 
-    def __hash__(self):
-        if type(self.data) == dict:
-            data_hash = hash(frozenset(self.data.items()))
+        self.geom_type = geom_type
+        self.polygons = []
+        self._edges = []
+        self._boxes = []
+        self._bounds = []
+        self._areas = []
+        for rings in polygons:
+            coords = []
+            for ring in rings:
+                ring = np.array([c[:2] for c in ring], dtype=float)
+                if not len(ring):
+                    continue
+                if tuple(ring[0]) != tuple(ring[-1]):
+                    ring = np.vstack([ring, ring[:1]])
+                coords.append(ring)
+            if not coords:
+                continue
+            self.polygons.append(coords)
+
+            starts = np.concatenate([ring[:-1] for ring in coords])
+            ends = np.concatenate([ring[1:] for ring in coords])
+            edges = (starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1])
+            self._edges.append(edges)
+            self._boxes.append((np.minimum(edges[0], edges[2]),
+                                np.minimum(edges[1], edges[3]),
+                                np.maximum(edges[0], edges[2]),
+                                np.maximum(edges[1], edges[3])))
+            exterior = coords[0]
+            self._bounds.append((float(exterior[:, 0].min()),
+                                 float(exterior[:, 1].min()),
+                                 float(exterior[:, 0].max()),
+                                 float(exterior[:, 1].max())))
+            self._areas.append(
+                _ring_area(exterior[:, 0], exterior[:, 1]) -
+                sum([_ring_area(hole[:, 0], hole[:, 1])
+                     for hole in coords[1:]]))
+
+        self.is_empty = not self.polygons
+        if self.is_empty:
+            self.bounds = None
         else:
-            data_hash = hash(self.data)
+            self.bounds = (min([b[0] for b in self._bounds]),
+                           min([b[1] for b in self._bounds]),
+                           max([b[2] for b in self._bounds]),
+                           max([b[3] for b in self._bounds]))
 
-        return hash((self.x, self.y, data_hash))
+    @classmethod
+    def from_geojson(cls, geometry):
+        """
+        :param geometry: a GeoJSON Polygon or MultiPolygon, or a Feature
+        of one, as a mapping or an object with ``__geo_interface__``.
+        """
+        geometry = getattr(geometry, '__geo_interface__', geometry)
+        if geometry.get('type') == 'Feature':
+            geometry = geometry['geometry']
+        geom_type = geometry.get('type')
+        if geom_type == 'Polygon':
+            return cls([geometry['coordinates']], geom_type)
+        if geom_type == 'MultiPolygon':
+            return cls(geometry['coordinates'], geom_type)
+        raise ValueError('only Polygon and MultiPolygon have rings, not %r.'
+                         % (geom_type,))
 
-    def __eq__(self, othr):
-        return (self.x, self.y, self.data) == (othr.x, othr.y, othr.data)
+    @classmethod
+    def from_wkb(cls, data):
+        """Reads a Polygon or MultiPolygon from 2D WKB."""
+        if load_numpy() is None:
+            raise ImportError('numpy is required for ring geometries.')
+        offset = [0]
 
+        def read(fmt):
+            values = struct.unpack_from(fmt, data, offset[0])
+            offset[0] += struct.calcsize(fmt)
+            return values
 
-class QuadTree(Node):
-    def __init__(self, points):
-        # pure_points = [feature_to_point(featurize(point)) for point in points]
+        def read_polygon():
+            order = '<' if read('B')[0] == 1 else '>'
+            geom_type = read(order + 'I')[0]
+            if geom_type not in (3, 6):
+                raise ValueError('only Polygon and MultiPolygon WKB is '
+                                 'supported, not type %d.' % geom_type)
+            count = read(order + 'I')[0]
+            if geom_type == 6:
+                return 'MultiPolygon', [read_polygon()[1][0]
+                                        for _ in range(count)]
+            rings = []
+            for _ in range(count):
+                length = read(order + 'I')[0]
+                rings.append(np.array(read(order + '%dd' % (2 * length)))
+                             .reshape(-1, 2))
+            return 'Polygon', [rings]
 
-        # if a split involves 16 checks of containment, the optimal
-        # number of points is 16/ln(4)
-        super(QuadTree, self).__init__(
-            None, rect=self.find_bbox(points), max_points=11
-        )
-        for point in points:
-            self.add_point(point)
+        geom_type, polygons = read_polygon()
+        return cls(polygons, geom_type)
 
-    @staticmethod
-    def find_bbox(points):
-        x, y = get_coords(points[0])
-        minx = x
-        maxx = x
-        miny = y
-        maxy = y
+    @property
+    def wkb(self):
+        """The geometry as little-endian WKB, as shapely writes it."""
+        polygons = []
+        for rings in self.polygons:
+            polygons.append(struct.pack('<BII', 1, 3, len(rings)) + b''.join([
+                struct.pack('<I', len(ring)) + ring.astype('<f8').tobytes()
+                for ring in rings
+            ]))
+        if self.geom_type == 'Polygon' and len(polygons) == 1:
+            return polygons[0]
+        return struct.pack('<BII', 1, 6, len(polygons)) + b''.join(polygons)
 
-        for p in points:
-            x, y = get_coords(p)
-            if x < minx:
-                minx = x
-            if x > maxx:
-                maxx = x
-            if y < miny:
-                miny = y
-            if y > maxy:
-                maxy = y
+    @property
+    def __geo_interface__(self):
+        coordinates = [[[tuple(c) for c in ring.tolist()] for ring in rings]
+                       for rings in self.polygons]
+        if self.geom_type == 'Polygon' and len(coordinates) == 1:
+            return {'type': 'Polygon', 'coordinates': coordinates[0]}
+        return {'type': 'MultiPolygon', 'coordinates': coordinates}
 
-        return minx, miny, maxx, maxy
+    def _near(self, index, rectangle):
+        """The edges of polygon ``index`` whose boxes meet ``rectangle``."""
+        x0, y0, x1, y1 = rectangle
+        ex0, ey0, ex1, ey1 = self._boxes[index]
+        near = np.flatnonzero((ex0 <= x1) & (x0 <= ex1) &
+                              (ey0 <= y1) & (y0 <= ey1))
+        return zip(*[edge[near].tolist() for edge in self._edges[index]])
+
+    def _polygon_contains_xy(self, index, x, y):
+        """``_polygon_contains`` for one point, edge by edge."""
+        # edges left of the point neither hold it nor cross to its right
+        inside = False
+        for ax, ay, bx, by in self._near(index, (x, y, float('inf'), y)):
+            cross = (bx - ax) * (y - ay) - (by - ay) * (x - ax)
+            if cross == 0 and min(ax, bx) <= x:
+                return True
+            if (ay > y) != (by > y) and (cross > 0) == (by > ay):
+                inside = not inside
+        return inside
+
+    def _polygon_contains(self, index, xs, ys):
+        edges = self._edges[index]
+        if len(xs) * len(edges[0]) <= self.CHUNK:
+            return self._test_points(edges, xs[:, None], ys[:, None])
+
+        # many points: sorted by y, each edge tests the band of points
+        # between its ends
+        order = np.argsort(ys, kind='mergesort')
+        xs = xs[order]
+        ys = ys[order]
+        ex0, ey0, ex1, ey1 = self._boxes[index]
+        starts = np.searchsorted(ys, ey0, 'left').tolist()
+        ends = np.searchsorted(ys, ey1, 'right').tolist()
+        on_edge = np.zeros(len(xs), dtype=bool)
+        crossings = np.zeros(len(xs), dtype=np.int64)
+        for number, (start, end) in enumerate(zip(starts, ends)):
+            if start == end:
+                continue
+            x = xs[start:end]
+            y = ys[start:end]
+            ax, ay, bx, by = [edge[number] for edge in edges]
+            cross = (bx - ax) * (y - ay) - (by - ay) * (x - ax)
+            on_edge[start:end] |= ((cross == 0) & (ex0[number] <= x) &
+                                   (x <= ex1[number]))
+            crossings[start:end] += (((ay > y) != (by > y)) &
+                                     ((cross > 0) == (by > ay)))
+        inside = np.empty(len(xs), dtype=bool)
+        inside[order] = on_edge | (crossings % 2 == 1)
+        return inside
+
+    @staticmethod
+    def _test_points(edges, x, y):
+        ax, ay, bx, by = edges
+        cross = (bx - ax) * (y - ay) - (by - ay) * (x - ax)
+        on_edge = ((cross == 0) &
+                   (np.minimum(ax, bx) <= x) & (x <= np.maximum(ax, bx)) &
+                   (np.minimum(ay, by) <= y) & (y <= np.maximum(ay, by)))
+        # edges straddling the horizontal through the point, crossed to
+        # its right, counted over the exterior and the holes
+        crossings = ((ay > y) != (by > y)) & ((cross > 0) == (by > ay))
+        return on_edge.any(axis=1) | (crossings.sum(axis=1) % 2 == 1)
+
+    def contains_coordinates(self, xs, ys):
+        """
+        Whether each point is within the polygons, or on their boundary.
+
+        :return: A boolean numpy array.
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        inside = np.zeros(len(xs), dtype=bool)
+        for index, (x0, y0, x1, y1) in enumerate(self._bounds):
+            candidates = np.flatnonzero(
+                ~inside & (x0 <= xs) & (xs <= x1) & (y0 <= ys) & (ys <= y1))
+            if len(candidates) == 1:
+                inside[candidates] = self._polygon_contains_xy(
+                    index, float(xs[candidates[0]]), float(ys[candidates[0]]))
+            elif len(candidates):
+                inside[candidates] = self._polygon_contains(
+                    index, xs[candidates], ys[candidates])
+        return inside
+
+    def contains_xy(self, x, y):
+        """``contains_coordinates`` for one point."""
+        for index, (x0, y0, x1, y1) in enumerate(self._bounds):
+            if (x0 <= x <= x1 and y0 <= y <= y1 and
+                    self._polygon_contains_xy(index, x, y)):
+                return True
+        return False
+
+    def contains_rectangle(self, rectangle):
+        x0, y0, x1, y1 = rectangle
+        if not (x0 < x1 and y0 < y1):
+            # a flat rectangle is never reported as contained, its points
+            # are tested instead
+            return False
+
+        for index, (bx0, by0, bx1, by1) in enumerate(self._bounds):
+            if not (bx0 <= x0 and x1 <= bx1 and by0 <= y0 and y1 <= by1):
+                continue
+            if self._crosses_interior(index, rectangle):
+                continue
+            # no edge runs through the rectangle, it lies within the
+            # polygon if its centre does, else try the other polygons,
+            # e.g. an island in a hole of this one
+            if self._polygon_contains_xy(index, (x0 + x1) / 2,
+                                         (y0 + y1) / 2):
+                return True
+        return False
+
+    def _crosses_interior(self, index, rectangle):
+        """Whether an edge of polygon ``index`` runs through the interior."""
+        x0, y0, x1, y1 = rectangle
+        for segment in self._near(index, rectangle):
+            clipped = clip_segment(segment, rectangle)
+            if clipped is None:
+                continue
+            mx = (clipped[0] + clipped[2]) / 2
+            my = (clipped[1] + clipped[3]) / 2
+            if x0 < mx < x1 and y0 < my < y1:
+                return True
+        return False
+
+    def intersects_rectangle(self, rectangle):
+        x0, y0, x1, y1 = rectangle
+        for index, (bx0, by0, bx1, by1) in enumerate(self._bounds):
+            if x1 < bx0 or bx1 < x0 or y1 < by0 or by1 < y0:
+                continue
+            # an edge meets the rectangle, or else one is within the other
+            for segment in self._near(index, rectangle):
+                if clip_segment(segment, rectangle) is not None:
+                    return True
+            if self._polygon_contains_xy(index, x0, y0):
+                return True
+        return False
+
+    def intersection_area(self, rectangle):
+        """The area of the polygons within ``rectangle``."""
+        x0, y0, x1, y1 = rectangle
+        area = 0.0
+        for index, (bx0, by0, bx1, by1) in enumerate(self._bounds):
+            if x1 <= bx0 or bx1 <= x0 or y1 <= by0 or by1 <= y0:
+                continue
+            if x0 <= bx0 and bx1 <= x1 and y0 <= by0 and by1 <= y1:
+                area += self._areas[index]
+                continue
+            rings = [_ring_area(*_clip_ring(ring[:, 0], ring[:, 1], rectangle))
+                     for ring in self.polygons[index]]
+            area += rings[0] - sum(rings[1:])
+        return area
+
+
+class Feature(object):
+    """
+    A wrapper around shapely geometries, or polygon rings.
+
+    The geometry is prepared once and its bounds are cached, since every
+    query tests the same feature against many nodes.
+
+    GeoJSON Polygons and MultiPolygons, given as mappings or objects with
+    ``__geo_interface__``, become RingGeometry objects and are tested
+    without shapely. Other GeoJSON geometries are read with shapely.
+    """
+    def __init__(self, geometry):
+        if not (is_shapely_geometry(geometry) or
+                isinstance(geometry, RingGeometry)):
+            mapping = getattr(geometry, '__geo_interface__', geometry)
+            if not isinstance(mapping, dict):
+                raise Exception
+            if mapping.get('type') == 'Feature':
+                mapping = mapping['geometry']
+            if mapping.get('type') in ('Polygon', 'MultiPolygon'):
+                geometry = RingGeometry.from_geojson(mapping)
+            else:
+                load_shapely()
+                geometry = shapelyShape(mapping)
+
+        self.geometry = geometry
+
+    @property
+    def geometry(self):
+        return self._geometry
+
+    @geometry.setter
+    def geometry(self, geometry):
+        self._geometry = geometry
+        self._wkb = None
+        self.is_empty = geometry.is_empty
+        if isinstance(geometry, RingGeometry):
+            self._rings = geometry
+            self._prepared = None
+            self.bounds = geometry.bounds
+            return
+
+        load_shapely()
+        self._rings = None
+        if self.is_empty:
+            self.bounds = None
+            self._prepared = None
+        else:
+            self.bounds = tuple(geometry.bounds)
+            if prepare_geometry is not None:
+                prepare_geometry(geometry)
+            self._prepared = prep(geometry)
+
+    @property
+    def wkb(self):
+        """The geometry as WKB, computed once."""
+        if self._wkb is None:
+            self._wkb = self._geometry.wkb
+        return self._wkb
+
+    def copy(self):
+        """
+        A Feature of the same geometry, prepared anew: prepared shapely
+        geometries cannot be shared between threads.
+        """
+        if self._rings is not None:
+            # ring tests only read the coordinates
+            return Feature(self._rings)
+        return Feature(shapelyWkb.loads(self.wkb))
+
+    def contains_point(self, point):
+        if self.is_empty:
+            return False
+
+        x, y = get_coords(point)
+        x0, y0, x1, y1 = self.bounds
+        if not (x0 <= x <= x1 and y0 <= y <= y1):
+            return False
+
+        if self._rings is not None:
+            return self._rings.contains_xy(x, y)
+        if intersects_xy is not None:
+            return bool(intersects_xy(self._geometry, x, y))
+        return self._prepared.intersects(shapelyPoint(x, y))
+
+    def contains_points(self, points):
+        """
+        Batch version of ``contains_point``.
+
+        :return: A list of booleans, one per point.
+        """
+        if self.is_empty or not len(points):
+            return [False] * len(points)
+
+        if ((self._rings is None and intersects_xy is None and
+                vectorized is None) or load_numpy() is None):
+            return [self.contains_point(point) for point in points]
+
+        coords = np.array([get_coords(point) for point in points],
+                          dtype=float)
+        return self.contains_coordinates(coords[:, 0], coords[:, 1]).tolist()
+
+    def contains_coordinates(self, xs, ys):
+        """
+        Vectorized ``contains_point`` for numpy coordinate arrays.
+
+        :return: A boolean numpy array.
+        """
+        load_numpy()
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if self.is_empty:
+            return np.zeros(len(xs), dtype=bool)
+
+        x0, y0, x1, y1 = self.bounds
+        inside = (x0 <= xs) & (xs <= x1) & (y0 <= ys) & (ys <= y1)
+        candidates = np.flatnonzero(inside)
+        if not len(candidates):
+            return inside
+
+        xs = xs[candidates]
+        ys = ys[candidates]
+        if self._rings is not None:
+            inside[candidates] = self._rings.contains_coordinates(xs, ys)
+        elif intersects_xy is not None:
+            inside[candidates] = intersects_xy(self._geometry, xs, ys)
+        else:
+            # shapely 1.x can only batch the (fast) interior test, points
+            # on the boundary are found among the rest one by one
+            if vectorized is not None:
+                interior = vectorized.contains(self._prepared, xs, ys)
+            else:
+                interior = np.zeros(len(xs), dtype=bool)
+            rest = np.flatnonzero(~interior)
+            interior[rest] = [
+                self._prepared.intersects(shapelyPoint(x, y))
+                for x, y in zip(xs[rest].tolist(), ys[rest].tolist())
+            ]
+            inside[candidates] = interior
+        return inside
+
+    def contains_rectangle(self, rectangle):
+        if self.is_empty:
+            return False
+
+        x0, y0, x1, y1 = rectangle
+        bx0, by0, bx1, by1 = self.bounds
+        if not (bx0 <= x0 and x1 <= bx1 and by0 <= y0 and y1 <= by1):
+            # the rectangle sticks out of the bounding box
+            return False
+
+        if self._rings is not None:
+            return self._rings.contains_rectangle(rectangle)
+        return self._prepared.contains(rectangle_polygon(rectangle))
+
+    def intersects_rectangle(self, rectangle):
+        if self.is_empty:
+            return False
+
+        x0, y0, x1, y1 = rectangle
+        bx0, by0, bx1, by1 = self.bounds
+        if x1 < bx0 or bx1 < x0 or y1 < by0 or by1 < y0:
+            # disjoint from the bounding box
+            return False
+        if x0 <= bx0 and bx1 <= x1 and y0 <= by0 and by1 <= y1:
+            # the whole geometry lies within the rectangle
+            return True
+
+        if self._rings is not None:
+            return self._rings.intersects_rectangle(rectangle)
+        return self._prepared.intersects(rectangle_polygon(rectangle))
+
+    def covered_fraction(self, rectangle):
+        """The fraction of the area of ``rectangle`` within the geometry."""
+        x0, y0, x1, y1 = rectangle
+        area = (x1 - x0) * (y1 - y0)
+        if not area:
+            # a flat rectangle has no area to compare, call it half covered
+            return 0.5
+        if self._rings is not None:
+            covered = self._rings.intersection_area(rectangle)
+        else:
+            covered = self._geometry.intersection(
+                rectangle_polygon(rectangle)).area
+        return min(covered / area, 1.0)
+
+
+class QueryStats(object):
+    """
+    Counters of what overlap queries did, filled in by the queries that
+    are given a ``stats`` argument, and summed over all of them.
+
+    ``on_query``, if given, is called with the stats object after each
+    query, e.g. to feed the numbers into a metrics system.
+    """
+    FIELDS = ('queries', 'cache_hits', 'nodes_visited', 'contains_hits',
+              'intersects_calls', 'points_tested', 'geos_time')
+
+    def __init__(self, on_query=None):
+        self.on_query = on_query
+        self.reset()
+
+    def reset(self):
+        self.queries = 0
+        self.cache_hits = 0
+        self.nodes_visited = 0
+        self.contains_hits = 0
+        self.intersects_calls = 0
+        self.points_tested = 0
+        self.geos_time = 0.0
+
+    def as_dict(self):
+        return dict([(field, getattr(self, field)) for field in self.FIELDS])
+
+    def _finish(self):
+        self.queries += 1
+        if self.on_query is not None:
+            self.on_query(self)
+
+    def __repr__(self):
+        return 'QueryStats(%s)' % ', '.join([
+            '%s=%r' % (field, getattr(self, field)) for field in self.FIELDS
+        ])
+
+
+# node versions come from one counter, no two states of any nodes share
+# one, so trees can share a QueryCache
+_versions = itertools.count(1)
+
+
+class QueryCache(object):
+    """
+    A bounded LRU cache of overlap query results, keyed on the query, the
+    queried node and the WKB of the feature.
+
+    Set it as the ``cache`` of a tree to use it. Results are stored with
+    the ``version`` of the queried node, which every change of the points
+    under that node renews, so results of an older tree are not returned.
+    Versions are unique across trees, which may share a cache, and the
+    cache may be used from several threads.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, version):
+        """
+        :return: The result stored for ``key`` at ``version``, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            # most recently used last
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry[1]
+
+    def put(self, key, version, result):
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = (version, result)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __repr__(self):
+        return 'QueryCache(maxsize=%r, size=%r, hits=%r, misses=%r, ' \
+            'evictions=%r)' % (self.maxsize, len(self.entries), self.hits,
+                               self.misses, self.evictions)
+
+
+class _InstrumentedFeature(object):
+    """
+    Wraps a Feature to count and time the tests queries make on it, so
+    queries without stats run the plain Feature methods.
+    """
+    def __init__(self, feature, stats):
+        self.feature = feature
+        self.stats = stats
+
+    def contains_rectangle(self, rectangle):
+        self.stats.nodes_visited += 1
+        start = timeit.default_timer()
+        contained = self.feature.contains_rectangle(rectangle)
+        self.stats.geos_time += timeit.default_timer() - start
+        if contained:
+            self.stats.contains_hits += 1
+        return contained
+
+    def intersects_rectangle(self, rectangle):
+        self.stats.intersects_calls += 1
+        start = timeit.default_timer()
+        intersects = self.feature.intersects_rectangle(rectangle)
+        self.stats.geos_time += timeit.default_timer() - start
+        return intersects
+
+    def contains_points(self, points):
+        self.stats.points_tested += len(points)
+        start = timeit.default_timer()
+        inside = self.feature.contains_points(points)
+        self.stats.geos_time += timeit.default_timer() - start
+        return inside
+
+
+def count_in_nodes(feature, nodes):
+    """
+    Counts the points within ``feature`` from the ``(node, contained)``
+    pairs of ``Node.overlapping_nodes``.
+    """
+    count = 0
+    boundary = []
+    for node, contained in nodes:
+        if contained:
+            # all points are within
+            count += node.number_of_points
+        else:
+            boundary.append(node)
+
+    # points of partially covered leaves are tested in one batch
+    candidates = [point for node in boundary for point in node._points]
+    inside = feature.contains_points(candidates)
+    weights = [frequency for node in boundary
+               for frequency in node._points.values()]
+    return count + sum([
+        weight for weight, flag in zip(weights, inside) if flag
+    ])
+
+
+def points_in_nodes(feature, nodes):
+    """
+    Lists the points within ``feature`` from the ``(node, contained)``
+    pairs of ``Node.overlapping_nodes``.
+    """
+    boundary = [node for node, contained in nodes if not contained]
+    candidates = [point for node in boundary for point in node._points]
+    inside = dict(zip(candidates, feature.contains_points(candidates)))
+
+    output = []
+    for node, contained in nodes:
+        if contained:
+            # all points are within
+            output.extend(node.get_all_points())
+        else:
+            output.extend([
+                point for point in node.features if inside[point]
+            ])
+    return output
+
+
+class Node(object):
+    # In the case of a root node "parent" will be None. The
+    # "rect" lists the minx, miny, maxx, maxy of the rectangle
+    # represented by the node.
+    ROOT = 0
+    BRANCH = 1
+    LEAF = 2
+
+    # an optional QueryCache of overlap query results
+    cache = None
+
+    def __init__(self, parent, rect, max_points=2, max_depth=None):
+        self.parent = parent
+        self.children = []
+        self._points = {}
+        self.features = []
+        self.number_of_points = 0
+        self.max_points = max_points
+        # leaves this deep below the root are not split, they overflow
+        self.max_depth = max_depth
+
+        # the payload fields aggregated by the tree, a list shared by all
+        # of its nodes, see register_aggregate
+        if parent is None:
+            self.aggregate_fields = []
+        else:
+            self.aggregate_fields = parent.aggregate_fields
+        self.aggregates = dict(
+            (field, Aggregate()) for field in self.aggregate_fields)
+
+        self.rectangle = tuple([float(item) for item in rect])
+        self.type = Node.LEAF
+        # renewed whenever the points or the shape under the node change
+        self.version = next(_versions)
+        # bumped on the root when nodes are merged away or the root grows,
+        # which a QueryPlan cannot follow incrementally
+        self.generation = 0
+
+    @property
+    def points(self):
+        points = []
+        for coordinate, frequency in self._points.items():
+            points.extend([coordinate] * frequency)
+        return points
+
+    def add_point(self, point):
+        # point_feature = featurize(point)
+        # point = feature_to_point(point_feature)
+        if not self.point_coords_in_bbox(point):
+            # point not in box, cannot place
+            raise ValueError('%r is outside of the node.' % (point,))
+        self._touch()
+        self._add_point(point, self.get_depth())
+
+    def _touch(self):
+        # renews the versions of this node and of the nodes above it
+        node = self
+        while node is not None:
+            node.version = next(_versions)
+            node = node.parent
+
+    def _add_point(self, point, depth):
+        # ``depth`` is the depth of this node, the point is in its box
+        node = self
+        while node.type != Node.LEAF:
+            node.version = next(_versions)
+            node.number_of_points += 1
+            if node.aggregate_fields:
+                node._aggregate([point])
+            # find where the point goes
+            for child in node.children:
+                if child.point_coords_in_bbox(point):
+                    node = child
+                    depth += 1
+                    break
+            else:
+                raise ValueError('%r is outside of the node.' % (point,))
+
+        if point in node._points:
+            node._points[point] += 1
+        else:
+            node._points[point] = 1
+        node.features.append(point)
+        node.number_of_points += 1
+        node.version = next(_versions)
+        if node.aggregate_fields:
+            node._aggregate([point])
+        if node._crowded() and node._can_split(depth):
+            # the box is crowded, break it up in 4
+            node._subdivide(depth)
+
+    def _crowded(self):
+        # more than max_points distinct locations, as bulk_partition counts
+        return (len(self._points) > self.max_points and
+                count_locations(self._points, self.max_points)
+                > self.max_points)
+
+    def _can_split(self, depth):
+        return self.max_depth is None or depth < self.max_depth
+
+    def add_points(self, points):
+        """
+        Adds a batch of points.
+
+        The points are sent down the tree together, each branch splitting
+        the batch among its children, instead of routing every point from
+        this node on its own.
+
+        :param points: any iterable of points, read once.
+        """
+        points = list(points)
+        for point in points:
+            if not self.point_coords_in_bbox(point):
+                raise ValueError('%r is outside of the node.' % (point,))
+
+        self._touch()
+        stack = [(self, points, self.get_depth())]
+        while stack:
+            node, points, depth = stack.pop()
+            if node.type == Node.LEAF:
+                for point in points:
+                    node._add_point(point, depth)
+                continue
+
+            batches = [[] for child in node.children]
+            for point in points:
+                # find where the point goes
+                for batch, child in zip(batches, node.children):
+                    if child.point_coords_in_bbox(point):
+                        batch.append(point)
+                        break
+            node.version = next(_versions)
+            for batch, child in zip(batches, node.children):
+                if batch:
+                    node.number_of_points += len(batch)
+                    if node.aggregate_fields:
+                        node._aggregate(batch)
+                    stack.append((child, batch, depth + 1))
+
+    def register_aggregate(self, field):
+        """
+        Starts keeping an Aggregate (count, sum, min, max and mean) of the
+        numeric payload ``field`` in every node of the tree. Points are
+        Point objects whose ``data`` is a dict; points without a value
+        for the field are left out.
+
+        The aggregates of existing points are computed in one pass, after
+        that they are kept up to date as points are added and removed.
+        """
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        if field in root.aggregate_fields:
+            return
+
+        root.aggregate_fields.append(field)
+        nodes = [root]
+        for node in nodes:
+            nodes.extend(node.children)
+        for node in reversed(nodes):
+            # children come after their parent, so they are done first
+            node._reaggregate(field)
+
+    def _aggregate(self, points):
+        for field in self.aggregate_fields:
+            aggregate = self.aggregates[field]
+            for point in points:
+                aggregate.add(payload_value(point, field))
+
+    def _reaggregate(self, field):
+        aggregate = Aggregate()
+        if self.type == Node.LEAF:
+            for point in self.features:
+                aggregate.add(payload_value(point, field))
+        else:
+            for child in self.children:
+                aggregate.update(child.aggregates[field])
+        self.aggregates[field] = aggregate
+
+    def aggregate_overlapping(self, feature, field):
+        """
+        Aggregates the payload ``field`` of the points within ``feature``.
+
+        Nodes that ``feature`` contains contribute their stored aggregate,
+        so this costs about as much as ``count_overlapping_points``.
+
+        :return: An Aggregate.
+        """
+        if field not in self.aggregate_fields:
+            raise KeyError('%r is not an aggregated field.' % (field,))
+
+        nodes = self.overlapping_nodes(feature)
+        boundary = [node for node, contained in nodes if not contained]
+        candidates = [point for node in boundary for point in node._points]
+        inside = dict(zip(candidates, feature.contains_points(candidates)))
+
+        output = Aggregate()
+        for node, contained in nodes:
+            if contained:
+                output.update(node.aggregates[field])
+            else:
+                for point in node.features:
+                    if inside[point]:
+                        output.add(payload_value(point, field))
+        return output
+
+    def count_overlapping_points(self, feature, stats=None):
+        """
+        :param feature: a Feature.
+        :param stats: an optional QueryStats to record the work done in.
+        """
+        if self.cache is not None:
+            # the versions tell trees apart, the id keeps their entries
+            # from replacing each other
+            key = ('count', id(self), feature.wkb)
+            count = self.cache.get(key, self.version)
+            if count is not None:
+                if stats is not None:
+                    stats.cache_hits += 1
+                    stats._finish()
+                return count
+
+        if stats is None:
+            count = count_in_nodes(feature, self.overlapping_nodes(feature))
+        else:
+            instrumented = _InstrumentedFeature(feature, stats)
+            count = count_in_nodes(instrumented,
+                                   self.overlapping_nodes(instrumented))
+            stats._finish()
+
+        if self.cache is not None:
+            self.cache.put(key, self.version, count)
+        return count
+
+    def estimate_overlapping_points(self, feature, depth=None, budget=None):
+        """
+        Estimates ``count_overlapping_points`` with a bounded amount of
+        work.
+
+        Nodes are visited level by level. A node partially covered by
+        ``feature`` is only descended into (or, for a leaf, has its points
+        tested) while it is at most ``depth`` levels below this node and
+        fewer than ``budget`` nodes have been descended into. The points
+        of the other partially covered nodes are estimated from the
+        fraction of their area within the feature.
+
+        :param depth: deepest level to descend to, unlimited by default.
+        :param budget: most nodes to descend into, unlimited by default.
+        :return: An Estimate, with the count of the points in contained
+        nodes and tested leaves as lower bound, and that plus all points
+        of the estimated nodes as upper bound.
+        """
+        estimate = Estimate()
+        expanded = 0
+        queue = collections.deque([(self, 0)])
+        while queue:
+            node, level = queue.popleft()
+            if not node.number_of_points:
+                continue
+            if feature.contains_rectangle(node.rectangle):
+                estimate.add_exact(node.number_of_points)
+            elif feature.intersects_rectangle(node.rectangle):
+                if ((depth is not None and level > depth)
+                        or (budget is not None and expanded >= budget)):
+                    estimate.add_partial(node.number_of_points,
+                                         feature.covered_fraction(
+                                             node.rectangle))
+                    continue
+
+                expanded += 1
+                if node.type == Node.LEAF:
+                    estimate.add_exact(
+                        count_in_nodes(feature, [(node, False)]))
+                else:
+                    queue.extend([
+                        (child, level + 1) for child in node.children])
+        return estimate
+
+    def get_overlapping_points(self, feature, stats=None):
+        """
+        :param feature: a Feature.
+        :param stats: an optional QueryStats to record the work done in.
+        """
+        if self.cache is not None:
+            key = ('points', id(self), feature.wkb)
+            points = self.cache.get(key, self.version)
+            if points is not None:
+                if stats is not None:
+                    stats.cache_hits += 1
+                    stats._finish()
+                return list(points)
+
+        if stats is None:
+            points = points_in_nodes(feature, self.overlapping_nodes(feature))
+        else:
+            instrumented = _InstrumentedFeature(feature, stats)
+            points = points_in_nodes(instrumented,
+                                     self.overlapping_nodes(instrumented))
+            stats._finish()
+
+        if self.cache is not None:
+            # a tuple, so callers cannot change the cached result
+            self.cache.put(key, self.version, tuple(points))
+        return points
+
+    def iter_overlapping_points(self, feature):
+        """
+        Lazy version of ``get_overlapping_points``: yields the same points
+        in the same order while walking the tree, without building lists.
+        The points of a partially covered leaf are tested together when
+        the walk reaches it.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if not node.number_of_points:
+                continue
+            if feature.contains_rectangle(node.rectangle):
+                # all points are within
+                for point in node.iter_all_points():
+                    yield point
+            elif feature.intersects_rectangle(node.rectangle):
+                if node.type == Node.LEAF:
+                    candidates = list(node._points)
+                    inside = dict(zip(
+                        candidates, feature.contains_points(candidates)))
+                    for point in node.features:
+                        if inside[point]:
+                            yield point
+                else:
+                    # reversed, so children are visited in order
+                    stack.extend(reversed(node.children))
+
+    def any_overlapping(self, feature):
+        """
+        Tells whether any point lies within ``feature``, stopping at the
+        first one found.
+        """
+        for point in self.iter_overlapping_points(feature):
+            return True
+        return False
+
+    def count_overlapping_points_batch(self, features):
+        """
+        Counts the points within each of ``features``.
+
+        Equivalent to calling ``count_overlapping_points`` for every
+        feature, but the tree is traversed only once.
+
+        :return: A list of counts, one per feature.
+        """
+        return [
+            count_in_nodes(feature, nodes) for feature, nodes in
+            zip(features, self.overlapping_nodes_batch(features))
+        ]
+
+    def get_overlapping_points_batch(self, features):
+        """
+        Batch version of ``get_overlapping_points``, see
+        ``count_overlapping_points_batch``.
+
+        :return: A list of point lists, one per feature.
+        """
+        return [
+            points_in_nodes(feature, nodes) for feature, nodes in
+            zip(features, self.overlapping_nodes_batch(features))
+        ]
+
+    def overlapping_nodes(self, feature):
+        """
+        Finds the nodes needed to answer an overlap query, in tree order.
+
+        :return: A list of ``(node, contained)`` pairs: the largest nodes
+        whose rectangle lies within ``feature`` (``contained`` is True),
+        and the leaves it only partially covers, whose points have to be
+        tested one by one.
+        """
+        output = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if feature.contains_rectangle(node.rectangle):
+                output.append((node, True))
+            elif feature.intersects_rectangle(node.rectangle):
+                if node.type == Node.LEAF:
+                    output.append((node, False))
+                else:
+                    # reversed, so children are visited in order
+                    stack.extend(reversed(node.children))
+        return output
+
+    def overlapping_nodes_batch(self, features):
+        """
+        Runs ``overlapping_nodes`` for many features in a single traversal.
+
+        Every node only tests the features that partially cover its
+        parent, features that contain the node are resolved there.
+
+        :return: A list with the ``(node, contained)`` pairs of each feature.
+        """
+        output = [[] for feature in features]
+        stack = [(self, range(len(features)))]
+        while stack:
+            node, active = stack.pop()
+            if not node.number_of_points:
+                # nothing to count, whatever the features look like
+                continue
+
+            partial = []
+            for i in active:
+                feature = features[i]
+                if feature.contains_rectangle(node.rectangle):
+                    output[i].append((node, True))
+                elif feature.intersects_rectangle(node.rectangle):
+                    if node.type == Node.LEAF:
+                        output[i].append((node, False))
+                    else:
+                        partial.append(i)
+
+            if partial:
+                stack.extend([
+                    (child, partial) for child in reversed(node.children)
+                ])
+        return output
+
+    def get_all_points(self):
+        if self.type == Node.LEAF:
+            return self.features
+
+        output = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.type == Node.LEAF:
+                output.extend(node.features)
+            else:
+                stack.extend(reversed(node.children))
+        return output
+
+    def iter_all_points(self):
+        """
+        Lazy version of ``get_all_points``, yields the points in the same
+        order.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.type == Node.LEAF:
+                for point in node.features:
+                    yield point
+            else:
+                stack.extend(reversed(node.children))
+
+    def _copy(self, parent):
+        # a copy of the node under ``parent`` sharing its children, for
+        # copy-on-write updates, see ConcurrentQuadTree
+        node = self.__class__.__new__(self.__class__)
+        node.__dict__.update(self.__dict__)
+        node.parent = parent
+        node.children = list(self.children)
+        node._points = dict(self._points)
+        node.features = list(self.features)
+        node.aggregates = dict(
+            (field, aggregate.copy())
+            for field, aggregate in self.aggregates.items())
+        return node
+
+    def get_depth(self):
+        """The number of nodes above this one."""
+        depth = 0
+        node = self.parent
+        while node is not None:
+            depth += 1
+            node = node.parent
+        return depth
+
+    def subdivide(self):
+        """
+        Recursively subdivides a rectangle. Division occurs
+        ONLY if the rectangle spans a "feature of interest".
+        :return:
+        """
+        if not self.type == Node.LEAF:
+            # only leafs can be subdivided
+            raise Exception
+
+        self._touch()
+        self._subdivide(self.get_depth())
+
+    def _subdivide(self, depth):
+        # children still crowded are split in turn, down to max_depth
+        stack = [(self, depth)]
+        while stack:
+            node, depth = stack.pop()
+            features = node.features
+            node._points = {}
+            node.features = []
+            node.type = Node.BRANCH
+            node.version = next(_versions)
+
+            x0, y0, x1, y1 = node.rectangle
+            half_width = (x1 - x0) / 2
+            half_height = (y1 - y0) / 2
+            rects = quadrants(node.rectangle, x0 + half_width,
+                              y0 + half_height)
+            for rect in rects:
+                node.children.append(
+                    Node(node, rect, node.max_points, node.max_depth))
+
+            batches = [[] for child in node.children]
+            for point in features:
+                for batch, child in zip(batches, node.children):
+                    if child.point_coords_in_bbox(point):
+                        batch.append(point)
+                        break
+            for batch, child in zip(batches, node.children):
+                child.features = batch
+                child._points = frequencies(batch)
+                child.number_of_points = len(batch)
+                if child.aggregate_fields:
+                    child._aggregate(batch)
+                if child._crowded() and child._can_split(depth + 1):
+                    stack.append((child, depth + 1))
+
+    def merge(self):
+        """
+        Collapses a branch whose children are all leaves back into a
+        single leaf, the inverse of ``subdivide``.
+        """
+        if self.type == Node.LEAF or any([
+                child.type != Node.LEAF for child in self.children]):
+            # only parents of leafs can be merged
+            raise Exception
+
+        features = []
+        for child in self.children:
+            features.extend(child.features)
+            child.parent = None
+
+        self.children = []
+        self.type = Node.LEAF
+        self.features = features
+        self._points = frequencies(features)
+        self._touch()
+
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        root.generation += 1
+
+    def remove_point(self, point):
+        """
+        Removes one occurrence of ``point`` from the tree under this node.
+
+        Branches left with no more than ``max_points`` distinct locations are
+        merged back into leaves, so the tree keeps the shape it would have
+        if the point had never been added.
+
+        :raises ValueError: if the point is not in the tree.
+        """
+        node = self
+        path = [node]
+        while node.type != Node.LEAF:
+            # same route as add_point: the first child containing the point
+            for child in node.children:
+                if child.point_coords_in_bbox(point):
+                    node = child
+                    path.append(node)
+                    break
+            else:
+                break
+
+        if not node.point_coords_in_bbox(point) or point not in node._points:
+            raise ValueError('%r is not in the tree.' % (point,))
+
+        node._points[point] -= 1
+        if not node._points[point]:
+            del node._points[point]
+        node.features.remove(point)
+        self._touch()
+        for parent in path:
+            parent.number_of_points -= 1
+            parent.version = next(_versions)
+        for field in self.aggregate_fields:
+            # minimum and maximum cannot be taken back, recompute them
+            for parent in reversed(path):
+                parent._reaggregate(field)
+
+        for parent in reversed(path[:-1]):
+            if any([child.type != Node.LEAF for child in parent.children]):
+                return
+            # children hold disjoint locations
+            distinct = sum([
+                count_locations(child._points, parent.max_points)
+                for child in parent.children])
+            if distinct > parent.max_points:
+                return
+            parent.merge()
+
+    def move_point(self, point, new_point):
+        """
+        Moves one occurrence of ``point`` to ``new_point``, which may carry
+        a different payload.
+
+        :raises ValueError: if ``point`` is not in the tree, or
+        ``new_point`` is outside of this node.
+        """
+        if not self.point_coords_in_bbox(new_point):
+            raise ValueError('%r is outside of the node.' % (new_point,))
+
+        self.remove_point(point)
+        self.add_point(new_point)
+
+    def point_coords_in_bbox(self, point):
+        """
+        Test if the point's _coordinates_ fall within the
+        Node's bounding box.
+
+        NOT whether the Point object exists within the node or not.
+
+        :param point:
+        :type point: Point class or tuple of (x, y) coordinates.
+        :return: Returns True if the coordinates lie within the
+        Node's bounding box.
+        :rtype bool:
+        """
+        x, y = get_coords(point)
+
+        x0, y0, x1, y1 = self.rectangle
+        if x0 <= x <= x1 and y0 <= y <= y1:
+            return True
+        else:
+            return False
+
+    def walk(self):
+        """An iterator over the points of in the Node"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.type == Node.LEAF:
+                for point in node.points:
+                    yield point
+            else:
+                stack.extend(reversed(node.children))
+
+    def count_in_rectangle(self, bbox):
+        """
+        Counts the points within the axis-aligned rectangle ``bbox``.
+
+        Gives the same result as ``count_overlapping_points`` with a
+        Feature of the rectangle, but only compares floats.
+
+        :param bbox: (minx, miny, maxx, maxy), the boundary is included.
+        """
+        x0, y0, x1, y1 = bbox
+        count = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nx0, ny0, nx1, ny1 = node.rectangle
+            if nx1 < x0 or x1 < nx0 or ny1 < y0 or y1 < ny0:
+                continue
+            elif x0 <= nx0 and nx1 <= x1 and y0 <= ny0 and ny1 <= y1:
+                # all points are within
+                count += node.number_of_points
+            elif node.type == Node.LEAF:
+                count += sum([
+                    frequency for point, frequency in node._points.items()
+                    if point_in_rectangle(point, bbox)
+                ])
+            else:
+                stack.extend(node.children)
+        return count
+
+    def density_grid(self, bbox, nx, ny):
+        """
+        Counts the points in each cell of a grid of ``nx`` by ``ny`` equal
+        cells over ``bbox``.
+
+        :return: An (ny, nx) numpy array, row 0 at the bottom of
+        ``bbox``, see ``density``.
+        """
+        load_numpy()
+        x0, y0, x1, y1 = bbox
+        return self.density(np.linspace(x0, x1, nx + 1),
+                            np.linspace(y0, y1, ny + 1))
+
+    def density_tile(self, z, x, y, size=256):
+        """
+        Counts the points of longitude, latitude coordinates in each pixel
+        of the Web Mercator tile ``z/x/y``, see ``tile_edges``.
+
+        :return: A (size, size) numpy array, row 0 at the top (north) of
+        the tile, as images are laid out.
+        """
+        lons, lats = tile_edges(z, x, y, size)
+        return self.density(lons, lats)[::-1]
+
+    def density(self, x_edges, y_edges):
+        """
+        Counts the points in each cell of the grid with the given cell
+        edges, in one traversal.
+
+        A node that lies within a single cell adds its number of points to
+        that cell without being descended into, only nodes straddling cell
+        edges are. Points outside of the grid are not counted, and a point
+        lying exactly on the edge between two cells is counted in the upper
+        one, except on the last edge, as ``bin_coordinates`` does.
+
+        Nodes are classified a whole level at a time with array operations,
+        but the points of the leaves straddling cell edges are read from
+        their dicts, which bounds the speed for grids finer than the
+        leaves: ``compact().density`` is several times faster for repeated
+        grids of large trees.
+
+        :param x_edges: increasing x coordinates of the cell edges.
+        :param y_edges: increasing y coordinates of the cell edges.
+        :return: A (len(y_edges) - 1, len(x_edges) - 1) numpy array.
+        """
+        load_numpy()
+        x_edges = np.asarray(x_edges, dtype=float)
+        y_edges = np.asarray(y_edges, dtype=float)
+        nx = len(x_edges) - 1
+        ny = len(y_edges) - 1
+        grid = np.zeros((ny, nx), dtype=np.int64)
+        x0, x1 = x_edges[0], x_edges[-1]
+        y0, y1 = y_edges[0], y_edges[-1]
+
+        # the cells and counts of nodes within one cell, and the leaves
+        # straddling cell edges, binned at the end
+        cells = []
+        counts_in_cells = []
+        straddling = []
+        level = [self]
+        while level:
+            rects = np.array([node.rectangle for node in level], dtype=float)
+            counts = np.array([node.number_of_points for node in level],
+                              dtype=np.int64)
+            nx0, ny0, nx1, ny1 = rects.T
+            overlapping = ((counts > 0) & ~((nx1 < x0) | (x1 < nx0) |
+                                            (ny1 < y0) | (y1 < ny0)))
+
+            columns = cell_index(x_edges, nx0)
+            rows = cell_index(y_edges, ny0)
+            within = ((x0 <= nx0) & (nx1 <= x1) & (y0 <= ny0) & (ny1 <= y1))
+            # points on an inner edge belong to the upper cell, as in
+            # bin_coordinates
+            single = (overlapping & within
+                      & ((nx1 < x_edges[columns + 1]) | (columns == nx - 1))
+                      & ((ny1 < y_edges[rows + 1]) | (rows == ny - 1)))
+            # all points of these nodes are in one cell
+            cells.append(rows[single] * nx + columns[single])
+            counts_in_cells.append(counts[single])
+
+            children = []
+            for index in np.flatnonzero(overlapping & ~single).tolist():
+                node = level[index]
+                if node.type == Node.LEAF:
+                    straddling.append(node)
+                else:
+                    children.extend(node.children)
+            level = children
+
+        grid.ravel()[:] += np.bincount(
+            np.concatenate(cells), np.concatenate(counts_in_cells),
+            minlength=nx * ny).astype(np.int64)
+        if straddling:
+            points = [node._points for node in straddling]
+            weights = None
+            distinct = sum([len(item) for item in points])
+            if (sum([node.number_of_points for node in straddling]) !=
+                    distinct):
+                # some points are stacked on one location
+                weights = np.fromiter(itertools.chain.from_iterable(
+                    [item.values() for item in points]), dtype=np.int64)
+            try:
+                coords = np.fromiter(itertools.chain.from_iterable(
+                    itertools.chain.from_iterable(points)), dtype=float)
+            except (TypeError, ValueError):  # Point objects
+                coords = None
+            if coords is not None and len(coords) == 2 * distinct:
+                coords = coords.reshape(-1, 2)
+            else:
+                # Point objects, or tuples with more than (x, y)
+                coords = np.array([
+                    get_coords(point) for item in points for point in item
+                ], dtype=float).reshape(-1, 2)
+            bin_coordinates(grid, x_edges, y_edges, coords[:, 0],
+                            coords[:, 1], weights)
+        return grid
+
+    def query_rectangle(self, bbox):
+        """
+        Lists the points within the axis-aligned rectangle ``bbox``, see
+        ``count_in_rectangle``.
+        """
+        x0, y0, x1, y1 = bbox
+        output = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nx0, ny0, nx1, ny1 = node.rectangle
+            if nx1 < x0 or x1 < nx0 or ny1 < y0 or y1 < ny0:
+                continue
+            elif x0 <= nx0 and nx1 <= x1 and y0 <= ny0 and ny1 <= y1:
+                # all points are within
+                output.extend(node.get_all_points())
+            elif node.type == Node.LEAF:
+                output.extend([
+                    point for point in node.features
+                    if point_in_rectangle(point, bbox)
+                ])
+            else:
+                # reversed, so children are visited in order
+                stack.extend(reversed(node.children))
+        return output
+
+    def nearest_points(self, point, k=1):
+        """
+        Finds the ``k`` points closest to ``point``.
+
+        Best-first search: nodes and points are taken from a priority queue
+        ordered by their distance to ``point``, where the distance of a
+        node is that of the closest point of its rectangle. Points at equal
+        distance are returned in tree order, as ``get_all_points`` lists
+        them: ties are broken by the path of child and point indices of
+        each entry.
+
+        :param point: Point class or tuple of (x, y) coordinates.
+        :return: A list of up to ``k`` points, closest first.
+        """
+        x, y = get_coords(point)
+        queue = [(0.0, (), self, False)]
+        output = []
+        while queue and len(output) < k:
+            _, path, item, is_point = heapq.heappop(queue)
+            if is_point:
+                output.append(item)
+            elif item.type == Node.LEAF:
+                for index, other in enumerate(item.features):
+                    px, py = get_coords(other)
+                    distance = (px - x) ** 2 + (py - y) ** 2
+                    heapq.heappush(
+                        queue, (distance, path + (index,), other, True))
+            else:
+                for index, child in enumerate(item.children):
+                    if child.number_of_points:
+                        distance = rectangle_distance2(x, y, child.rectangle)
+                        heapq.heappush(
+                            queue, (distance, path + (index,), child, False))
+        return output
+
+    def get_points_within_distance(self, point, distance):
+        """
+        Lists the points at most ``distance`` away from ``point``.
+
+        Nodes whose rectangle is farther than ``distance`` are skipped, and
+        nodes that lie entirely within the circle are returned whole.
+
+        :param point: Point class or tuple of (x, y) coordinates.
+        """
+        x, y = get_coords(point)
+        limit = distance * distance
+
+        output = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if rectangle_distance2(x, y, node.rectangle) > limit:
+                continue
+
+            x0, y0, x1, y1 = node.rectangle
+            farthest = max(x - x0, x1 - x) ** 2 + max(y - y0, y1 - y) ** 2
+            if farthest <= limit:
+                # all points are within
+                output.extend(node.get_all_points())
+            elif node.type == Node.LEAF:
+                for other in node.features:
+                    px, py = get_coords(other)
+                    if (px - x) ** 2 + (py - y) ** 2 <= limit:
+                        output.append(other)
+            else:
+                # reversed, so children are visited in order
+                stack.extend(reversed(node.children))
+        return output
+
+    def get_bbox(self):
+        return self.rectangle
+
+    def compact(self):
+        """
+        Returns a read-only CompactQuadTree copy of the tree under this
+        node, which keeps nodes and points in flat numpy arrays.
+        """
+        return CompactQuadTree.from_tree(self)
+
+    def save(self, path):
+        """
+        Writes the tree under this node to ``path`` in the binary format of
+        ``CompactQuadTree.save``. Point payloads are not saved.
+        """
+        self.compact().save(path)
+
+
+class Aggregate(object):
+    """
+    Count, sum, minimum, maximum and mean of the values of a payload
+    field. None values are skipped.
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / float(self.count)
+
+    def add(self, value):
+        if value is None:
+            return
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def update(self, other):
+        """Merges the aggregate of another set of points into this one."""
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def copy(self):
+        output = Aggregate()
+        output.update(self)
+        return output
+
+    def __repr__(self):
+        return 'Aggregate(count=%r, sum=%r, min=%r, max=%r)' % (
+            self.count, self.sum, self.min, self.max)
+
+
+class Estimate(object):
+    """
+    An approximate count, with guaranteed ``lower`` and ``upper`` bounds.
+    """
+    def __init__(self):
+        self.value = 0.0
+        self.lower = 0
+        self.upper = 0
+
+    @property
+    def exact(self):
+        return self.lower == self.upper
+
+    def add_exact(self, count):
+        self.value += count
+        self.lower += count
+        self.upper += count
+
+    def add_partial(self, count, fraction):
+        """Adds ``count`` points, of which about ``fraction`` count."""
+        self.value += count * fraction
+        self.upper += count
+
+    def __repr__(self):
+        return 'Estimate(value=%r, lower=%r, upper=%r)' % (
+            self.value, self.lower, self.upper)
+
+
+def _frozen(value):
+    """
+    A hashable copy of a JSON-like payload: dicts become frozensets of
+    their items and lists become tuples, at any depth.
+    """
+    if isinstance(value, dict):
+        return frozenset([(key, _frozen(item))
+                          for key, item in value.items()])
+    if isinstance(value, list):
+        return tuple([_frozen(item) for item in value])
+    return value
+
+
+class Point(object):
+    """
+    A point object which allows a paylood to be attached.
+    """
+    def __init__(self, x=None, y=None, data=None):
+        self.x = x
+        self.y = y
+        self.data = data
+
+    def __repr__(self):
+        return 'p(%s, %s)' % (str(self.x), str(self.y))
+
+    def __hash__(self):
+        return hash((self.x, self.y, _frozen(self.data)))
+
+    def __eq__(self, othr):
+        return (self.x, self.y, self.data) == (othr.x, othr.y, othr.data)
+
+
+class QuadTree(Node):
+    """
+    The root of a tree of Nodes.
+
+    Unlike a Node, the root grows to fit points added outside of its
+    rectangle.
+
+    ``QuadTree(points, backend='morton')`` builds a static MortonQuadTree
+    instead, which honours ``extent`` and ``max_points`` but has no
+    ``max_depth``: its cells are always ``MortonQuadTree.LEVELS`` deep.
+    """
+    def __new__(cls, points=None, extent=None, max_points=11,
+                backend='node', max_depth=None):
+        if backend == 'morton':
+            if max_depth is not None:
+                raise ValueError('the morton backend has no max_depth.')
+            return MortonQuadTree(points, extent, max_points)
+        elif backend != 'node':
+            raise ValueError('unknown backend %r.' % (backend,))
+        return super(QuadTree, cls).__new__(cls)
+
+    def __init__(self, points=None, extent=None, max_points=11,
+                 backend='node', max_depth=None):
+        """
+        :param points: points to insert, any iterable.
+        :param extent: initial (minx, miny, maxx, maxy) of the root,
+        defaults to the bounding box of ``points`` when they are a
+        sequence.
+        :param max_points: maximum number of distinct locations in a leaf.
+        :param backend: 'node' for a tree of Nodes, 'morton' for a
+        MortonQuadTree.
+        :param max_depth: depth at which leaves stop splitting and hold
+        any number of points, unlimited by default. Only for the 'node'
+        backend.
+        """
+        # pure_points = [feature_to_point(featurize(point)) for point in points]
+        if points is None:
+            points = []
+        if extent is None and hasattr(points, '__len__') and len(points):
+            extent = self.find_bbox(points)
+            if not all([math.isfinite(value) for value in extent]):
+                # fit to the first point instead, add_point reports the
+                # point that is not finite
+                extent = None
+
+        # without an extent the root fits itself to the first points
+        self._fit_first_point = extent is None
+
+        # if a split involves 16 checks of containment, the optimal
+        # number of points is 16/ln(4)
+        super(QuadTree, self).__init__(
+            None, rect=extent or (0, 0, 0, 0), max_points=max_points,
+            max_depth=max_depth
+        )
+        for point in points:
+            self.add_point(point)
+
+    def add_point(self, point):
+        if self._fit_first_point or not self.point_coords_in_bbox(point):
+            self.grow(point)
+        super(QuadTree, self).add_point(point)
+
+    def add_points(self, points):
+        # bounds are checked before inserting, iterators would be used up
+        points = list(points)
+        for point in points:
+            # before growing, the bounding box may skip NaN coordinates
+            finite_coords(point)
+        if points:
+            minx, miny, maxx, maxy = self.find_bbox(points)
+            for corner in [(minx, miny), (maxx, maxy)]:
+                if (self._fit_first_point
+                        or not self.point_coords_in_bbox(corner)):
+                    self.grow(corner)
+        super(QuadTree, self).add_points(points)
+
+    def move_point(self, point, new_point):
+        if self._fit_first_point or not self.point_coords_in_bbox(new_point):
+            finite_coords(new_point)
+            # a point missing from the tree leaves the root as it was
+            self.remove_point(point)
+            self.add_point(new_point)
+        else:
+            super(QuadTree, self).move_point(point, new_point)
+
+    def grow(self, point):
+        """
+        Grows the root until its rectangle contains ``point``.
+
+        A leaf root is simply stretched. A branch is wrapped into a new
+        root twice as large, extending towards the point, which keeps the
+        old root as one of its quadrants. Each step moves a constant
+        number of nodes, the existing subtrees are reused as they are.
+
+        :raises ValueError: if a coordinate of the point is not finite.
+        """
+        x, y = finite_coords(point)
+        self.version = next(_versions)
+        self.generation += 1
+        while self._fit_first_point or not self.point_coords_in_bbox(point):
+            x0, y0, x1, y1 = self.rectangle
+            if self.type == Node.LEAF:
+                if self._fit_first_point and not self.number_of_points:
+                    self.rectangle = (x, y, x, y)
+                else:
+                    self.rectangle = (min(x0, x), min(y0, y),
+                                      max(x1, x), max(y1, y))
+                break
+
+            # a flat root grows by the distance to the point instead
+            width = (x1 - x0) or abs(x - x0)
+            height = (y1 - y0) or abs(y - y0)
+            if x < x0:
+                x0, split_x = x0 - width, x0
+            else:
+                x1, split_x = x1 + width, x1
+            if y < y0:
+                y0, split_y = y0 - height, y0
+            else:
+                y1, split_y = y1 + height, y1
+            self._wrap((x0, y0, x1, y1), split_x, split_y)
+        self._fit_first_point = False
+
+    def _wrap(self, rect, split_x, split_y):
+        # move the state of the root into a new node, which becomes the
+        # quadrant of ``rect`` that matches the current rectangle
+        old = Node(self, self.rectangle, self.max_points, self.max_depth)
+        old.children = self.children
+        old.number_of_points = self.number_of_points
+        old.type = self.type
+        for child in old.children:
+            child.parent = old
+        for field in self.aggregate_fields:
+            old.aggregates[field] = self.aggregates[field].copy()
+
+        # the old root comes first, so points on its edges keep being
+        # routed to it rather than to its new siblings
+        rects = quadrants(rect, split_x, split_y)
+        rects.remove(old.rectangle)
+        children = [old]
+        for quadrant in rects:
+            children.append(
+                Node(self, quadrant, self.max_points, self.max_depth))
+
+        self.children = children
+        self.rectangle = tuple([float(item) for item in rect])
+
+    @classmethod
+    def from_stream(cls, points, extent=None, max_points=11,
+                    chunk_size=10000, max_depth=None):
+        """
+        Builds a QuadTree from an iterable of points without materializing
+        it, inserting ``chunk_size`` points at a time with ``add_points``.
+
+        Without an ``extent`` the root fits the first chunk and grows as
+        needed. For a tighter root, compute the extent in a first pass,
+        e.g. ``QuadTree.find_bbox(iter_csv_points(path))``.
+        """
+        tree = cls(extent=extent, max_points=max_points, max_depth=max_depth)
+        points = iter(points)
+        while True:
+            chunk = list(itertools.islice(points, chunk_size))
+            if not chunk:
+                return tree
+            tree.add_points(chunk)
+
+    @classmethod
+    def from_csv(cls, source, x='x', y='y', extent=None, max_points=11,
+                 chunk_size=10000, max_depth=None, **kwargs):
+        """
+        Streams the points of a CSV file into a QuadTree, see
+        ``iter_csv_points`` and ``from_stream``.
+        """
+        return cls.from_stream(iter_csv_points(source, x, y, **kwargs),
+                               extent, max_points, chunk_size, max_depth)
+
+    @classmethod
+    def from_geojson(cls, source, properties=False, extent=None,
+                     max_points=11, chunk_size=10000, max_depth=None):
+        """
+        Streams the point features of a GeoJSON file into a QuadTree, see
+        ``iter_geojson_points`` and ``from_stream``.
+        """
+        return cls.from_stream(iter_geojson_points(source, properties),
+                               extent, max_points, chunk_size, max_depth)
+
+    @classmethod
+    def from_arrays(cls, xs, ys=None, max_points=11, max_depth=None):
+        """
+        Bulk-loads a QuadTree from numpy coordinate arrays.
+
+        Builds the same tree as ``QuadTree(list(zip(xs, ys)))``, but the
+        points are partitioned into quadrants with vectorized operations,
+        a whole level at a time, instead of being inserted one by one.
+
+        :param xs: x coordinates, or an (N, 2) array of coordinates when
+        ``ys`` is omitted.
+        :param ys: y coordinates.
+        :param max_points: maximum number of distinct locations in a leaf.
+        :param max_depth: depth at which leaves stop splitting.
+        :return: A QuadTree holding ``(x, y)`` float tuples.
+        """
+        xs, ys = coordinate_arrays(xs, ys)
+        if not len(xs):
+            raise ValueError('cannot bulk-load an empty set of points.')
+
+        rect = (xs.min(), ys.min(), xs.max(), ys.max())
+        tree = cls(extent=rect, max_points=max_points, max_depth=max_depth)
+        tree._bulk_load(xs, ys)
+        return tree
+
+    def _bulk_load(self, xs, ys):
+        rects, counts, first_child, starts, order = bulk_partition(
+            xs, ys, self.rectangle, self.max_points, self.max_depth)
+
+        points = list(zip(xs[order].tolist(), ys[order].tolist()))
+        self._unpack(rects, counts, first_child, starts, points)
+
+    def _unpack(self, rects, counts, first_child, starts, points):
+        # builds the Nodes under the root from the flat arrays of a
+        # CompactQuadTree, ``points`` being the list of its coordinates
+        rects = rects.tolist()
+        counts = counts.tolist()
+        first_child = first_child.tolist()
+        starts = starts.tolist()
+
+        # nodes are stored breadth-first, so every node is created by its
+        # parent before the loop reaches it
+        nodes = [self] + [None] * (len(counts) - 1)
+        for i, node in enumerate(nodes):
+            node.number_of_points = counts[i]
+            child = first_child[i]
+            if child < 0:
+                node.features = points[starts[i]:starts[i] + counts[i]]
+                node._points = frequencies(node.features)
+            else:
+                node.type = Node.BRANCH
+                for j in range(child, child + 4):
+                    nodes[j] = Node(node, rects[j], node.max_points,
+                                    node.max_depth)
+                node.children = nodes[child:child + 4]
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """
+        Loads a tree written by ``save``.
+
+        :param mmap: memory-map the file instead of reading it, and return
+        a read-only CompactQuadTree backed by the mapping. Processes that
+        map the same file share a single copy of the tree.
+        :return: A QuadTree, or a CompactQuadTree with ``mmap``.
+        """
+        compact = CompactQuadTree.load(path, mmap)
+        if mmap:
+            return compact
+
+        tree = cls(extent=compact.rectangle, max_points=compact.max_points,
+                   max_depth=compact.max_depth)
+        points = [tuple(point) for point in compact.coords.tolist()]
+        tree._unpack(compact.rects, compact.counts, compact.first_child,
+                     compact.starts, points)
+        return tree
+
+    def compile(self, feature):
+        """
+        Finds the nodes covered by ``feature`` once, for queries repeated
+        with the same feature.
+
+        :return: A QueryPlan.
+        """
+        return QueryPlan(self, feature)
+
+    def summary(self):
+        """
+        Describes the shape of the tree.
+
+        :return: A dict with the number of points, distinct points, nodes
+        and leaves, ``depth_histogram`` (nodes at each depth),
+        ``leaf_occupancy`` (leaves by number of distinct points) and
+        ``duplicates``, the locations holding more than one point: their
+        number, the points stacked on them beyond the first, the largest
+        stack and the leaves they are in.
+        """
+        depth_histogram = {}
+        leaf_occupancy = {}
+        duplicates = {'locations': 0, 'points': 0, 'max_multiplicity': 0,
+                      'leaves': 0}
+        distinct = 0
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            depth_histogram[depth] = depth_histogram.get(depth, 0) + 1
+            if node.type != Node.LEAF:
+                stack.extend([(child, depth + 1) for child in node.children])
+                continue
+
+            occupancy = len(node._points)
+            distinct += occupancy
+            leaf_occupancy[occupancy] = leaf_occupancy.get(occupancy, 0) + 1
+            stacked = [count for count in node._points.values() if count > 1]
+            if stacked:
+                duplicates['locations'] += len(stacked)
+                duplicates['points'] += sum(stacked) - len(stacked)
+                duplicates['max_multiplicity'] = max(
+                    duplicates['max_multiplicity'], max(stacked))
+                duplicates['leaves'] += 1
+
+        return {
+            'points': self.number_of_points,
+            'distinct_points': distinct,
+            'nodes': sum(depth_histogram.values()),
+            'leaves': sum(leaf_occupancy.values()),
+            'depth_histogram': depth_histogram,
+            'leaf_occupancy': leaf_occupancy,
+            'duplicates': duplicates,
+        }
+
+    @staticmethod
+    def find_bbox(points):
+        """The bounding box of ``points``, in one pass over any iterable."""
+        points = iter(points)
+        try:
+            x, y = get_coords(next(points))
+        except StopIteration:
+            raise ValueError('cannot find the bounding box of no points.')
+        minx = x
+        maxx = x
+        miny = y
+        maxy = y
+
+        for p in points:
+            x, y = get_coords(p)
+            if x < minx:
+                minx = x
+            if x > maxx:
+                maxx = x
+            if y < miny:
+                miny = y
+            if y > maxy:
+                maxy = y
+
+        return minx, miny, maxx, maxy
+
+
+class QueryPlan(object):
+    """
+    The nodes a QuadTree query with ``feature`` needs, see
+    ``Node.overlapping_nodes``: the nodes within the feature, whose
+    points are all counted, and the boundary leaves, whose points are
+    tested one by one.
+
+    Running the plan makes no rectangle tests. Points added to the tree
+    later are still found, since nodes keep their counts up to date. A
+    boundary leaf that has been subdivided is replaced by the nodes of
+    its subtree, while merges and growth of the root, which leave nodes
+    detached, compile the plan again.
+    """
+    def __init__(self, tree, feature):
+        self.tree = tree
+        self.feature = feature
+        self._compile()
+
+    def _compile(self):
+        self.generation = self.tree.generation
+        self.nodes = self.tree.overlapping_nodes(self.feature)
+
+    def _update(self):
+        if self.generation != self.tree.generation:
+            self._compile()
+        elif any([node.type != Node.LEAF
+                  for node, contained in self.nodes if not contained]):
+            nodes = []
+            for node, contained in self.nodes:
+                if contained or node.type == Node.LEAF:
+                    nodes.append((node, contained))
+                else:
+                    nodes.extend(node.overlapping_nodes(self.feature))
+            self.nodes = nodes
+
+    @property
+    def contained(self):
+        """The nodes within the feature."""
+        self._update()
+        return [node for node, contained in self.nodes if contained]
+
+    @property
+    def boundary(self):
+        """The leaves partially covered by the feature."""
+        self._update()
+        return [node for node, contained in self.nodes if not contained]
+
+    def count_overlapping_points(self):
+        self._update()
+        return count_in_nodes(self.feature, self.nodes)
+
+    def get_overlapping_points(self):
+        self._update()
+        return points_in_nodes(self.feature, self.nodes)
+
+
+def morton_codes(ix, iy):
+    """Interleaves the bits of 32-bit cell indices into Z-order codes."""
+    load_numpy()
+    def spread(values):
+        values = values.astype(np.uint64)
+        for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                            (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                            (1, 0x5555555555555555)]:
+            values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+        return values
+    return spread(ix) | (spread(iy) << np.uint64(1))
+
+
+class MortonQuadTree(object):
+    """
+    A static, linear quadtree.
+
+    The rectangle of the tree is cut into a grid of 2**LEVELS by
+    2**LEVELS cells, and the points are kept in arrays sorted by the
+    Morton (Z-order) code of their cell. Every quadtree cell is then a
+    contiguous range of the arrays, found by binary search, and the
+    number of points in a cell is the length of its range. There are no
+    node objects to chase.
+
+    Gives the same results as a QuadTree for ``count_overlapping_points``,
+    ``get_overlapping_points`` and ``walk``, although points come out in
+    Z-order rather than in the order of a QuadTree.
+    """
+    LEVELS = 16
+
+    def __init__(self, points=None, extent=None, max_points=11):
+        """
+        :param points: a sequence of points, or an (N, 2) numpy array of
+        coordinates.
+        :param extent: (minx, miny, maxx, maxy) of the tree, defaults to
+        the bounding box of ``points``.
+        :param max_points: cells with more points are split while testing
+        points against features.
+        """
+        if load_numpy() is None:
+            raise ImportError('numpy is required to build a MortonQuadTree.')
+
+        if isinstance(points, np.ndarray):
+            # an (N, 2) array of coordinates, kept as float tuples
+            xs, ys = coordinate_arrays(points)
+            self._build(xs, ys, None, extent, max_points)
+            return
+
+        points = list(points) if points is not None else []
+        coords = np.array([get_coords(point) for point in points],
+                          dtype=float).reshape(-1, 2)
+        self._build(coords[:, 0], coords[:, 1], points, extent, max_points)
+
+    @classmethod
+    def from_arrays(cls, xs, ys=None, max_points=11):
+        """
+        Builds a MortonQuadTree of ``(x, y)`` float tuples from numpy
+        coordinate arrays, see ``QuadTree.from_arrays``.
+        """
+        xs, ys = coordinate_arrays(xs, ys)
+        tree = cls.__new__(cls)
+        tree._build(xs, ys, None, None, max_points)
+        return tree
+
+    def _build(self, xs, ys, points, extent, max_points):
+        self.max_points = max_points
+        if extent is None:
+            if len(xs):
+                extent = (xs.min(), ys.min(), xs.max(), ys.max())
+            else:
+                extent = (0, 0, 0, 0)
+        self.rectangle = tuple([float(item) for item in extent])
+        x0, y0, x1, y1 = self.rectangle
+        if len(xs) and not (x0 <= xs.min() and xs.max() <= x1
+                            and y0 <= ys.min() and ys.max() <= y1):
+            raise ValueError('points are outside of the extent.')
+
+        # cell boundaries; a point in cell i lies within edges[i:i + 2]
+        cells = 2 ** self.LEVELS
+        steps = np.arange(cells + 1) / float(cells)
+        x_edges = x0 + (x1 - x0) * steps
+        y_edges = y0 + (y1 - y0) * steps
+        x_edges[-1] = x1
+        y_edges[-1] = y1
+        ix = np.clip(np.searchsorted(x_edges, xs, 'right') - 1, 0, cells - 1)
+        iy = np.clip(np.searchsorted(y_edges, ys, 'right') - 1, 0, cells - 1)
+
+        codes = morton_codes(ix, iy)
+        order = np.argsort(codes, kind='stable')
+        self.codes = codes[order]
+        self.xs = xs[order]
+        self.ys = ys[order]
+        if points is None:
+            self.points = list(zip(self.xs.tolist(), self.ys.tolist()))
+        else:
+            self.points = [points[i] for i in order.tolist()]
+        self._x_edges = x_edges.tolist()
+        self._y_edges = y_edges.tolist()
+
+    @property
+    def number_of_points(self):
+        return len(self.points)
+
+    def get_bbox(self):
+        return self.rectangle
+
+    def point_coords_in_bbox(self, point):
+        return point_in_rectangle(point, self.rectangle)
+
+    def walk(self):
+        """An iterator over the points of the tree, in Z-order."""
+        return iter(self.points)
+
+    def get_all_points(self):
+        return list(self.points)
+
+    def count_overlapping_points(self, feature):
+        count = 0
+        boundary = []
+        for start, end, contained in self.overlapping_ranges(feature):
+            if contained:
+                count += end - start
+            else:
+                boundary.append((start, end))
+
+        if boundary:
+            xs = np.concatenate([self.xs[start:end] for start, end in boundary])
+            ys = np.concatenate([self.ys[start:end] for start, end in boundary])
+            count += int(np.count_nonzero(feature.contains_coordinates(xs, ys)))
+        return count
+
+    def get_overlapping_points(self, feature):
+        output = []
+        for start, end, contained in self.overlapping_ranges(feature):
+            if contained:
+                output.extend(self.points[start:end])
+            else:
+                inside = feature.contains_coordinates(
+                    self.xs[start:end], self.ys[start:end]).tolist()
+                output.extend([
+                    point for point, flag in
+                    zip(self.points[start:end], inside) if flag
+                ])
+        return output
+
+    def overlapping_ranges(self, feature):
+        """
+        The Morton counterpart of ``Node.overlapping_nodes``.
+
+        :return: A list of ``(start, end, contained)`` ranges of the
+        sorted points: cells within ``feature``, and the partially covered
+        cells small enough to test their points one by one.
+        """
+        output = []
+        # cells as (level, column, row, code, first point, end of points)
+        stack = [(0, 0, 0, 0, 0, len(self.points))]
+        while stack:
+            level, column, row, code, start, end = stack.pop()
+            if start == end:
+                continue
+
+            size = 2 ** (self.LEVELS - level)
+            rectangle = (self._x_edges[column * size],
+                         self._y_edges[row * size],
+                         self._x_edges[(column + 1) * size],
+                         self._y_edges[(row + 1) * size])
+            if feature.contains_rectangle(rectangle):
+                output.append((start, end, True))
+            elif feature.intersects_rectangle(rectangle):
+                if (end - start <= self.max_points or level == self.LEVELS
+                        or self.codes[start] == self.codes[end - 1]):
+                    output.append((start, end, False))
+                    continue
+
+                # the four children are consecutive ranges of codes
+                shift = 2 * (self.LEVELS - level - 1)
+                bounds = np.array([(code * 4 + k) << shift for k in (1, 2, 3)],
+                                  dtype=np.uint64)
+                splits = [start] + (start + np.searchsorted(
+                    self.codes[start:end], bounds)).tolist() + [end]
+                children = [
+                    (level + 1, 2 * column + (k & 1), 2 * row + (k >> 1),
+                     code * 4 + k, splits[k], splits[k + 1])
+                    for k in range(4)
+                ]
+                # reversed, so children are visited in Z-order
+                stack.extend(reversed(children))
+        return output
+
+
+# binary file layout of CompactQuadTree.save
+FILE_MAGIC = b'QUADTREE'
+FILE_VERSION = 2
+# magic, version, max_points, nodes, points, max_depth (-1 for none) and
+# padding to keep the arrays 8-byte aligned
+FILE_HEADER = '<8sIIQQi4x'
+# version 1 files have no max_depth
+FILE_HEADERS = {1: '<8sIIQQ', 2: FILE_HEADER}
+FILE_DTYPES = ('<f8', '<i8', '<i8', '<i8', '<f8')
+
+
+class CompactNode(object):
+    """
+    A read-only view of one node of a CompactQuadTree.
+
+    Offers the query API of Node on top of the flat arrays of the tree.
+    """
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def rectangle(self):
+        return tuple(self.tree.rects[self.index].tolist())
+
+    @property
+    def number_of_points(self):
+        return int(self.tree.counts[self.index])
+
+    @property
+    def type(self):
+        if self.tree.first_child[self.index] < 0:
+            return Node.LEAF
+        return Node.BRANCH
+
+    @property
+    def children(self):
+        child = int(self.tree.first_child[self.index])
+        if child < 0:
+            return []
+        return [CompactNode(self.tree, i) for i in range(child, child + 4)]
+
+    @property
+    def features(self):
+        if self.type == Node.LEAF:
+            return self.tree.node_points(self.index)
+        return []
+
+    @property
+    def points(self):
+        points = []
+        for coordinate, frequency in frequencies(self.features).items():
+            points.extend([coordinate] * frequency)
+        return points
+
+    def count_overlapping_points(self, feature):
+        tree = self.tree
+        count = 0
+        boundary = []
+        for index, contained in self.overlapping_nodes(feature):
+            if contained:
+                count += int(tree.counts[index])
+            else:
+                boundary.append(index)
+
+        if boundary:
+            coords = np.concatenate([tree.node_coords(i) for i in boundary])
+            count += int(np.count_nonzero(
+                feature.contains_coordinates(coords[:, 0], coords[:, 1])))
+        return count
+
+    def get_overlapping_points(self, feature):
+        tree = self.tree
+        output = []
+        for index, contained in self.overlapping_nodes(feature):
+            points = tree.node_points(index)
+            if not contained:
+                coords = tree.node_coords(index)
+                inside = feature.contains_coordinates(
+                    coords[:, 0], coords[:, 1]).tolist()
+                points = [
+                    point for point, flag in zip(points, inside) if flag
+                ]
+            output.extend(points)
+        return output
+
+    def overlapping_nodes(self, feature):
+        """
+        Same as ``Node.overlapping_nodes``, but returns node indices.
+        """
+        tree = self.tree
+        output = []
+        stack = [self.index]
+        while stack:
+            index = stack.pop()
+            rectangle = tuple(tree.rects[index].tolist())
+            if feature.contains_rectangle(rectangle):
+                output.append((index, True))
+            elif feature.intersects_rectangle(rectangle):
+                child = int(tree.first_child[index])
+                if child < 0:
+                    output.append((index, False))
+                else:
+                    # reversed, so children are visited in order
+                    stack.extend(range(child + 3, child - 1, -1))
+        return output
+
+    def count_in_rectangle(self, bbox):
+        """Same as ``Node.count_in_rectangle``."""
+        tree = self.tree
+        count = 0
+        for index, contained in self.rectangle_nodes(bbox):
+            if contained:
+                count += int(tree.counts[index])
+            else:
+                count += int(np.count_nonzero(
+                    coords_in_rectangle(tree.node_coords(index), bbox)))
+        return count
+
+    def density_grid(self, bbox, nx, ny):
+        """Same as ``Node.density_grid``."""
+        x0, y0, x1, y1 = bbox
+        return self.density(np.linspace(x0, x1, nx + 1),
+                            np.linspace(y0, y1, ny + 1))
+
+    def density_tile(self, z, x, y, size=256):
+        """Same as ``Node.density_tile``."""
+        lons, lats = tile_edges(z, x, y, size)
+        return self.density(lons, lats)[::-1]
+
+    def density(self, x_edges, y_edges):
+        """
+        Same as ``Node.density``, but the nodes are processed a whole
+        level at a time with array operations.
+        """
+        tree = self.tree
+        x_edges = np.asarray(x_edges, dtype=float)
+        y_edges = np.asarray(y_edges, dtype=float)
+        nx = len(x_edges) - 1
+        ny = len(y_edges) - 1
+        grid = np.zeros((ny, nx), dtype=np.int64)
+        x0, x1 = x_edges[0], x_edges[-1]
+        y0, y1 = y_edges[0], y_edges[-1]
+
+        # the cells and counts of nodes within one cell, and the leaves
+        # straddling cell edges, binned at the end
+        cells = []
+        counts = []
+        straddling = []
+        level = np.array([self.index])
+        while len(level):
+            level = level[tree.counts[level] > 0]
+            nx0, ny0, nx1, ny1 = tree.rects[level].T
+            overlapping = ~((nx1 < x0) | (x1 < nx0) | (ny1 < y0) | (y1 < ny0))
+            level = level[overlapping]
+            nx0, ny0, nx1, ny1 = tree.rects[level].T
+
+            columns = cell_index(x_edges, nx0)
+            rows = cell_index(y_edges, ny0)
+            within = ((x0 <= nx0) & (nx1 <= x1) & (y0 <= ny0) & (ny1 <= y1))
+            # points on an inner edge belong to the upper cell, as in
+            # bin_coordinates
+            single = (within
+                      & ((nx1 < x_edges[columns + 1]) | (columns == nx - 1))
+                      & ((ny1 < y_edges[rows + 1]) | (rows == ny - 1)))
+            # all points of these nodes are in one cell
+            cells.append(rows[single] * nx + columns[single])
+            counts.append(tree.counts[level[single]])
+
+            level = level[~single]
+            children = tree.first_child[level]
+            straddling.append(level[children < 0])
+            children = children[children >= 0]
+            level = (children[:, None] + np.arange(4)).ravel()
+
+        grid.ravel()[:] += np.bincount(
+            np.concatenate(cells), np.concatenate(counts),
+            minlength=nx * ny).astype(np.int64)
+        leaves = np.concatenate(straddling)
+        if len(leaves):
+            counts = tree.counts[leaves]
+            offsets = np.repeat(tree.starts[leaves] - np.cumsum(counts)
+                                + counts, counts)
+            coords = tree.coords[np.arange(len(offsets)) + offsets]
+            bin_coordinates(grid, x_edges, y_edges, coords[:, 0],
+                            coords[:, 1])
+        return grid
+
+    def query_rectangle(self, bbox):
+        """Same as ``Node.query_rectangle``."""
+        tree = self.tree
+        output = []
+        for index, contained in self.rectangle_nodes(bbox):
+            coords = tree.node_coords(index)
+            if not contained:
+                coords = coords[coords_in_rectangle(coords, bbox)]
+            output.extend([tuple(point) for point in coords.tolist()])
+        return output
+
+    def rectangle_nodes(self, bbox):
+        """
+        Like ``overlapping_nodes``, for the axis-aligned rectangle ``bbox``.
+        """
+        tree = self.tree
+        x0, y0, x1, y1 = bbox
+        output = []
+        stack = [self.index]
+        while stack:
+            index = stack.pop()
+            nx0, ny0, nx1, ny1 = tree.rects[index].tolist()
+            if nx1 < x0 or x1 < nx0 or ny1 < y0 or y1 < ny0:
+                continue
+            elif x0 <= nx0 and nx1 <= x1 and y0 <= ny0 and ny1 <= y1:
+                output.append((index, True))
+            else:
+                child = int(tree.first_child[index])
+                if child < 0:
+                    output.append((index, False))
+                else:
+                    # reversed, so children are visited in order
+                    stack.extend(range(child + 3, child - 1, -1))
+        return output
+
+    def get_all_points(self):
+        return self.tree.node_points(self.index)
+
+    def point_coords_in_bbox(self, point):
+        return point_in_rectangle(point, self.rectangle)
+
+    def walk(self):
+        """An iterator over the points of in the Node"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.type == Node.LEAF:
+                for point in node.points:
+                    yield point
+            else:
+                stack.extend(reversed(node.children))
+
+    def get_bbox(self):
+        return self.rectangle
+
+
+class CompactQuadTree(CompactNode):
+    """
+    A read-only QuadTree kept in flat, typed numpy arrays.
+
+    Nodes are stored breadth-first. For node ``i``, ``rects[i]`` is its
+    rectangle, ``counts[i]`` its number of points and ``first_child[i]``
+    the index of the first of its four consecutive children (-1 for
+    leaves). The points of the tree live in one (N, 2) ``coords`` buffer,
+    ordered so that the points of every node are the contiguous block
+    starting at ``starts[i]``.
+
+    Only coordinates are stored, points are returned as ``(x, y)`` tuples.
+    """
+    def __init__(self, rects, counts, first_child, starts, coords,
+                 max_points=11, max_depth=None):
+        super(CompactQuadTree, self).__init__(self, 0)
+        self.rects = rects
+        self.counts = counts
+        self.first_child = first_child
+        self.starts = starts
+        self.coords = coords
+        self.max_points = max_points
+        # kept for the QuadTree that ``QuadTree.load`` unpacks it into
+        self.max_depth = max_depth
+
+    @classmethod
+    def from_arrays(cls, xs, ys=None, max_points=11, max_depth=None):
+        """
+        Bulk-loads a CompactQuadTree from numpy coordinate arrays,
+        without ever creating Node objects.
+
+        See ``QuadTree.from_arrays`` for the arguments.
+        """
+        xs, ys = coordinate_arrays(xs, ys)
+        if not len(xs):
+            raise ValueError('cannot bulk-load an empty set of points.')
+
+        rect = (xs.min(), ys.min(), xs.max(), ys.max())
+        rects, counts, first_child, starts, order = bulk_partition(
+            xs, ys, rect, max_points, max_depth)
+        coords = np.column_stack([xs[order], ys[order]])
+        return cls(rects, counts, first_child, starts, coords, max_points,
+                   max_depth)
+
+    @classmethod
+    def from_tree(cls, root):
+        """Packs a tree of Node objects into a CompactQuadTree."""
+        if load_numpy() is None:
+            raise ImportError('numpy is required to build a CompactQuadTree.')
+
+        nodes = [root]
+        first_child = []
+        for node in nodes:
+            if node.type == Node.LEAF:
+                first_child.append(-1)
+            else:
+                first_child.append(len(nodes))
+                nodes.extend(node.children)
+
+        # points are laid out depth-first, so every subtree is contiguous
+        index = dict((id(node), i) for i, node in enumerate(nodes))
+        starts = [0] * len(nodes)
+        coords = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            starts[index[id(node)]] = len(coords)
+            if node.type == Node.LEAF:
+                coords.extend([get_coords(point) for point in node.features])
+            else:
+                stack.extend(reversed(node.children))
+
+        return cls(
+            np.array([node.rectangle for node in nodes], dtype=float),
+            np.array([node.number_of_points for node in nodes],
+                     dtype=np.int64),
+            np.array(first_child, dtype=np.int64),
+            np.array(starts, dtype=np.int64),
+            np.array(coords, dtype=float).reshape(-1, 2),
+            root.max_points,
+            root.max_depth
+        )
+
+    def save(self, path):
+        """
+        Writes the tree to ``path`` in a compact binary format.
+
+        A 40 byte header (magic, format version, ``max_points``, number of
+        nodes and of points, ``max_depth`` or -1, and 4 bytes of padding)
+        is followed by the little-endian ``rects``,
+        ``counts``, ``first_child``, ``starts`` and ``coords`` arrays, all
+        8-byte aligned so that the file can be memory-mapped.
+        """
+        with io.open(path, 'wb') as fp:
+            fp.write(struct.pack(
+                FILE_HEADER, FILE_MAGIC, FILE_VERSION, self.max_points,
+                len(self.counts), len(self.coords),
+                -1 if self.max_depth is None else self.max_depth))
+            for array, dtype in zip(self.arrays(), FILE_DTYPES):
+                np.ascontiguousarray(array, dtype=dtype).tofile(fp)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """
+        Loads a tree written by ``save``.
+
+        :param mmap: memory-map the file instead of reading it into memory.
+        The arrays of the tree are then read-only views of the mapping.
+        """
+        if load_numpy() is None:
+            raise ImportError('numpy is required to load a CompactQuadTree.')
+
+        if mmap:
+            data = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            with io.open(path, 'rb') as fp:
+                data = fp.read()
+
+        if len(data) < struct.calcsize('<8sI'):
+            raise ValueError('%s is not a quadtree file.' % path)
+        magic, version = struct.unpack('<8sI', bytes(data[:12]))
+        if magic != FILE_MAGIC:
+            raise ValueError('%s is not a quadtree file.' % path)
+        if version not in FILE_HEADERS:
+            raise ValueError('unsupported quadtree file version %d.' % version)
+
+        header_size = struct.calcsize(FILE_HEADERS[version])
+        if len(data) < header_size:
+            raise ValueError('%s is truncated.' % path)
+        header = struct.unpack(FILE_HEADERS[version], bytes(data[:header_size]))
+        max_points, number_of_nodes, number_of_points = header[2:5]
+        max_depth = header[5] if len(header) > 5 else -1
+
+        shapes = [(number_of_nodes, 4), (number_of_nodes,), (number_of_nodes,),
+                  (number_of_nodes,), (number_of_points, 2)]
+        arrays = []
+        offset = header_size
+        for shape, dtype in zip(shapes, FILE_DTYPES):
+            count = int(np.prod(shape))
+            if offset + count * 8 > len(data):
+                raise ValueError('%s is truncated.' % path)
+            arrays.append(np.frombuffer(
+                data, dtype=dtype, count=count, offset=offset).reshape(shape))
+            offset += count * 8
+
+        return cls(*arrays, max_points=max_points,
+                   max_depth=None if max_depth < 0 else max_depth)
+
+    def arrays(self):
+        """The arrays of the tree, in the order of the constructor."""
+        return (self.rects, self.counts, self.first_child, self.starts,
+                self.coords)
+
+    @property
+    def nbytes(self):
+        """Number of bytes held by the arrays of the tree."""
+        return sum([array.nbytes for array in self.arrays()])
+
+    def node_coords(self, index):
+        """The (K, 2) block of coordinates of the points of node ``index``."""
+        start = int(self.starts[index])
+        return self.coords[start:start + int(self.counts[index])]
+
+    def node_points(self, index):
+        """The points of node ``index`` as a list of ``(x, y)`` tuples."""
+        return [tuple(point) for point in self.node_coords(index).tolist()]
+
+
+# the tree of a ParallelQueryExecutor worker process, and the feature it
+# last decoded
+_worker_tree = None
+_worker_feature = (None, None)
+
+
+def _attach_worker(path):
+    global _worker_tree
+    _worker_tree = CompactQuadTree.load(path, mmap=True)
+
+
+def _feature_data(feature):
+    """What a worker needs to rebuild ``feature``: its kind and WKB."""
+    return (feature._rings is not None, feature.wkb)
+
+
+def _worker_query(task):
+    global _worker_feature
+    method, data, index = task
+    if _worker_feature[0] != data:
+        rings, wkb = data
+        if rings:
+            geometry = RingGeometry.from_wkb(wkb)
+        else:
+            load_shapely()
+            geometry = shapelyWkb.loads(wkb)
+        _worker_feature = (data, Feature(geometry))
+    node = CompactNode(_worker_tree, index)
+    return getattr(node, method)(_worker_feature[1])
+
+
+class ParallelQueryExecutor(object):
+    """
+    Runs overlap queries on a pool of worker processes.
+
+    The workers memory-map the same saved tree instead of receiving a
+    copy of it, and features are sent to them as WKB. Results are the same
+    as, and in the same order as, the serial queries, except that points
+    are returned as ``(x, y)`` tuples since saved trees keep no payloads.
+
+    The pool is reused across calls, close the executor when done::
+
+        with ParallelQueryExecutor(tree) as executor:
+            counts = executor.count_overlapping_points_batch(features)
+    """
+    def __init__(self, tree, processes=None):
+        """
+        :param tree: path of a tree written by ``save``, or a tree, which
+        is saved to a temporary file for the lifetime of the executor.
+        :param processes: number of worker processes, defaults to the
+        number of CPUs.
+        """
+        self._temporary = None
+        if isinstance(tree, (CompactQuadTree, Node)):
+            import tempfile
+            handle, self._temporary = tempfile.mkstemp(suffix='.qt')
+            os.close(handle)
+            tree.save(self._temporary)
+            tree = self._temporary
+
+        self.path = tree
+        self.tree = CompactQuadTree.load(self.path, mmap=True)
+        import multiprocessing
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(
+            self.processes, initializer=_attach_worker, initargs=(self.path,))
+
+    def count_overlapping_points(self, feature):
+        """
+        Counts the points within one feature, the subtrees it overlaps
+        being split among the workers.
+        """
+        return sum(self._split('count_overlapping_points', feature))
+
+    def get_overlapping_points(self, feature):
+        """
+        Lists the points within one feature, see
+        ``count_overlapping_points``.
+        """
+        output = []
+        for points in self._split('get_overlapping_points', feature):
+            output.extend(points)
+        return output
+
+    def count_overlapping_points_batch(self, features):
+        """Counts the points within each feature, one task per feature."""
+        return self._batch('count_overlapping_points', features)
+
+    def get_overlapping_points_batch(self, features):
+        """Lists the points within each feature, one task per feature."""
+        return self._batch('get_overlapping_points', features)
+
+    def _batch(self, method, features):
+        return self.pool.map(_worker_query, [
+            (method, _feature_data(feature), 0) for feature in features
+        ])
+
+    def _split(self, method, feature):
+        # expand the tree breadth-first until there are a few tasks per
+        # worker, then order them depth-first, like the serial query
+        tree = self.tree
+        frontier = [0]
+        while len(frontier) < 4 * self.processes:
+            expanded = []
+            for index in frontier:
+                child = int(tree.first_child[index])
+                if child < 0:
+                    expanded.append(index)
+                else:
+                    expanded.extend(range(child, child + 4))
+            if len(expanded) == len(frontier):
+                break
+            frontier = expanded
+        frontier = [index for index in frontier if tree.counts[index]]
+        frontier.sort(key=lambda index: int(tree.starts[index]))
+
+        data = _feature_data(feature)
+        return self.pool.map(_worker_query, [
+            (method, data, index) for index in frontier
+        ])
+
+    def close(self):
+        """Stops the workers and removes the temporary tree file."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.tree = None
+        if self._temporary is not None:
+            os.remove(self._temporary)
+            self._temporary = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ConcurrentQuadTree(object):
+    """
+    A QuadTree that reader threads can query while a writer adds points.
+
+    Readers query the published ``root`` as it is, without locks. Writers
+    never change a published node: a batch of points is inserted into
+    copies of the nodes on the paths it touches, which share every other
+    subtree with the published tree, and the new root is then published
+    with a single assignment. A query sees the tree either before or after
+    a whole batch.
+
+    ``add_point`` buffers points until ``batch_size`` of them are waiting,
+    ``flush`` publishes them sooner.
+
+    GEOS prepared geometries are not thread-safe, so each thread needs its
+    own Features, see ThreadedQueryExecutor.
+    """
+    def __init__(self, tree=None, batch_size=1000):
+        """
+        :param tree: a QuadTree to start from, which must not be changed
+        directly afterwards. Defaults to an empty QuadTree.
+        :param batch_size: number of buffered points that triggers a flush.
+        """
+        self.root = tree if tree is not None else QuadTree()
+        self.batch_size = batch_size
+        self.pending = []
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """The current tree, which later writes leave unchanged."""
+        return self.root
+
+    def add_point(self, point):
+        with self._lock:
+            self.pending.append(point)
+            if len(self.pending) < self.batch_size:
+                return
+            points = self.pending
+            self.pending = []
+            self._publish(points)
+
+    def add_points(self, points):
+        """Inserts and publishes ``points``, and any buffered ones."""
+        with self._lock:
+            points = self.pending + list(points)
+            self.pending = []
+            self._publish(points)
+
+    def flush(self):
+        """Publishes the buffered points."""
+        self.add_points([])
+
+    def _publish(self, points):
+        if not points:
+            return
+
+        root = self.root._copy(None)
+        # nodes of the new tree that are not shared with published trees
+        private = set([id(root)])
+        for point in points:
+            if root._fit_first_point or not root.point_coords_in_bbox(point):
+                # growing moves the children of the root under a new node,
+                # which sets their parents, so they must not be published
+                root.children = [
+                    child if id(child) in private else child._copy(root)
+                    for child in root.children
+                ]
+                private.update([id(child) for child in root.children])
+                root.grow(point)
+                private.update([id(child) for child in root.children])
+
+            node = root
+            depth = 0
+            while node.type != Node.LEAF:
+                node.version = next(_versions)
+                node.number_of_points += 1
+                if node.aggregate_fields:
+                    node._aggregate([point])
+                for i, child in enumerate(node.children):
+                    if child.point_coords_in_bbox(point):
+                        if id(child) not in private:
+                            child = child._copy(node)
+                            node.children[i] = child
+                            private.add(id(child))
+                        node = child
+                        depth += 1
+                        break
+                else:
+                    raise ValueError('%r is outside of the node.' % (point,))
+
+            node._add_point(point, depth)
+            # nodes made by a subdivision are new
+            stack = list(node.children)
+            while stack:
+                child = stack.pop()
+                private.add(id(child))
+                stack.extend(child.children)
+        self.root = root
+
+    @property
+    def number_of_points(self):
+        return self.root.number_of_points
+
+    def count_overlapping_points(self, feature, stats=None):
+        return self.root.count_overlapping_points(feature, stats)
+
+    def get_overlapping_points(self, feature, stats=None):
+        return self.root.get_overlapping_points(feature, stats)
+
+    def iter_overlapping_points(self, feature):
+        return self.root.iter_overlapping_points(feature)
+
+    def count_in_rectangle(self, bbox):
+        return self.root.count_in_rectangle(bbox)
+
+    def query_rectangle(self, bbox):
+        return self.root.query_rectangle(bbox)
+
+    def get_all_points(self):
+        return self.root.get_all_points()
+
+    def walk(self):
+        return self.root.walk()
+
+
+class ThreadedQueryExecutor(object):
+    """
+    Runs overlap queries on a pool of threads.
+
+    Unlike a ParallelQueryExecutor, threads share the tree itself, and
+    point payloads are kept. Queries run in parallel while shapely tests
+    geometries without holding the GIL, which batch point tests with
+    shapely 2 do. The tree may be a ConcurrentQuadTree being written to.
+
+        with ThreadedQueryExecutor(tree) as executor:
+            counts = executor.count_overlapping_points_batch(features)
+    """
+    def __init__(self, tree, threads=None):
+        """
+        :param tree: a QuadTree, ConcurrentQuadTree or CompactQuadTree.
+        :param threads: number of threads, defaults to the number of CPUs.
+        """
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        self.tree = tree
+        self.threads = threads or cpu_count()
+        self.pool = ThreadPool(self.threads)
+
+    def count_overlapping_points_batch(self, features):
+        """Counts the points within each feature, one task per feature."""
+        return self._batch('count_overlapping_points', features)
+
+    def get_overlapping_points_batch(self, features):
+        """Lists the points within each feature, one task per feature."""
+        return self._batch('get_overlapping_points', features)
+
+    def _batch(self, method, features):
+        query = getattr(self.tree, method)
+
+        def task(feature):
+            # prepared geometries cannot be shared between threads, every
+            # task prepares its own copy
+            return query(feature.copy())
+
+        return self.pool.map(task, features)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RegionIndex(object):
+    """
+    Finds which of a list of polygon Features each point falls in, the
+    reverse of a QuadTree query.
+
+    Cells are subdivided as Nodes are, and each cell keeps the features
+    that intersect it, in order. A cell within the first of its features
+    resolves to that feature, so its points need no geometry test. The
+    other cells are split down to ``max_depth``, and the points of the
+    smallest ones are tested against their features.
+
+    A point in several features is located in the first one.
+    """
+    def __init__(self, features, max_depth=10, properties=None):
+        """
+        :param features: Features or shapely geometries.
+        :param max_depth: depth at which cells stop splitting.
+        :param properties: optional payload of each feature, e.g. the
+        GeoJSON properties.
+        """
+        if load_numpy() is None:
+            raise ImportError('numpy is required to build a RegionIndex.')
+
+        self.features = [
+            feature if isinstance(feature, Feature) else Feature(feature)
+            for feature in features
+        ]
+        self.properties = properties
+        self.max_depth = max_depth
+
+        bounds = [feature.bounds for feature in self.features
+                  if not feature.is_empty]
+        if bounds:
+            self.rectangle = (min([b[0] for b in bounds]),
+                              min([b[1] for b in bounds]),
+                              max([b[2] for b in bounds]),
+                              max([b[3] for b in bounds]))
+        else:
+            self.rectangle = (0.0, 0.0, 0.0, 0.0)
+        self._build()
+
+    @classmethod
+    def from_geojson(cls, source, max_depth=10):
+        """
+        Indexes the features of a GeoJSON file, keeping their properties.
+
+        :param source: path or file object.
+        """
+        features = []
+        properties = []
+        with open_source(source) as fp:
+            for item in iter_json_features(fp):
+                if item.get('type') == 'Feature':
+                    geometry = item.get('geometry')
+                    data = item.get('properties')
+                else:
+                    geometry = item
+                    data = None
+                if geometry:
+                    features.append(Feature(geometry))
+                    properties.append(data)
+        return cls(features, max_depth, properties)
+
+    def _build(self):
+        # cells in breadth-first order, as in a CompactQuadTree
+        rects = [self.rectangle]
+        depths = [0]
+        candidates = [range(len(self.features))]
+        first_child = []
+        resolved = []
+        for index, rect in enumerate(rects):
+            inside = [
+                i for i in candidates[index]
+                if self.features[i].intersects_rectangle(rect)
+            ]
+            if inside and self.features[inside[0]].contains_rectangle(rect):
+                # all points of the cell are in its first feature
+                resolved.append(inside[0])
+                inside = []
+            else:
+                resolved.append(-1)
+            candidates[index] = inside
+
+            if not inside or depths[index] == self.max_depth:
+                first_child.append(-1)
+                continue
+            # a branch cell passes its list on to its children
+            candidates[index] = []
+
+            first_child.append(len(rects))
+            x0, y0, x1, y1 = rect
+            for child in quadrants(rect, x0 + (x1 - x0) / 2,
+                                   y0 + (y1 - y0) / 2):
+                rects.append(child)
+                depths.append(depths[index] + 1)
+                candidates.append(inside)
+
+        self.rects = np.array(rects, dtype=float).reshape(-1, 4)
+        self.first_child = np.array(first_child, dtype=np.int64)
+        self.resolved = np.array(resolved, dtype=np.int64)
+        # features left to test for the points of each leaf cell, in CSR
+        # form: those of cell i are candidates[offsets[i]:offsets[i + 1]],
+        # branch cells have none as their points end up in a leaf
+        self.offsets = np.zeros(len(rects) + 1, dtype=np.int64)
+        np.cumsum([len(items) for items in candidates],
+                  out=self.offsets[1:])
+        self.candidates = np.fromiter(
+            itertools.chain.from_iterable(candidates), dtype=np.int64,
+            count=int(self.offsets[-1]))
+
+    @property
+    def number_of_cells(self):
+        return len(self.first_child)
+
+    def cells_of(self, xs, ys):
+        """
+        The leaf cell of each point, -1 for points outside of the index,
+        routing points on cell edges as ``Node.add_point`` does.
+        """
+        x0, y0, x1, y1 = self.rectangle
+        cells = np.full(len(xs), -1, dtype=np.int64)
+        active = np.flatnonzero((x0 <= xs) & (xs <= x1)
+                                & (y0 <= ys) & (ys <= y1))
+        cells[active] = 0
+        while len(active):
+            children = self.first_child[cells[active]]
+            split = children >= 0
+            active = active[split]
+            children = children[split]
+
+            rects = self.rects[cells[active]]
+            xm = rects[:, 0] + (rects[:, 2] - rects[:, 0]) / 2
+            ym = rects[:, 1] + (rects[:, 3] - rects[:, 1]) / 2
+            px = xs[active]
+            py = ys[active]
+            # same order as ``quadrants``, first containing child wins
+            quadrant = np.where(
+                px <= xm,
+                np.where(py <= ym, 0, 1),
+                np.where(py >= ym, 2, 3)
+            )
+            cells[active] = children + quadrant
+        return cells
+
+    def locate(self, points):
+        """
+        Finds the feature of each point.
+
+        :param points: a sequence of points, or an (N, 2) array.
+        :return: A numpy array with the index in ``features`` of the
+        feature each point falls in, -1 for points in none.
+        """
+        if isinstance(points, np.ndarray):
+            xs, ys = coordinate_arrays(points)
+        else:
+            xs, ys = coordinate_arrays(
+                np.array([get_coords(point) for point in points],
+                         dtype=float).reshape(-1, 2))
+
+        cells = self.cells_of(xs, ys)
+        output = np.full(len(xs), -1, dtype=np.int64)
+        found = cells >= 0
+        output[found] = self.resolved[cells[found]]
+
+        # points of unresolved cells are tested against the features of
+        # their cell in order, one batch per feature
+        pending = np.flatnonzero(found & (output < 0))
+        rank = 0
+        while len(pending):
+            starts = self.offsets[cells[pending]] + rank
+            left = starts < self.offsets[cells[pending] + 1]
+            pending = pending[left]
+            features = self.candidates[starts[left]]
+            for i in np.unique(features).tolist():
+                tested = pending[features == i]
+                inside = self.features[i].contains_coordinates(
+                    xs[tested], ys[tested])
+                output[tested[inside]] = i
+            pending = pending[output[pending] < 0]
+            rank += 1
+        return output
@@ -2,7 +2,15 @@ import quadtree as module
 import unittest as ut
 from shapely.geometry import Polygon
 from shapely.geometry import asShape
+import io
 import json
+import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 from quadtree import Feature
 
 
@@ -51,6 +59,92 @@ class TestFeatureWrapper(ut.TestCase):
         self.failUnless(self.feature.contains_rectangle(rectangle))
 
 
+class TestPreparedFeature(ut.TestCase):
+    def setUp(self):
+        geojson = json.load(open("kings-county.geojson"))
+        self.geometry = asShape(geojson['features'][0]['geometry'])
+        self.feature = module.Feature(geometry=self.geometry)
+
+    def test_caches_bounds(self):
+        self.assertEqual(self.feature.bounds, tuple(self.geometry.bounds))
+
+    def test_empty_geometry_has_no_bounds(self):
+        empty = module.Feature(geometry=Polygon())
+        self.failUnless(empty.is_empty)
+        self.assertEqual(empty.bounds, None)
+
+    def test_same_as_unprepared_predicates(self):
+        x0, y0, x1, y1 = self.geometry.bounds
+        steps = 12
+        for i in range(steps):
+            for j in range(steps):
+                rectangle = (x0 + (x1 - x0) * i / steps,
+                             y0 + (y1 - y0) * j / steps,
+                             x0 + (x1 - x0) * (i + 1) / steps,
+                             y0 + (y1 - y0) * (j + 1) / steps)
+                polygon = Polygon(module.bbox_to_coords(rectangle))
+                self.assertEqual(self.feature.contains_rectangle(rectangle),
+                                 self.geometry.contains(polygon))
+                self.assertEqual(self.feature.intersects_rectangle(rectangle),
+                                 not self.geometry.disjoint(polygon))
+
+    def test_rectangle_outside_bounds_is_not_contained(self):
+        x0, y0, x1, y1 = self.geometry.bounds
+        self.failIf(self.feature.contains_rectangle((x0 - 1, y0, x0, y1)))
+        self.failIf(self.feature.intersects_rectangle(
+            (x0 - 2, y0, x0 - 1, y1)))
+
+    def test_replacing_geometry_resets_cache(self):
+        self.feature.geometry = Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+        self.assertEqual(self.feature.bounds, (0, 0, 1, 1))
+        self.failUnless(self.feature.contains_point((0.5, 0.5)))
+
+
+class TestBatchPointTests(ut.TestCase):
+    def setUp(self):
+        geojson = json.load(open("kings-county.geojson"))
+        self.feature = module.Feature(
+            geometry=asShape(geojson['features'][0]['geometry']))
+        x0, y0, x1, y1 = self.feature.bounds
+        self.points = [(x0 + (x1 - x0) * i / 40.0, y0 + (y1 - y0) * j / 40.0)
+                       for i in range(-2, 43) for j in range(-2, 43)]
+        # vertices lie on the boundary
+        polygon = self.feature.geometry.geoms[0]
+        self.points.extend(list(polygon.exterior.coords)[:20])
+
+    def test_same_as_contains_point(self):
+        self.assertEqual(
+            self.feature.contains_points(self.points),
+            [self.feature.contains_point(point) for point in self.points])
+
+    def test_accepts_point_objects(self):
+        points = [module.Point(x, y) for x, y in self.points]
+        self.assertEqual(self.feature.contains_points(points),
+                         self.feature.contains_points(self.points))
+
+    def test_empty_geometry(self):
+        empty = module.Feature(geometry=Polygon())
+        self.assertEqual(empty.contains_points([(0, 0), (1, 1)]),
+                         [False, False])
+
+    def test_duplicates_are_counted(self):
+        quadtree = module.QuadTree(self.points * 3)
+        expected = 3 * sum(self.feature.contains_points(self.points))
+        self.assertEqual(quadtree.count_overlapping_points(self.feature),
+                         expected)
+        self.assertEqual(
+            len(quadtree.get_overlapping_points(self.feature)), expected)
+
+    def test_overlapping_points_keep_payloads(self):
+        square = Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5])))
+        points = [module.Point(0.25, 0.25, 'a'), module.Point(0.75, 0.75, 'b'),
+                  module.Point(0.75, 0.75, 'c'), module.Point(1, 1, 'd')]
+        quadtree = module.QuadTree(points)
+        self.assertEqual(
+            [point.data for point in quadtree.get_overlapping_points(square)],
+            ['b', 'c', 'd'])
+
+
 class TestSquare(ut.TestCase):
     def setUp(self):
         self.square = module.Feature(Polygon([(0, 0), (1, 0), (1, 1), (0, 1)]))
@@ -196,6 +290,80 @@ class TestAutoSplitting(ut.TestCase):
         self.assertEqual(node.children[0].number_of_points, 2)
 
 
+class TestRemovePoint(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 10.0, y / 10.0) for x in range(11) for y in range(11)]
+        self.points.extend([(0.5, 0.5)] * 3)
+        self.quadtree = module.QuadTree(self.points)
+
+    def shape(self, node):
+        return (node.rectangle, node.type, node.number_of_points,
+                sorted(node._points.items()),
+                [self.shape(child) for child in node.children])
+
+    def test_count_is_updated(self):
+        self.quadtree.remove_point((0.3, 0.7))
+        self.assertEqual(self.quadtree.number_of_points, len(self.points) - 1)
+        self.failIf((0.3, 0.7) in set(self.quadtree.walk()))
+
+    def test_removes_one_duplicate(self):
+        self.quadtree.remove_point((0.5, 0.5))
+        self.assertEqual(self.quadtree.get_all_points().count((0.5, 0.5)), 3)
+
+    def test_same_shape_as_rebuilt_tree(self):
+        remaining = list(self.points)
+        for point in self.points[::2] + self.points[1:60:2]:
+            self.quadtree.remove_point(point)
+            remaining.remove(point)
+        expected = module.Node(None, self.quadtree.rectangle, max_points=11)
+        for point in remaining:
+            expected.add_point(point)
+        self.assertEqual(self.shape(self.quadtree), self.shape(expected))
+
+    def test_tree_collapses_into_leaf(self):
+        for point in self.points[:-5]:
+            self.quadtree.remove_point(point)
+        self.assertEqual(self.quadtree.type, module.Node.LEAF)
+        self.assertEqual(self.quadtree.children, [])
+        self.assertEqual(sorted(self.quadtree.features), sorted(self.points[-5:]))
+
+    def test_missing_point_raises_value_error(self):
+        self.assertRaises(ValueError, self.quadtree.remove_point, (0.55, 0.5))
+        self.assertRaises(ValueError, self.quadtree.remove_point, (2, 2))
+        self.assertEqual(self.quadtree.number_of_points, len(self.points))
+
+    def test_removes_point_with_payload(self):
+        node = module.Node(None, (0, 0, 1, 1), max_points=1)
+        node.add_point(module.Point(0.25, 0.25, 'a'))
+        node.add_point(module.Point(0.75, 0.75, 'b'))
+        node.remove_point(module.Point(0.25, 0.25, 'a'))
+        self.assertEqual(node.type, module.Node.LEAF)
+        self.assertEqual([point.data for point in node.features], ['b'])
+
+
+class TestMovePoint(ut.TestCase):
+    def setUp(self):
+        self.node = module.Node(None, (0, 0, 1, 1), max_points=1)
+        self.node.add_point((0.25, 0.25))
+        self.node.add_point((0.75, 0.75))
+
+    def test_point_is_moved(self):
+        self.node.move_point((0.25, 0.25), (0.8, 0.2))
+        self.assertEqual(self.node.number_of_points, 2)
+        self.assertSetEqual(set(self.node.walk()), {(0.8, 0.2), (0.75, 0.75)})
+
+    def test_move_outside_keeps_point(self):
+        self.assertRaises(ValueError, self.node.move_point,
+                          (0.25, 0.25), (2, 2))
+        self.assertSetEqual(set(self.node.walk()),
+                            {(0.25, 0.25), (0.75, 0.75)})
+
+    def test_counts_follow_points(self):
+        square = Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5])))
+        self.node.move_point((0.25, 0.25), (0.6, 0.9))
+        self.assertEqual(self.node.count_overlapping_points(square), 2)
+
+
 class TestFeatureOverlap(ut.TestCase):
     def setUp(self):
         self.square = Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5])))
@@ -246,6 +414,721 @@ class TestFeatureOverlap(ut.TestCase):
         self.assertEqual(node.count_overlapping_points(feature), 2500)
 
 
+class TestBatchOverlap(ut.TestCase):
+    def setUp(self):
+        self.quadtree = module.QuadTree(
+            [(x / 20.0, y / 20.0) for x in range(21) for y in range(21)]
+            + [(0.5, 0.5)] * 3)
+        self.features = [
+            Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5]))),
+            Feature(Polygon(module.bbox_to_coords([0.12, 0.3, 0.61, 0.44]))),
+            Feature(Polygon([(0, 0), (1, 0), (0, 1)])),
+            Feature(Polygon(module.bbox_to_coords([2, 2, 3, 3]))),
+            Feature(Polygon()),
+            Feature(Polygon(module.bbox_to_coords([-1, -1, 2, 2]))),
+        ]
+
+    def test_counts_match_single_queries(self):
+        self.assertEqual(
+            self.quadtree.count_overlapping_points_batch(self.features),
+            [self.quadtree.count_overlapping_points(feature)
+             for feature in self.features])
+
+    def test_points_match_single_queries(self):
+        self.assertEqual(
+            self.quadtree.get_overlapping_points_batch(self.features),
+            [self.quadtree.get_overlapping_points(feature)
+             for feature in self.features])
+
+    def test_containing_feature_counts_everything(self):
+        self.assertEqual(
+            self.quadtree.count_overlapping_points_batch(self.features)[-1],
+            self.quadtree.number_of_points)
+
+    def test_no_features(self):
+        self.assertEqual(self.quadtree.count_overlapping_points_batch([]), [])
+
+
+class TestQueryStats(ut.TestCase):
+    def setUp(self):
+        self.quadtree = module.QuadTree(
+            [(x / 20.0, y / 20.0) for x in range(21) for y in range(21)]
+            + [(0.5, 0.5)] * 3, max_points=4)
+        self.feature = Feature(Polygon([(0, 0), (1, 0), (0, 1)]))
+
+    def test_same_results_with_stats(self):
+        stats = module.QueryStats()
+        self.assertEqual(
+            self.quadtree.count_overlapping_points(self.feature, stats),
+            self.quadtree.count_overlapping_points(self.feature))
+        self.assertEqual(
+            self.quadtree.get_overlapping_points(self.feature, stats),
+            self.quadtree.get_overlapping_points(self.feature))
+        self.assertEqual(stats.queries, 2)
+
+    def test_counters(self):
+        stats = module.QueryStats()
+        self.quadtree.count_overlapping_points(self.feature, stats)
+        nodes = self.quadtree.overlapping_nodes(self.feature)
+        self.assertEqual(stats.contains_hits,
+                         len([node for node, contained in nodes if contained]))
+        self.assertEqual(stats.points_tested, sum([
+            len(node._points) for node, contained in nodes if not contained
+        ]))
+        self.failUnless(stats.nodes_visited >= len(nodes))
+        self.assertEqual(stats.intersects_calls,
+                         stats.nodes_visited - stats.contains_hits)
+        self.failUnless(stats.geos_time > 0)
+
+    def test_callback(self):
+        seen = []
+        stats = module.QueryStats(on_query=lambda s: seen.append(s.as_dict()))
+        self.quadtree.count_overlapping_points(self.feature, stats)
+        self.quadtree.count_overlapping_points(self.feature, stats)
+        self.assertEqual([item['queries'] for item in seen], [1, 2])
+        stats.reset()
+        self.assertEqual(stats.nodes_visited, 0)
+
+    def test_summary(self):
+        summary = self.quadtree.summary()
+        self.assertEqual(summary['points'], 444)
+        self.assertEqual(summary['distinct_points'], 441)
+        self.assertEqual(summary['nodes'],
+                         sum(summary['depth_histogram'].values()))
+        self.assertEqual(summary['depth_histogram'][0], 1)
+        self.assertEqual(summary['leaves'],
+                         len([node for node in self.iter_nodes()
+                              if node.type == module.Node.LEAF]))
+        self.assertEqual(sum([occupancy * leaves for occupancy, leaves
+                              in summary['leaf_occupancy'].items()]), 441)
+        self.assertEqual(summary['duplicates'], {
+            'locations': 1, 'points': 3, 'max_multiplicity': 4, 'leaves': 1})
+
+    def iter_nodes(self):
+        stack = [self.quadtree]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children)
+
+
+class TestLazyQueries(ut.TestCase):
+    def setUp(self):
+        self.quadtree = module.QuadTree(
+            [(x / 20.0, y / 20.0) for x in range(21) for y in range(21)]
+            + [(0.5, 0.5)] * 3, max_points=4)
+        self.feature = Feature(Polygon([(0, 0), (1, 0), (0, 1)]))
+
+    def test_iter_overlapping_points(self):
+        points = self.quadtree.iter_overlapping_points(self.feature)
+        self.failIf(isinstance(points, list))
+        self.assertEqual(list(points),
+                         self.quadtree.get_overlapping_points(self.feature))
+
+    def test_duplicates_are_repeated(self):
+        points = list(self.quadtree.iter_overlapping_points(self.feature))
+        self.assertEqual(points.count((0.5, 0.5)), 4)
+
+    def test_iter_all_points(self):
+        self.assertEqual(list(self.quadtree.iter_all_points()),
+                         self.quadtree.get_all_points())
+
+    def test_stops_early(self):
+        points = self.quadtree.iter_overlapping_points(self.feature)
+        self.failUnless(self.feature.contains_point(next(points)))
+
+    def test_any_overlapping(self):
+        self.failUnless(self.quadtree.any_overlapping(self.feature))
+        outside = Feature(Polygon(module.bbox_to_coords([2, 2, 3, 3])))
+        self.failIf(self.quadtree.any_overlapping(outside))
+        self.failIf(self.quadtree.any_overlapping(Feature(Polygon())))
+
+
+class TestQueryCache(ut.TestCase):
+    def setUp(self):
+        self.quadtree = module.QuadTree(
+            [(x / 20.0, y / 20.0) for x in range(21) for y in range(21)],
+            max_points=4)
+        self.quadtree.cache = module.QueryCache(maxsize=2)
+        self.feature = Feature(Polygon([(0, 0), (1, 0), (0, 1)]))
+
+    def test_repeated_query_hits(self):
+        count = self.quadtree.count_overlapping_points(self.feature)
+        same = Feature(Polygon([(0, 0), (1, 0), (0, 1)]))
+        self.assertEqual(self.quadtree.count_overlapping_points(same), count)
+        self.assertEqual(self.quadtree.cache.hits, 1)
+        self.assertEqual(self.quadtree.cache.misses, 1)
+
+    def test_query_types_are_separate(self):
+        count = self.quadtree.count_overlapping_points(self.feature)
+        points = self.quadtree.get_overlapping_points(self.feature)
+        self.assertEqual(len(points), count)
+        points.append('junk')
+        self.assertEqual(self.quadtree.get_overlapping_points(self.feature),
+                         points[:-1])
+        self.assertEqual(self.quadtree.cache.hits, 1)
+
+    def test_invalidated_by_mutations(self):
+        count = self.quadtree.count_overlapping_points(self.feature)
+        self.quadtree.add_point((0.01, 0.01))
+        self.assertEqual(self.quadtree.count_overlapping_points(self.feature),
+                         count + 1)
+        self.quadtree.remove_point((0.01, 0.01))
+        self.assertEqual(self.quadtree.count_overlapping_points(self.feature),
+                         count)
+        self.quadtree.children[0].add_point((0.02, 0.02))
+        self.assertEqual(self.quadtree.count_overlapping_points(self.feature),
+                         count + 1)
+        self.quadtree.add_point((-1, -1))
+        self.assertEqual(self.quadtree.count_overlapping_points(self.feature),
+                         count + 1)
+        self.assertEqual(self.quadtree.cache.hits, 0)
+
+    def test_eviction(self):
+        for x in range(3):
+            self.quadtree.count_overlapping_points(
+                Feature(Polygon(module.bbox_to_coords([0, 0, x + 1, 1]))))
+        self.assertEqual(len(self.quadtree.cache), 2)
+        self.assertEqual(self.quadtree.cache.evictions, 1)
+
+    def test_trees_share_a_cache(self):
+        other = module.QuadTree([(0.1, 0.1), (0.2, 0.2)])
+        other.cache = self.quadtree.cache
+        count = self.quadtree.count_overlapping_points(self.feature)
+        self.assertEqual(other.count_overlapping_points(self.feature), 2)
+        self.assertEqual(self.quadtree.count_overlapping_points(self.feature),
+                         count)
+        self.assertEqual(other.get_overlapping_points(self.feature),
+                         [(0.1, 0.1), (0.2, 0.2)])
+        self.assertEqual(self.quadtree.cache.hits, 1)
+
+    def test_hits_are_in_stats(self):
+        stats = module.QueryStats()
+        self.quadtree.count_overlapping_points(self.feature, stats)
+        self.quadtree.count_overlapping_points(self.feature, stats)
+        self.assertEqual(stats.queries, 2)
+        self.assertEqual(stats.cache_hits, 1)
+
+    def test_version(self):
+        version = self.quadtree.version
+        leaf_version = self.quadtree.children[0].version
+        self.quadtree.add_point((0.5, 0.5))
+        self.failUnless(self.quadtree.version > version)
+        self.failUnless(self.quadtree.children[0].version > leaf_version)
+
+
+class CountingFeature(Feature):
+    rectangle_tests = 0
+
+    def contains_rectangle(self, rectangle):
+        self.rectangle_tests += 1
+        return super(CountingFeature, self).contains_rectangle(rectangle)
+
+    def intersects_rectangle(self, rectangle):
+        self.rectangle_tests += 1
+        return super(CountingFeature, self).intersects_rectangle(rectangle)
+
+
+class TestQueryPlan(ut.TestCase):
+    def setUp(self):
+        self.quadtree = module.QuadTree(
+            [(x / 20.0, y / 20.0) for x in range(21) for y in range(21)],
+            max_points=4)
+        self.feature = CountingFeature(Polygon([(0, 0), (1, 0), (0, 1)]))
+
+    def assertMatchesTree(self, plan):
+        self.assertEqual(plan.count_overlapping_points(),
+                         self.quadtree.count_overlapping_points(self.feature))
+        self.assertEqual(plan.get_overlapping_points(),
+                         self.quadtree.get_overlapping_points(self.feature))
+
+    def test_runs_without_rectangle_tests(self):
+        count = self.quadtree.count_overlapping_points(self.feature)
+        plan = self.quadtree.compile(self.feature)
+        self.feature.rectangle_tests = 0
+        self.assertEqual(plan.count_overlapping_points(), count)
+        self.assertEqual(len(plan.get_overlapping_points()), count)
+        self.assertEqual(self.feature.rectangle_tests, 0)
+
+    def test_nodes(self):
+        plan = self.quadtree.compile(self.feature)
+        self.failUnless(plan.contained)
+        self.failUnless(all([node.type == module.Node.LEAF
+                             for node in plan.boundary]))
+
+    def test_follows_insertions(self):
+        plan = self.quadtree.compile(self.feature)
+        for i in range(20):
+            self.quadtree.add_point((0.3 + i / 1000.0, 0.3))
+        self.assertMatchesTree(plan)
+
+    def test_refreshes_subdivided_leaves(self):
+        plan = self.quadtree.compile(self.feature)
+        leaf = plan.boundary[0]
+        x0, y0, x1, y1 = leaf.rectangle
+        for i in range(20):
+            self.quadtree.add_point(
+                ((x0 + x1) / 2 + i * 1e-6, (y0 + y1) / 2))
+        self.assertEqual(leaf.type, module.Node.BRANCH)
+        self.assertMatchesTree(plan)
+        self.failIf(leaf in plan.boundary)
+
+    def test_recompiles_after_merges_and_growth(self):
+        plan = self.quadtree.compile(self.feature)
+        for point in self.quadtree.get_all_points()[:300]:
+            self.quadtree.remove_point(point)
+        self.assertMatchesTree(plan)
+        self.quadtree.add_point((-1.0, -1.0))
+        self.assertMatchesTree(plan)
+
+
+class TestEstimate(ut.TestCase):
+    def setUp(self):
+        self.quadtree = module.QuadTree(
+            [(x / 20.0, y / 20.0) for x in range(21) for y in range(21)],
+            max_points=4)
+        self.feature = Feature(Polygon([(0, 0), (1, 0), (0, 1)]))
+        self.count = self.quadtree.count_overlapping_points(self.feature)
+
+    def test_unlimited_is_exact(self):
+        estimate = self.quadtree.estimate_overlapping_points(self.feature)
+        self.failUnless(estimate.exact)
+        self.assertEqual(estimate.value, self.count)
+        self.assertEqual(estimate.lower, self.count)
+
+    def test_bounds(self):
+        for depth in range(4):
+            for budget in [None, 0, 1, 5]:
+                estimate = self.quadtree.estimate_overlapping_points(
+                    self.feature, depth=depth, budget=budget)
+                self.failUnless(
+                    estimate.lower <= self.count <= estimate.upper)
+                self.failUnless(
+                    estimate.lower <= estimate.value <= estimate.upper)
+
+    def test_area_fraction(self):
+        estimate = self.quadtree.estimate_overlapping_points(
+            self.feature, budget=0)
+        self.failIf(estimate.exact)
+        self.assertEqual(estimate.lower, 0)
+        self.assertEqual(estimate.upper, 441)
+        self.assertAlmostEqual(estimate.value, 441 * 0.5)
+
+    def test_deeper_is_tighter(self):
+        shallow = self.quadtree.estimate_overlapping_points(
+            self.feature, depth=1)
+        deep = self.quadtree.estimate_overlapping_points(
+            self.feature, depth=3)
+        self.failUnless(deep.upper - deep.lower
+                        <= shallow.upper - shallow.lower)
+
+    def test_covered_fraction(self):
+        self.assertAlmostEqual(
+            self.feature.covered_fraction((0, 0, 0.5, 0.5)), 1.0)
+        self.assertAlmostEqual(
+            self.feature.covered_fraction((0.5, 0.5, 1, 1)), 0.0)
+
+
+class TestDensity(ut.TestCase):
+    def setUp(self):
+        # points in the middle of 0.1 cells, and stacked duplicates
+        self.points = [((x + 0.5) / 40.0, (y + 0.5) / 40.0)
+                       for x in range(40) for y in range(0, 40, 3)]
+        self.points.extend([(0.33, 0.77)] * 5)
+        self.quadtree = module.QuadTree(self.points, max_points=3)
+
+    def brute_force(self, bbox, nx, ny):
+        x0, y0, x1, y1 = bbox
+        grid = [[0] * nx for row in range(ny)]
+        for x, y in self.points:
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                column = min(int((x - x0) / (x1 - x0) * nx), nx - 1)
+                row = min(int((y - y0) / (y1 - y0) * ny), ny - 1)
+                grid[row][column] += 1
+        return grid
+
+    def test_density_grid(self):
+        for bbox, nx, ny in [((0, 0, 1, 1), 10, 10),
+                             ((0, 0, 1, 1), 64, 64),
+                             ((0.2, 0.1, 0.7, 0.9), 5, 8),
+                             ((-1, -1, 0.5, 0.5), 3, 2)]:
+            grid = self.quadtree.density_grid(bbox, nx, ny)
+            self.assertEqual(grid.shape, (ny, nx))
+            self.assertEqual(grid.tolist(), self.brute_force(bbox, nx, ny))
+
+    def test_points_on_inner_edges(self):
+        points = [(0.25, 0.25), (0.5, 0.25), (0.5, 0.5), (0.5, 0.75),
+                  (0.25, 0.5), (0.75, 1.0), (1.0, 0.5), (0.1, 0.9)]
+        xs, ys = np.array(points).T
+        for nx, ny in [(2, 1), (2, 2), (4, 4), (8, 2)]:
+            x_edges = np.linspace(0, 1, nx + 1)
+            y_edges = np.linspace(0, 1, ny + 1)
+            expected = np.histogram2d(ys, xs, [y_edges, x_edges])[0].tolist()
+            for max_points in [1, 2, 4, 11]:
+                for tree in [module.QuadTree(points, extent=(0, 0, 1, 1),
+                                             max_points=max_points),
+                             module.QuadTree.from_arrays(
+                                 xs, ys, max_points=max_points)]:
+                    self.assertEqual(tree.density(x_edges, y_edges).tolist(),
+                                     expected)
+                    self.assertEqual(
+                        tree.compact().density(x_edges, y_edges).tolist(),
+                        expected)
+
+    def test_points_with_more_coordinates(self):
+        points = [(0.25, 0.25, 7.0), (0.75, 0.25, 8.0), (0.25, 0.75, 9.0),
+                  (0.75, 0.75, 10.0)]
+        quadtree = module.QuadTree(points)
+        self.assertEqual(quadtree.density_grid((0, 0, 1, 1), 2, 2).tolist(),
+                         [[1, 1], [1, 1]])
+
+    def test_compact_tree(self):
+        compact = self.quadtree.compact()
+        for bbox, nx, ny in [((0, 0, 1, 1), 10, 10),
+                             ((0.2, 0.1, 0.7, 0.9), 5, 8)]:
+            self.assertEqual(compact.density_grid(bbox, nx, ny).tolist(),
+                             self.brute_force(bbox, nx, ny))
+
+    def test_density_tile(self):
+        # tile 10/301/385 spans -74.18 to -73.83 and 40.45 to 40.71
+        points = [(-74.0 + i / 100.0, 40.6 + i / 200.0) for i in range(10)]
+        quadtree = module.QuadTree(points)
+        tile = quadtree.density_tile(10, 301, 385, size=4)
+        self.assertEqual(tile.shape, (4, 4))
+        self.assertEqual(tile.sum(), 10)
+        lons, lats = module.tile_edges(10, 301, 385, size=4)
+        self.failUnless(lons[0] < -74.0 and -73.91 < lons[-1])
+        self.failUnless(lats[0] < 40.6 and 40.645 < lats[-1])
+        # latitudes grow northwards, the top row comes first
+        self.assertEqual(tile[::-1].tolist(),
+                         quadtree.density(lons, lats).tolist())
+        self.assertEqual(
+            tile.tolist(), quadtree.compact().density_tile(
+                10, 301, 385, size=4).tolist())
+
+
+class TestRegionIndex(ut.TestCase):
+    def setUp(self):
+        self.features = [
+            Feature(Polygon([(0, 0), (1, 0), (0, 1)])),
+            Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 2, 2]))),
+            # overlaps both, comes last
+            Feature(Polygon(module.bbox_to_coords([0.2, 0.2, 1.5, 1.5]))),
+        ]
+        self.index = module.RegionIndex(self.features, max_depth=6)
+        self.points = [(x / 10.0 + 0.013, y / 10.0 + 0.007)
+                       for x in range(-2, 23) for y in range(-2, 23)]
+
+    def brute_force(self, points):
+        output = []
+        for point in points:
+            for i, feature in enumerate(self.features):
+                if feature.contains_point(point):
+                    output.append(i)
+                    break
+            else:
+                output.append(-1)
+        return output
+
+    def test_locate(self):
+        self.assertEqual(self.index.locate(self.points).tolist(),
+                         self.brute_force(self.points))
+
+    def test_locate_array(self):
+        self.assertEqual(
+            self.index.locate(np.array(self.points)).tolist(),
+            self.brute_force(self.points))
+
+    def test_first_feature_wins(self):
+        self.assertEqual(self.index.locate([(0.3, 0.3), (0.9, 0.9),
+                                            (1.2, 0.3), (3, 3)]).tolist(),
+                         [0, 1, 2, -1])
+
+    def test_cells_resolve_without_tests(self):
+        resolved = self.index.resolved >= 0
+        self.failUnless(resolved.any())
+        offsets = self.index.offsets
+        self.failIf((offsets[1:] > offsets[:-1])[resolved].any())
+        self.failUnless(all([
+            self.features[self.index.resolved[cell]].contains_rectangle(
+                tuple(self.index.rects[cell].tolist()))
+            for cell in np.flatnonzero(resolved).tolist()
+        ]))
+
+    def test_size_with_many_features(self):
+        features = [Polygon(module.bbox_to_coords([i + .1, j + .1,
+                                                   i + .9, j + .9]))
+                    for i in range(20) for j in range(20)]
+        index = module.RegionIndex(features, max_depth=7)
+        # only leaf cells keep candidates, a few features each
+        self.failUnless(len(index.candidates) <= index.number_of_cells)
+        self.assertEqual(len(index.offsets), index.number_of_cells + 1)
+        self.assertEqual(index.locate([(0.5, 0.5), (3.95, 2.5),
+                                       (19.5, 19.5)]).tolist(),
+                         [0, -1, 399])
+
+    def test_from_geojson(self):
+        index = module.RegionIndex.from_geojson('kings-county.geojson')
+        self.assertEqual(index.properties[0]['NHGISNAM'], 'Kings')
+        self.assertEqual(index.locate([(-73.95, 40.65), (-74.2, 40.65)])
+                         .tolist(), [0, -1])
+
+
+class TestConcurrentQuadTree(ut.TestCase):
+    def setUp(self):
+        self.points = [((x * 7 % 20) / 20.0, (x * 3 % 20) / 20.0)
+                       for x in range(200)]
+        self.points.extend([(-0.5, 0.2), (1.5, 1.5)])
+
+    def assertSameTree(self, node, other):
+        self.assertEqual(node.rectangle, other.rectangle)
+        self.assertEqual(node.type, other.type)
+        self.assertEqual(node.number_of_points, other.number_of_points)
+        self.assertEqual(node.features, other.features)
+        self.assertEqual(len(node.children), len(other.children))
+        for child, other_child in zip(node.children, other.children):
+            self.assertSameTree(child, other_child)
+
+    def test_same_tree_as_quadtree(self):
+        tree = module.ConcurrentQuadTree(batch_size=7)
+        quadtree = module.QuadTree(max_points=11)
+        for point in self.points:
+            tree.add_point(point)
+            quadtree.add_point(point)
+        tree.flush()
+        self.assertSameTree(tree.snapshot(), quadtree)
+
+    def test_batches(self):
+        tree = module.ConcurrentQuadTree(batch_size=10)
+        for point in self.points[:9]:
+            tree.add_point(point)
+        self.assertEqual(tree.number_of_points, 0)
+        tree.add_point(self.points[9])
+        self.assertEqual(tree.number_of_points, 10)
+        tree.add_points(self.points[10:12])
+        self.assertEqual(tree.number_of_points, 12)
+
+    def test_snapshots_do_not_change(self):
+        tree = module.ConcurrentQuadTree(batch_size=1)
+        snapshots = []
+        for point in self.points:
+            tree.add_point(point)
+            snapshot = tree.snapshot()
+            snapshots.append((snapshot, list(snapshot.get_all_points())))
+        for snapshot, points in snapshots:
+            self.assertEqual(snapshot.get_all_points(), points)
+            self.assertEqual(snapshot.number_of_points, len(points))
+
+    def test_shares_untouched_nodes(self):
+        tree = module.ConcurrentQuadTree(
+            module.QuadTree(self.points[:200]), batch_size=1)
+        before = tree.snapshot()
+        tree.add_point((0.01, 0.01))
+        after = tree.snapshot()
+        self.failIf(before is after)
+        self.failIf(before.children[0] is after.children[0])
+        self.failUnless(before.children[2] is after.children[2])
+
+    def test_growing_keeps_snapshots(self):
+        tree = module.ConcurrentQuadTree(
+            module.QuadTree(self.points[:200]), batch_size=1)
+        before = tree.snapshot()
+        parents = []
+        stack = [before]
+        while stack:
+            node = stack.pop()
+            parents.extend([(child, child.parent) for child in node.children])
+            stack.extend(node.children)
+        points = before.get_all_points()
+        tree.add_point((3.5, 2.5))
+        self.failUnless(tree.snapshot().point_coords_in_bbox((3.5, 2.5)))
+        self.assertEqual(tree.number_of_points, 201)
+        self.failUnless(all([child.parent is parent
+                             for child, parent in parents]))
+        self.assertEqual(before.get_all_points(), points)
+        self.assertEqual(before.rectangle, (0.0, 0.0, 0.95, 0.95))
+
+    def test_concurrent_readers(self):
+        tree = module.ConcurrentQuadTree(
+            module.QuadTree(extent=(0, 0, 1, 1)), batch_size=20)
+        errors = []
+        done = threading.Event()
+
+        def read():
+            # edges exact in binary, so points on them are counted alike
+            feature = Feature(Polygon(module.bbox_to_coords([0, 0, 0.5, 1])))
+            while not done.is_set():
+                snapshot = tree.snapshot()
+                expected = len([point for point in snapshot.get_all_points()
+                                if point[0] <= 0.5])
+                if snapshot.count_overlapping_points(feature) != expected:
+                    errors.append(snapshot)
+
+        readers = [threading.Thread(target=read) for i in range(3)]
+        for reader in readers:
+            reader.start()
+        for point in self.points[:200] * 5:
+            tree.add_point(point)
+        done.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(tree.number_of_points, 1000)
+
+    def test_threaded_executor(self):
+        tree = module.ConcurrentQuadTree(module.QuadTree(self.points))
+        features = [
+            Feature(Polygon([(0, 0), (1, 0), (0, 1)])),
+            Feature(Polygon(module.bbox_to_coords([0.2, 0.2, 0.6, 0.9]))),
+        ] * 3
+        with module.ThreadedQueryExecutor(tree, threads=3) as executor:
+            self.assertEqual(
+                executor.count_overlapping_points_batch(features),
+                [tree.count_overlapping_points(f) for f in features])
+            self.assertEqual(
+                executor.get_overlapping_points_batch(features),
+                [tree.get_overlapping_points(f) for f in features])
+
+
+class TestRingGeometry(ut.TestCase):
+    def setUp(self):
+        geojson = json.load(open("kings-county.geojson"))
+        self.mapping = geojson['features'][0]['geometry']
+        self.shapely_feature = Feature(asShape(self.mapping))
+        self.feature = Feature(self.mapping)
+        x0, y0, x1, y1 = self.feature.bounds
+        random = np.random.RandomState(0)
+        self.xs = random.uniform(x0, x1, 20000)
+        self.ys = random.uniform(y0, y1, 20000)
+        # a square with a square hole
+        self.square = Feature({'type': 'Polygon', 'coordinates': [
+            module.bbox_to_coords([0, 0, 4, 4]),
+            module.bbox_to_coords([1, 1, 3, 3]),
+        ]})
+
+    def test_geojson_becomes_rings(self):
+        self.failUnless(isinstance(self.feature.geometry,
+                                   module.RingGeometry))
+        self.assertEqual(self.feature.bounds, self.shapely_feature.bounds)
+        point = Feature({'type': 'Point', 'coordinates': (0, 0)})
+        self.failIf(isinstance(point.geometry, module.RingGeometry))
+
+    def test_import_without_shapely(self):
+        code = '\n'.join([
+            'import sys, quadtree',
+            'tree = quadtree.QuadTree([(0.1, 0.2), (0.5, 0.5), (0.9, 0.9)])',
+            'feature = quadtree.Feature({"type": "Polygon", "coordinates":'
+            ' [[(0, 0), (1, 0), (1, 0.6), (0, 0.6)]]})',
+            'assert tree.count_overlapping_points(feature) == 2',
+            'assert tree.count_in_rectangle((0, 0, 0.5, 0.5)) == 2',
+            'assert "shapely" not in sys.modules',
+        ])
+        subprocess.check_call([sys.executable, '-c', code])
+
+    def test_import_without_numpy(self):
+        code = '\n'.join([
+            'import sys, quadtree',
+            'tree = quadtree.QuadTree([(0.1, 0.2), (0.5, 0.5), (0.9, 0.9)])',
+            'tree.add_points(iter([(0.3, 0.3)]))',
+            'assert len(list(tree.walk())) == 4',
+            'assert tree.count_in_rectangle((0, 0, 0.5, 0.5)) == 3',
+            'assert tree.nearest_points((0, 0)) == [(0.1, 0.2)]',
+            'loaded = [name for name in ("numpy", "shapely", "csv",'
+            ' "multiprocessing", "tempfile") if name in sys.modules]',
+            'assert not loaded, loaded',
+        ])
+        subprocess.check_call([sys.executable, '-c', code])
+
+    def test_points_agree_with_shapely(self):
+        self.assertEqual(
+            self.feature.contains_coordinates(self.xs, self.ys).tolist(),
+            self.shapely_feature.contains_coordinates(self.xs, self.ys)
+            .tolist())
+        points = list(zip(self.xs[:200].tolist(), self.ys[:200].tolist()))
+        self.assertEqual(
+            [self.feature.contains_point(point) for point in points],
+            self.shapely_feature.contains_points(points))
+
+    def test_boundary_is_inside(self):
+        corners = module.bbox_to_coords([0, 0, 4, 4])
+        self.failUnless(all(self.square.contains_points(
+            corners + [(2, 0), (1, 2), (3, 3)])))
+        self.assertEqual(self.square.contains_points([(2, 2), (5, 2)]),
+                         [False, False])
+
+    def test_rectangles_agree_with_shapely(self):
+        x0, y0, x1, y1 = self.feature.bounds
+        random = np.random.RandomState(1)
+        for i in range(500):
+            width, height = (10 ** random.uniform(-4, 0, 2)).tolist()
+            x, y = random.uniform(size=2).tolist()
+            rectangle = (x0 + (x1 - x0) * x, y0 + (y1 - y0) * y,
+                         x0 + (x1 - x0) * (x + width),
+                         y0 + (y1 - y0) * (y + height))
+            self.assertEqual(
+                self.feature.contains_rectangle(rectangle),
+                self.shapely_feature.contains_rectangle(rectangle))
+            self.assertEqual(
+                self.feature.intersects_rectangle(rectangle),
+                self.shapely_feature.intersects_rectangle(rectangle))
+            self.assertAlmostEqual(
+                self.feature.covered_fraction(rectangle),
+                self.shapely_feature.covered_fraction(rectangle))
+
+    def test_holes(self):
+        self.failIf(self.square.intersects_rectangle((1.5, 1.5, 2.5, 2.5)))
+        self.failIf(self.square.contains_rectangle((0.5, 0.5, 3.5, 3.5)))
+        self.failUnless(self.square.contains_rectangle((0, 0, 1, 4)))
+        self.assertEqual(self.square.covered_fraction((0, 0, 4, 4)), 0.75)
+
+    def test_island_in_hole(self):
+        mapping = {'type': 'MultiPolygon', 'coordinates': [
+            [module.bbox_to_coords([0, 0, 10, 10]),
+             module.bbox_to_coords([2, 2, 8, 8])],
+            [module.bbox_to_coords([3, 3, 7, 7])],
+        ]}
+        feature = Feature(mapping)
+        shapely_feature = Feature(asShape(mapping))
+        for rectangle in [(4, 4, 6, 6), (1, 1, 9, 9), (0, 0, 2, 10),
+                          (2.5, 2.5, 7.5, 7.5), (3, 3, 7, 7)]:
+            self.assertEqual(feature.contains_rectangle(rectangle),
+                             shapely_feature.contains_rectangle(rectangle))
+            self.assertEqual(feature.intersects_rectangle(rectangle),
+                             shapely_feature.intersects_rectangle(rectangle))
+        self.failUnless(feature.contains_rectangle((4, 4, 6, 6)))
+        tree = module.QuadTree([(x + 0.5, y + 0.5) for x in range(10)
+                                for y in range(10)], extent=(0, 0, 10, 10))
+        self.assertEqual(tree.count_overlapping_points(feature),
+                         tree.count_overlapping_points(shapely_feature))
+
+    def test_queries_agree_with_shapely(self):
+        tree = module.QuadTree.from_arrays(self.xs, self.ys)
+        for polygon in self.mapping['coordinates'][:3]:
+            mapping = {'type': 'Polygon', 'coordinates': polygon}
+            self.assertEqual(
+                tree.get_overlapping_points(Feature(mapping)),
+                tree.get_overlapping_points(Feature(asShape(mapping))))
+        self.assertEqual(
+            tree.count_overlapping_points(self.feature),
+            tree.count_overlapping_points(self.shapely_feature))
+
+    def test_wkb(self):
+        self.assertEqual(self.feature.wkb, self.shapely_feature.wkb)
+        rings = module.RingGeometry.from_wkb(self.shapely_feature.wkb)
+        self.assertEqual(rings.__geo_interface__['type'], 'MultiPolygon')
+        self.assertEqual(rings.bounds, self.feature.bounds)
+        self.failUnless(asShape(self.square.geometry).equals(
+            Polygon(module.bbox_to_coords([0, 0, 4, 4]),
+                    [module.bbox_to_coords([1, 1, 3, 3])])))
+
+    def test_threaded_executor(self):
+        tree = module.QuadTree.from_arrays(self.xs, self.ys)
+        with module.ThreadedQueryExecutor(tree, threads=2) as executor:
+            self.assertEqual(
+                executor.count_overlapping_points_batch([self.feature] * 2),
+                [tree.count_overlapping_points(self.feature)] * 2)
+
+
 class TestQuadTree(ut.TestCase):
     def setUp(self):
         self.points = [
@@ -271,6 +1154,543 @@ class TestQuadTree(ut.TestCase):
         self.assertEqual(self.quadtree.count_overlapping_points(rectangle), 2)
 
 
+class TestSaveLoad(ut.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tree.qt')
+        self.points = [(x / 20.0, (x * 7 % 19) / 20.0) for x in range(300)]
+        self.points.extend([(0.5, 0.5)] * 3)
+        self.quadtree = module.QuadTree(self.points)
+        self.quadtree.add_point((-4, 2))
+        self.feature = Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5])))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.quadtree.save(self.path)
+        loaded = module.QuadTree.load(self.path)
+        self.failUnless(isinstance(loaded, module.QuadTree))
+        nodes = [(self.quadtree, loaded)]
+        for node, other in nodes:
+            self.assertEqual(node.rectangle, other.rectangle)
+            self.assertEqual(node.type, other.type)
+            self.assertEqual(node.number_of_points, other.number_of_points)
+            self.assertEqual(node.features, other.features)
+            self.assertEqual(node._points, other._points)
+            nodes.extend(zip(node.children, other.children))
+
+    def test_loaded_tree_can_be_updated(self):
+        self.quadtree.save(self.path)
+        loaded = module.QuadTree.load(self.path)
+        loaded.add_point((10, 10))
+        loaded.remove_point((0.5, 0.5))
+        self.assertEqual(loaded.number_of_points, self.quadtree.number_of_points)
+
+    def test_keeps_max_depth(self):
+        tree = module.QuadTree([(0.1, 0.1), (0.9, 0.9)], max_points=2,
+                               max_depth=4)
+        tree.save(self.path)
+        loaded = module.QuadTree.load(self.path)
+        self.assertEqual(loaded.max_depth, 4)
+        # distinct points too close to separate above the limit
+        loaded.add_points([(0.3, 0.3 + i * 1e-9) for i in range(20)])
+        self.assertEqual(max(loaded.summary()['depth_histogram']), 4)
+        self.assertEqual(module.QuadTree.load(self.path, mmap=True).max_depth,
+                         4)
+
+        self.quadtree.save(self.path)
+        self.assertEqual(module.QuadTree.load(self.path).max_depth, None)
+
+    def test_loads_version_1_files(self):
+        self.quadtree.save(self.path)
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+        header = module.struct.unpack(module.FILE_HEADER, data[:40])
+        with open(self.path, 'wb') as fp:
+            fp.write(module.struct.pack(module.FILE_HEADERS[1], header[0], 1,
+                                        *header[2:5]))
+            fp.write(data[40:])
+        loaded = module.QuadTree.load(self.path)
+        self.assertEqual(loaded.get_all_points(),
+                         self.quadtree.get_all_points())
+        self.assertEqual(loaded.max_depth, None)
+
+    def test_memory_mapped(self):
+        self.quadtree.save(self.path)
+        mapped = module.QuadTree.load(self.path, mmap=True)
+        self.failUnless(isinstance(mapped, module.CompactQuadTree))
+        self.failIf(mapped.coords.flags.writeable)
+        self.assertEqual(mapped.max_points, self.quadtree.max_points)
+        self.assertEqual(mapped.count_overlapping_points(self.feature),
+                         self.quadtree.count_overlapping_points(self.feature))
+        self.assertEqual(mapped.get_all_points(),
+                         self.quadtree.get_all_points())
+
+    def test_compact_round_trip(self):
+        compact = self.quadtree.compact()
+        compact.save(self.path)
+        self.assertEqual(os.path.getsize(self.path), 40 + compact.nbytes)
+        loaded = module.CompactQuadTree.load(self.path)
+        for array, other in zip(compact.arrays(), loaded.arrays()):
+            self.assertEqual(array.tolist(), other.tolist())
+
+    def test_rejects_other_files(self):
+        self.assertRaises(ValueError, module.QuadTree.load, "kings-county.geojson")
+
+    def test_rejects_truncated_files(self):
+        self.quadtree.save(self.path)
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+        with open(self.path, 'wb') as fp:
+            fp.write(data[:-8])
+        self.assertRaises(ValueError, module.QuadTree.load, self.path)
+
+
+class TestParallelQueries(ut.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        points = [(x / 50.0, (x * 37 % 101) / 100.0) for x in range(2000)]
+        points.extend([(0.5, 0.5)] * 3)
+        cls.quadtree = module.QuadTree(points, max_points=4)
+        cls.executor = module.ParallelQueryExecutor(cls.quadtree, processes=2)
+        cls.features = [
+            Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5]))),
+            Feature(Polygon([(0, 0), (30, 0), (0, 1)])),
+            Feature(Polygon(module.bbox_to_coords([50, 50, 51, 51]))),
+        ]
+
+    @classmethod
+    def tearDownClass(cls):
+        path = cls.executor._temporary
+        cls.executor.close()
+        assert not os.path.exists(path)
+
+    def test_batch_counts(self):
+        self.assertEqual(
+            self.executor.count_overlapping_points_batch(self.features),
+            self.quadtree.count_overlapping_points_batch(self.features))
+
+    def test_batch_points(self):
+        self.assertEqual(
+            self.executor.get_overlapping_points_batch(self.features),
+            self.quadtree.get_overlapping_points_batch(self.features))
+
+    def test_split_feature(self):
+        for feature in self.features:
+            self.assertEqual(
+                self.executor.count_overlapping_points(feature),
+                self.quadtree.count_overlapping_points(feature))
+            self.assertEqual(
+                self.executor.get_overlapping_points(feature),
+                self.quadtree.get_overlapping_points(feature))
+
+    def test_pool_is_reused(self):
+        pool = self.executor.pool
+        for i in range(3):
+            self.executor.count_overlapping_points_batch(self.features)
+        self.failUnless(self.executor.pool is pool)
+
+
+class TestRectangleQuery(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 20.0, y / 20.0)
+                       for x in range(21) for y in range(21)]
+        self.points.extend([(0.5, 0.5)] * 3)
+        self.quadtree = module.QuadTree(self.points)
+        self.boxes = [(0.5, 0.5, 1.5, 1.5), (0.12, 0.3, 0.61, 0.44),
+                      (0.25, 0.25, 0.75, 0.75), (-1, -1, 2, 2),
+                      (2, 2, 3, 3), (0.0, 0.0, 0.05, 1.0)]
+
+    def test_count_same_as_feature(self):
+        for bbox in self.boxes:
+            feature = Feature(Polygon(module.bbox_to_coords(bbox)))
+            self.assertEqual(self.quadtree.count_in_rectangle(bbox),
+                             self.quadtree.count_overlapping_points(feature))
+
+    def test_points_same_as_feature(self):
+        for bbox in self.boxes:
+            feature = Feature(Polygon(module.bbox_to_coords(bbox)))
+            self.assertEqual(self.quadtree.query_rectangle(bbox),
+                             self.quadtree.get_overlapping_points(feature))
+
+    def test_boundary_is_included(self):
+        self.assertEqual(
+            sorted(self.quadtree.query_rectangle((0.05, 0.05, 0.1, 0.05))),
+            [(0.05, 0.05), (0.1, 0.05)])
+
+    def test_compact_tree(self):
+        compact = self.quadtree.compact()
+        for bbox in self.boxes:
+            self.assertEqual(compact.count_in_rectangle(bbox),
+                             self.quadtree.count_in_rectangle(bbox))
+            self.assertEqual(compact.query_rectangle(bbox),
+                             self.quadtree.query_rectangle(bbox))
+
+
+class TestAggregates(ut.TestCase):
+    def setUp(self):
+        self.points = [
+            module.Point(x / 10.0, y / 10.0, {'population': x * 11 + y})
+            for x in range(11) for y in range(11)]
+        self.points.append(module.Point(0.5, 0.5, {'other': 1}))
+        self.quadtree = module.QuadTree(self.points)
+        self.quadtree.register_aggregate('population')
+        self.square = Feature(Polygon(module.bbox_to_coords([0.45, 0.15, 1.5, 0.95])))
+
+    def expected(self, points):
+        values = [point.data['population'] for point in points
+                  if 'population' in point.data]
+        return len(values), sum(values), min(values), max(values)
+
+    def summary(self, aggregate):
+        return aggregate.count, aggregate.sum, aggregate.min, aggregate.max
+
+    def test_root_aggregate(self):
+        self.assertEqual(self.summary(self.quadtree.aggregates['population']),
+                         self.expected(self.points))
+
+    def test_every_node_is_aggregated(self):
+        nodes = [self.quadtree]
+        for node in nodes:
+            nodes.extend(node.children)
+            points = node.get_all_points()
+            if points:
+                self.assertEqual(self.summary(node.aggregates['population'])[0],
+                                 self.expected(points)[0])
+
+    def test_aggregate_overlapping(self):
+        inside = self.quadtree.get_overlapping_points(self.square)
+        aggregate = self.quadtree.aggregate_overlapping(self.square, 'population')
+        self.assertEqual(self.summary(aggregate), self.expected(inside))
+        self.assertEqual(aggregate.mean,
+                         float(aggregate.sum) / aggregate.count)
+
+    def test_kept_up_to_date(self):
+        extra = [module.Point(0.55, 0.55, {'population': 1000}),
+                 module.Point(3, 3, {'population': -5})]
+        for point in extra:
+            self.quadtree.add_point(point)
+        self.quadtree.add_points([module.Point(0.7, 0.2, {'population': 7})] * 20)
+        self.quadtree.remove_point(self.points[-2])
+        points = self.quadtree.get_all_points()
+        self.assertEqual(self.summary(self.quadtree.aggregates['population']),
+                         self.expected(points))
+        inside = self.quadtree.get_overlapping_points(self.square)
+        self.assertEqual(
+            self.summary(self.quadtree.aggregate_overlapping(self.square,
+                                                             'population')),
+            self.expected(inside))
+
+    def test_unregistered_field(self):
+        self.assertRaises(KeyError, self.quadtree.aggregate_overlapping,
+                          self.square, 'other')
+
+    def test_empty_aggregate(self):
+        aggregate = module.Aggregate()
+        self.assertEqual(aggregate.mean, None)
+        aggregate.add(None)
+        self.assertEqual(aggregate.count, 0)
+
+
+class TestNearestPoints(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 10.0, (x * 7 % 11) / 10.0) for x in range(60)]
+        self.points.append((0.5, 0.5))
+        self.quadtree = module.QuadTree(self.points)
+
+    def distance(self, point, other):
+        return (point[0] - other[0]) ** 2 + (point[1] - other[1]) ** 2
+
+    def test_nearest_point(self):
+        for target in [(0, 0), (2.55, 0.31), (10, 10), (-3, 0.5)]:
+            nearest = self.quadtree.nearest_points(target)
+            self.assertEqual(len(nearest), 1)
+            self.assertEqual(
+                self.distance(nearest[0], target),
+                min([self.distance(point, target) for point in self.points]))
+
+    def test_k_nearest_are_sorted_and_closest(self):
+        target = (3.02, 0.48)
+        nearest = self.quadtree.nearest_points(target, k=7)
+        distances = [self.distance(point, target) for point in nearest]
+        self.assertEqual(
+            distances,
+            sorted([self.distance(point, target)
+                    for point in self.points])[:7])
+
+    def test_more_than_available(self):
+        self.assertEqual(len(self.quadtree.nearest_points((0, 0), k=1000)),
+                         len(self.points))
+
+    def test_ties_in_tree_order(self):
+        quadtree = module.QuadTree([(x, y) for x in range(9)
+                                    for y in range(9)], max_points=3)
+        for target in [(4, 4), (3.5, 4), (0, 8)]:
+            self.assertEqual(
+                quadtree.nearest_points(target, k=81),
+                sorted(quadtree.get_all_points(),
+                       key=lambda point: self.distance(point, target)))
+
+    def test_returns_point_objects(self):
+        quadtree = module.QuadTree([module.Point(0, 0, 'a'),
+                                    module.Point(1, 1, 'b')])
+        self.assertEqual(quadtree.nearest_points((0.9, 0.8))[0].data, 'b')
+
+
+class TestPointsWithinDistance(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 20.0, y / 20.0)
+                       for x in range(21) for y in range(21)]
+        self.points.extend([(0.5, 0.5)] * 2)
+        self.quadtree = module.QuadTree(self.points)
+
+    def brute_force(self, target, distance):
+        return sorted([
+            point for point in self.points
+            if (point[0] - target[0]) ** 2 + (point[1] - target[1]) ** 2
+            <= distance ** 2
+        ])
+
+    def test_same_as_brute_force(self):
+        for target, distance in [((0.5, 0.5), 0.2), ((0, 0), 0.33),
+                                 ((1.2, 0.5), 0.25), ((0.31, 0.77), 0.05)]:
+            self.assertEqual(
+                sorted(self.quadtree.get_points_within_distance(
+                    target, distance)),
+                self.brute_force(target, distance))
+
+    def test_boundary_is_included(self):
+        self.assertEqual(
+            sorted(self.quadtree.get_points_within_distance((0, 0), 0.05)),
+            [(0.0, 0.0), (0.0, 0.05), (0.05, 0.0)])
+
+    def test_large_radius_returns_everything(self):
+        self.assertEqual(
+            len(self.quadtree.get_points_within_distance((0.5, 0.5), 10)),
+            len(self.points))
+
+    def test_far_away(self):
+        self.assertEqual(
+            self.quadtree.get_points_within_distance((5, 5), 1), [])
+
+
+class TestGrowingRoot(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 10.0, y / 10.0) for x in range(11) for y in range(11)]
+        self.quadtree = module.QuadTree(self.points)
+
+    def test_empty_tree(self):
+        quadtree = module.QuadTree()
+        self.assertEqual(quadtree.number_of_points, 0)
+        quadtree.add_point((3, 4))
+        self.assertEqual(quadtree.rectangle, (3, 4, 3, 4))
+        quadtree.add_point((1, 5))
+        self.assertEqual(quadtree.rectangle, (1, 4, 3, 5))
+
+    def test_extent_hint(self):
+        quadtree = module.QuadTree(extent=(0, 0, 10, 10))
+        quadtree.add_point((1, 1))
+        self.assertEqual(quadtree.rectangle, (0, 0, 10, 10))
+
+    def test_point_outside_grows_root(self):
+        self.quadtree.add_point((2.5, -0.5))
+        self.failUnless(self.quadtree.point_coords_in_bbox((2.5, -0.5)))
+        self.assertEqual(self.quadtree.number_of_points, len(self.points) + 1)
+        self.assertSetEqual(set(self.quadtree.walk()),
+                            set(self.points + [(2.5, -0.5)]))
+
+    def test_subtrees_are_reused(self):
+        children = list(self.quadtree.children)
+        self.quadtree.add_point((-0.5, -0.5))
+        old = self.quadtree.children[0]
+        self.assertEqual(old.rectangle, (0, 0, 1, 1))
+        self.assertEqual(old.children, children)
+        for child in children:
+            self.failUnless(child.parent is old)
+
+    def test_root_doubles_towards_point(self):
+        self.quadtree.add_point((-0.5, 1.5))
+        self.assertEqual(self.quadtree.rectangle, (-1, 0, 1, 2))
+
+    def test_queries_after_growth(self):
+        points = self.points + [(-3, 2), (7, -1), (0, 1.5), (1, 1)]
+        for point in points[len(self.points):]:
+            self.quadtree.add_point(point)
+        square = Feature(Polygon(module.bbox_to_coords([-4, 0.5, 1, 3])))
+        expected = len([point for point in points
+                        if module.point_in_rectangle(point, (-4, 0.5, 1, 3))])
+        self.assertEqual(self.quadtree.count_overlapping_points(square),
+                         expected)
+
+    def test_points_on_old_edge_can_be_removed(self):
+        self.quadtree.add_point((-2, -2))
+        self.quadtree.add_point((0, 0.5))
+        self.quadtree.remove_point((0, 0.5))
+        self.quadtree.remove_point((0, 0.5))
+        self.assertEqual(self.quadtree.number_of_points, len(self.points))
+
+    def test_move_point_outside(self):
+        self.quadtree.move_point((0.5, 0.5), (4, 4))
+        self.failUnless((4, 4) in self.quadtree.get_all_points())
+
+    def test_failed_move_does_not_grow(self):
+        rectangle = self.quadtree.rectangle
+        self.assertRaises(ValueError, self.quadtree.move_point,
+                          (0.55, 0.55), (5, 5))
+        self.assertRaises(ValueError, self.quadtree.move_point,
+                          (0.5, 0.5), (float('nan'), 5))
+        self.assertEqual(self.quadtree.rectangle, rectangle)
+        self.assertEqual(sorted(self.quadtree.get_all_points()),
+                         sorted(self.points))
+
+    def test_node_does_not_grow(self):
+        node = module.Node(None, (0, 0, 1, 1))
+        self.assertRaises(ValueError, node.add_point, (2, 2))
+
+    def test_coordinates_not_finite(self):
+        rectangle = self.quadtree.rectangle
+        for point in [(float('nan'), 1), (1, float('inf'))]:
+            self.assertRaises(ValueError, self.quadtree.add_point, point)
+            self.assertRaises(ValueError, self.quadtree.add_points,
+                              iter([(2, 2), point]))
+        self.assertEqual(self.quadtree.rectangle, rectangle)
+        self.assertEqual(self.quadtree.number_of_points, len(self.points))
+        self.assertRaises(ValueError, module.QuadTree,
+                          [(0, 0), (float('nan'), 1), (1, 1)])
+        source = io.StringIO(u'x,y\n0,0\nnan,1\n1,1\n')
+        self.assertRaises(ValueError, module.QuadTree.from_csv, source)
+
+
+class TestStreaming(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 10.0, (x * 7 % 13) / 10.0) for x in range(200)]
+        self.points.extend([(0.5, 0.5)] * 3)
+
+    def geojson(self, points):
+        return json.dumps({
+            'type': 'FeatureCollection',
+            'name': 'points',
+            'features': [{
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': list(point)},
+                'properties': {'id': i},
+            } for i, point in enumerate(points)],
+        }, indent=1)
+
+    def test_find_bbox_of_iterator(self):
+        self.assertEqual(module.QuadTree.find_bbox(iter(self.points)),
+                         module.QuadTree.find_bbox(self.points))
+
+    def test_tree_from_iterator(self):
+        quadtree = module.QuadTree(iter(self.points))
+        self.assertEqual(quadtree.number_of_points, len(self.points))
+        self.assertEqual(sorted(quadtree.get_all_points()), sorted(self.points))
+
+    def test_from_stream_in_chunks(self):
+        quadtree = module.QuadTree.from_stream(iter(self.points), chunk_size=7)
+        self.assertEqual(sorted(quadtree.get_all_points()), sorted(self.points))
+        square = Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5])))
+        self.assertEqual(quadtree.count_overlapping_points(square),
+                         module.QuadTree(self.points).count_overlapping_points(square))
+
+    def test_from_stream_with_extent(self):
+        quadtree = module.QuadTree.from_stream(
+            iter(self.points), extent=(0, 0, 100, 100), chunk_size=50)
+        self.assertEqual(quadtree.rectangle, (0, 0, 100, 100))
+        self.assertEqual(quadtree.number_of_points, len(self.points))
+
+    def test_add_points_same_as_add_point(self):
+        quadtree = module.QuadTree()
+        quadtree.add_points(self.points[:100])
+        quadtree.add_points(self.points[100:])
+        self.assertEqual(sorted(quadtree.get_all_points()), sorted(self.points))
+        node = module.Node(None, (0, 0, 1, 1))
+        self.assertRaises(ValueError, node.add_points, [(0.5, 0.5), (2, 2)])
+        self.assertEqual(node.number_of_points, 0)
+
+    def test_add_points_from_generator(self):
+        quadtree = module.QuadTree(extent=(0, 0, 1, 1))
+        quadtree.add_points(point for point in [(.1, .1), (.2, .2)])
+        self.assertEqual(quadtree.number_of_points, 2)
+        quadtree.add_points(iter([(3, 3)]))
+        self.assertEqual(sorted(quadtree.get_all_points()),
+                         [(.1, .1), (.2, .2), (3, 3)])
+        node = module.Node(None, (0, 0, 1, 1))
+        node.add_points(iter([(.5, .5), (.7, .7)]))
+        self.assertEqual(node.number_of_points, 2)
+
+    def test_csv(self):
+        source = io.StringIO(u'id,lon,lat\n' + u''.join(
+            u'%d,%r,%r\n' % (i, x, y) for i, (x, y) in enumerate(self.points)))
+        quadtree = module.QuadTree.from_csv(source, x='lon', y='lat',
+                                            chunk_size=10)
+        self.assertEqual(sorted(quadtree.get_all_points()), sorted(self.points))
+
+    def test_csv_payload(self):
+        source = io.StringIO(u'x,y,name\n1,2,a\n3,4,b\n')
+        points = list(module.iter_csv_points(source, properties=True))
+        self.assertEqual([point.data['name'] for point in points], ['a', 'b'])
+        self.assertEqual((points[1].x, points[1].y), (3.0, 4.0))
+
+    def test_geojson_collection_in_small_chunks(self):
+        source = io.StringIO(self.geojson(self.points))
+        self.assertEqual(
+            list(module.iter_geojson_points(source, chunk_size=16)),
+            self.points)
+
+    def test_geojson_sequence(self):
+        source = io.StringIO(u'\n'.join(json.dumps({
+            'type': 'Feature', 'properties': {'id': i},
+            'geometry': {'type': 'Point', 'coordinates': list(point)}})
+            for i, point in enumerate(self.points)))
+        points = list(module.iter_geojson_points(source, properties=True,
+                                                 chunk_size=32))
+        self.assertEqual([(point.x, point.y) for point in points], self.points)
+        self.assertEqual(points[3].data, {'id': 3})
+
+    def test_geojson_skips_other_geometries(self):
+        self.assertEqual(list(module.iter_geojson_points("kings-county.geojson")),
+                         [])
+
+    def test_geojson_tree(self):
+        source = io.StringIO(self.geojson(self.points))
+        quadtree = module.QuadTree.from_geojson(source, chunk_size=20)
+        self.assertEqual(sorted(quadtree.get_all_points()), sorted(self.points))
+
+    def test_geojson_features_of_other_members(self):
+        document = json.loads(self.geojson(self.points))
+        document = dict([('metadata', {'features': [1, 2]})]
+                        + list(document.items()))
+        text = json.dumps(document)
+        self.failUnless(text.index('"metadata"') < text.index('"type"'))
+        for chunk_size in (16, 100, len(text) + 1):
+            self.assertEqual(
+                list(module.iter_geojson_points(io.StringIO(text),
+                                                chunk_size=chunk_size)),
+                [tuple(map(float, point)) for point in self.points])
+
+    def test_geojson_list_properties(self):
+        source = io.StringIO(json.dumps({
+            'type': 'FeatureCollection',
+            'features': [{
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [1, 2]},
+                'properties': {'tags': ['a', 'b'], 'extra': {'n': [1]}},
+            }],
+        }))
+        quadtree = module.QuadTree.from_geojson(source, properties=True)
+        point, = quadtree.get_all_points()
+        self.assertEqual(point.data['tags'], ['a', 'b'])
+        self.assertEqual(hash(point), hash(module.Point(
+            1.0, 2.0, {'tags': ['a', 'b'], 'extra': {'n': [1]}})))
+
+    def test_truncated_geojson(self):
+        source = io.StringIO(self.geojson(self.points)[:-200])
+        self.assertRaises(ValueError, list,
+                          module.iter_geojson_points(source, chunk_size=64))
+
+
 class TestWalk(ut.TestCase):
     def test_returns_one_point(self):
         points = [
@@ -336,5 +1756,237 @@ class TestMetaData(ut.TestCase):
                          len(node.get_overlapping_points(feature)))
 
 
+class TestBulkLoad(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 100.0, y / 100.0)
+                       for x in range(0, 100, 3) for y in range(0, 100, 7)]
+        # duplicates and points on quadrant boundaries
+        self.points.extend([(0.5, 0.5)] * 5 + [(0.0, 0.5), (0.5, 0.99)])
+
+    def assertSameTree(self, node, other):
+        self.assertEqual(node.rectangle, other.rectangle)
+        self.assertEqual(node.type, other.type)
+        self.assertEqual(node.number_of_points, other.number_of_points)
+        self.assertEqual(node.features, other.features)
+        self.assertEqual(node._points, other._points)
+        self.assertEqual(len(node.children), len(other.children))
+        for child, other_child in zip(node.children, other.children):
+            self.assertSameTree(child, other_child)
+
+    def test_same_tree_as_incremental_build(self):
+        xs = [x for x, y in self.points]
+        ys = [y for x, y in self.points]
+        self.assertSameTree(module.QuadTree.from_arrays(xs, ys),
+                            module.QuadTree(self.points))
+
+    def test_accepts_coordinate_buffer(self):
+        quadtree = module.QuadTree.from_arrays(self.points)
+        self.assertEqual(quadtree.number_of_points, len(self.points))
+        self.assertSetEqual(set(quadtree.walk()), set(self.points))
+
+    def test_same_overlapping_points(self):
+        feature = Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5])))
+        quadtree = module.QuadTree(self.points)
+        bulk = module.QuadTree.from_arrays(self.points)
+        self.assertEqual(bulk.count_overlapping_points(feature),
+                         quadtree.count_overlapping_points(feature))
+        self.assertEqual(bulk.get_overlapping_points(feature),
+                         quadtree.get_overlapping_points(feature))
+
+    def test_max_points(self):
+        quadtree = module.QuadTree.from_arrays(self.points, max_points=1000)
+        self.assertEqual(quadtree.type, module.Node.LEAF)
+
+    def test_rejects_mismatched_arrays(self):
+        self.assertRaises(TypeError, module.QuadTree.from_arrays,
+                          [0, 1], [0])
+
+    def test_rejects_empty_input(self):
+        self.assertRaises(ValueError, module.QuadTree.from_arrays, [], [])
+
+
+class TestCompactQuadTree(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 100.0, y / 100.0)
+                       for x in range(0, 100, 3) for y in range(0, 100, 7)]
+        self.points.extend([(0.5, 0.5)] * 5)
+        self.quadtree = module.QuadTree(self.points)
+        self.compact = self.quadtree.compact()
+        self.feature = Feature(Polygon(module.bbox_to_coords([0.5, 0.5, 1.5, 1.5])))
+
+    def test_same_structure(self):
+        nodes = [(self.quadtree, self.compact)]
+        for node, compact in nodes:
+            self.assertEqual(node.rectangle, compact.rectangle)
+            self.assertEqual(node.type, compact.type)
+            self.assertEqual(node.number_of_points, compact.number_of_points)
+            self.assertEqual(node.features, compact.features)
+            nodes.extend(zip(node.children, compact.children))
+
+    def test_bulk_load_matches_packed_tree(self):
+        compact = module.CompactQuadTree.from_arrays(self.points)
+        for name in ('rects', 'counts', 'first_child', 'starts', 'coords'):
+            self.assertEqual(getattr(compact, name).tolist(),
+                             getattr(self.compact, name).tolist())
+
+    def test_count_overlapping_points(self):
+        self.assertEqual(self.compact.count_overlapping_points(self.feature),
+                         self.quadtree.count_overlapping_points(self.feature))
+
+    def test_get_overlapping_points(self):
+        self.assertEqual(self.compact.get_overlapping_points(self.feature),
+                         self.quadtree.get_overlapping_points(self.feature))
+
+    def test_walk(self):
+        self.assertEqual(list(self.compact.walk()),
+                         list(self.quadtree.walk()))
+
+    def test_get_all_points(self):
+        self.assertEqual(self.compact.get_all_points(),
+                         self.quadtree.get_all_points())
+
+    def test_point_payloads_are_dropped(self):
+        quadtree = module.QuadTree([module.Point(0, 0, 'a'),
+                                    module.Point(1, 1, 'b')])
+        self.assertEqual(quadtree.compact().get_all_points(),
+                         [(0.0, 0.0), (1.0, 1.0)])
+
+
+class TestDepthLimit(ut.TestCase):
+    def setUp(self):
+        # distinct points closer together than the tree can separate
+        # without going very deep
+        self.points = [(0.0, 0.0), (1.0, 1.0)] + [
+            (0.3 + i * 1e-12, 0.3 + i * 1e-12) for i in range(50)]
+
+    def depth(self, node):
+        return max(node.summary()['depth_histogram'])
+
+    def test_leaves_overflow_at_max_depth(self):
+        quadtree = module.QuadTree(self.points, max_points=2, max_depth=5)
+        self.assertEqual(self.depth(quadtree), 5)
+        self.assertEqual(quadtree.number_of_points, len(self.points))
+        self.assertEqual(max(quadtree.summary()['leaf_occupancy']), 50)
+        self.assertEqual(quadtree.count_in_rectangle((0.2, 0.2, 0.4, 0.4)),
+                         50)
+
+    def test_unlimited_depth(self):
+        quadtree = module.QuadTree(self.points, max_points=2)
+        self.failUnless(self.depth(quadtree) > 30)
+        self.assertEqual(sorted(quadtree.walk()), sorted(self.points))
+        self.assertEqual(quadtree.get_all_points(),
+                         list(quadtree.walk()))
+
+    def test_coincident_payload_points(self):
+        points = [module.Point(0.5, 0.5, {'id': i}) for i in range(12)]
+        points += [module.Point(0, 0, {'id': 12}),
+                   module.Point(1, 1, {'id': 13})]
+        quadtree = module.QuadTree(points)
+        self.assertEqual(quadtree.type, module.Node.LEAF)
+        self.assertEqual(quadtree.number_of_points, 14)
+        for i in range(10):
+            quadtree.add_point(module.Point(0.25, 0.25 + i / 100.0))
+        self.assertEqual(len(quadtree.children), 4)
+        self.assertEqual(
+            quadtree.summary()['nodes'],
+            module.QuadTree.from_arrays(
+                [module.get_coords(point) for point in quadtree.walk()]
+            ).summary()['nodes'])
+        for i in range(10):
+            quadtree.remove_point(module.Point(0.25, 0.25 + i / 100.0))
+        self.assertEqual(quadtree.type, module.Node.LEAF)
+
+    def test_bulk_load_honours_max_depth(self):
+        quadtree = module.QuadTree(self.points, max_points=2, max_depth=5)
+        bulk = module.QuadTree.from_arrays(self.points, max_points=2,
+                                           max_depth=5)
+        self.assertEqual(bulk.summary(), quadtree.summary())
+        self.assertEqual(sorted(bulk.get_all_points()),
+                         sorted(quadtree.get_all_points()))
+
+    def test_get_depth(self):
+        quadtree = module.QuadTree(self.points, max_points=2, max_depth=3)
+        node = quadtree
+        while node.children:
+            node = max(node.children, key=lambda child: child.number_of_points)
+        self.assertEqual(quadtree.get_depth(), 0)
+        self.assertEqual(node.get_depth(), 3)
+
+    def test_growth_keeps_max_depth(self):
+        quadtree = module.QuadTree(self.points, max_points=2, max_depth=5)
+        quadtree.add_point((3.0, 3.0))
+        self.failUnless(all([
+            child.max_depth == 5 for child in quadtree.children]))
+
+
+class TestMortonQuadTree(ut.TestCase):
+    def setUp(self):
+        self.points = [(x / 100.0, y / 100.0)
+                       for x in range(0, 100, 3) for y in range(0, 100, 7)]
+        self.points.extend([(0.5, 0.5)] * 20 + [(0.0, 0.5), (0.5, 0.99)])
+        self.feature = Feature(Polygon([(0.1, 0.1), (0.9, 0.2), (0.5, 0.8)]))
+
+    def test_backend_selection(self):
+        morton = module.QuadTree(self.points, backend='morton')
+        self.failUnless(isinstance(morton, module.MortonQuadTree))
+        self.failUnless(isinstance(module.QuadTree(self.points),
+                                   module.QuadTree))
+        self.assertRaises(ValueError, module.QuadTree, self.points,
+                          backend='unknown')
+
+    def test_from_ndarray(self):
+        coords = np.array(self.points)
+        for tree in [module.MortonQuadTree(coords),
+                     module.QuadTree(coords, backend='morton'),
+                     module.MortonQuadTree(coords, extent=(0, 0, 1, 1))]:
+            self.assertEqual(tree.count_overlapping_points(self.feature),
+                             module.QuadTree(self.points)
+                             .count_overlapping_points(self.feature))
+            self.assertEqual(sorted(tree.get_all_points()),
+                             sorted(self.points))
+        self.assertEqual(
+            module.MortonQuadTree(np.zeros((0, 2))).get_all_points(),
+            [])
+
+    def test_morton_backend_has_no_max_depth(self):
+        self.assertRaises(ValueError, module.QuadTree, self.points,
+                          backend='morton', max_depth=5)
+
+    def test_same_results_as_quadtree(self):
+        quadtree = module.QuadTree(self.points)
+        morton = module.QuadTree(self.points, backend='morton', max_points=3)
+        self.assertEqual(morton.number_of_points, len(self.points))
+        self.assertEqual(morton.count_overlapping_points(self.feature),
+                         quadtree.count_overlapping_points(self.feature))
+        self.assertEqual(sorted(morton.get_overlapping_points(self.feature)),
+                         sorted(quadtree.get_overlapping_points(self.feature)))
+        self.assertEqual(sorted(morton.walk()), sorted(quadtree.walk()))
+
+    def test_points_sorted_by_morton_code(self):
+        morton = module.MortonQuadTree([(1, 1), (0, 1), (1, 0), (0, 0)])
+        self.assertEqual(morton.get_all_points(),
+                         [(0, 0), (1, 0), (0, 1), (1, 1)])
+
+    def test_keeps_point_objects(self):
+        points = [module.Point(x, y, {'index': index})
+                  for index, (x, y) in enumerate(self.points)]
+        morton = module.MortonQuadTree(points)
+        found = morton.get_overlapping_points(self.feature)
+        self.failUnless(all(isinstance(point, module.Point)
+                            for point in found))
+        self.assertEqual(len(found),
+                         morton.count_overlapping_points(self.feature))
+
+    def test_from_arrays(self):
+        xs = [x for x, y in self.points]
+        ys = [y for x, y in self.points]
+        morton = module.MortonQuadTree.from_arrays(xs, ys)
+        self.assertEqual(sorted(morton.walk()), sorted(self.points))
+
+    def test_rejects_points_outside_extent(self):
+        self.assertRaises(ValueError, module.MortonQuadTree,
+                          [(2, 2)], extent=(0, 0, 1, 1))
+
+
 if __name__ == '__main__':
     ut.main()